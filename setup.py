@@ -18,6 +18,7 @@ setup(
         'console_scripts': [
             'sgpublish-create = sgpublish.commands.create:main', # Deprecated.
             'publish_generic = sgpublish.commands.create:main',
+            'sgpublish-daemon = sgpublish.commands.daemon:main',
         ],
     },
     
@@ -1,2 +1,2 @@
 from .publisher import Publisher
-
+from .batch import publish_many
@@ -0,0 +1,167 @@
+"""A non-blocking variant of the :class:`~sgpublish.publisher.Publisher`.
+
+Services which drive many publishes at once can't afford to block on each of
+them. The :class:`AsyncPublisher` runs every stage of a
+:class:`~sgpublish.publisher.Publisher` on the shared ``"publish"`` pool (see
+:mod:`sgpublish.executor`), and returns :class:`concurrent.futures.Future`
+objects instead of blocking. Stages of one publish still run in the order in
+which they were requested.
+
+Each stage occupies a worker of that pool until it is done (a commit, for
+instance, waits there on its copies and Shotgun requests, which run on the
+``"io"`` and ``"shotgun"`` pools), so at most as many publishes make progress
+at once as the ``"publish"`` pool has workers. Services which drive many
+publishes at once should size it accordingly; see :class:`AsyncPublisher`.
+
+Under Python 3 these futures may be awaited from an event loop via
+:func:`asyncio.wrap_future`.
+
+"""
+
+import logging
+import threading
+
+import concurrent.futures
+
+from . import executor
+from .publisher import Publisher
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncPublisher(object):
+
+    """Drives a :class:`~sgpublish.publisher.Publisher` without blocking.
+
+    Takes the same arguments as the :class:`~sgpublish.publisher.Publisher`,
+    which is constructed by :meth:`create`::
+
+        >>> pub = AsyncPublisher(link=task, type='maya_geocache', name='cache')
+        >>> pub.create()
+        >>> pub.add_file(path)
+        >>> future = pub.commit()
+        >>> future.add_done_callback(notify_user)
+
+    If any stage fails, the returned future carries the exception, and every
+    later stage (e.g. the :meth:`commit`, so that a publish is never
+    committed without a file which failed to be added) fails with the same
+    exception. The caller should then :meth:`rollback` (exactly as with the
+    blocking class).
+
+    Stages run on the shared ``"publish"`` pool, which has only
+    ``executor.DEFAULT_SIZES['publish']`` workers by default, so only that
+    many publishes advance at once. To run hundreds concurrently, enlarge it
+    (the copies themselves are still limited by the ``"io"`` pool)::
+
+        >>> from sgpublish import executor
+        >>> executor.configure(publish=200)
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._last = None
+        self._created = None
+        self._failure = None
+        self.publisher = None
+
+    def _then(self, func, after_failure=False):
+        """Run ``func`` on the pool once all previous stages are done.
+
+        :param bool after_failure: Run even if a previous stage failed;
+            otherwise this stage fails with the same exception.
+
+        """
+
+        future = concurrent.futures.Future()
+
+        def start(previous=None):
+            if self._failure is not None and not after_failure:
+                future.set_exception(self._failure)
+                return
+            inner = executor.submit('publish', func)
+            inner.add_done_callback(lambda inner: self._finish(inner, future))
+
+        with self._lock:
+            previous = self._last
+            self._last = future
+
+        if previous is None:
+            start()
+        else:
+            previous.add_done_callback(start)
+        return future
+
+    def _finish(self, inner, future):
+        exc = inner.exception()
+        if exc is not None:
+            # Recorded before the next stage is started by set_exception.
+            if self._failure is None:
+                self._failure = exc
+            future.set_exception(exc)
+        else:
+            future.set_result(inner.result())
+
+    def _create(self):
+        self.publisher = Publisher(*self._args, **self._kwargs)
+        return self.publisher
+
+    def create(self):
+        """Create the stub PublishEvent and the directory.
+
+        :return: A future of the :class:`~sgpublish.publisher.Publisher`.
+
+        """
+        if self._created is not None:
+            raise ValueError('publish already created')
+        self._created = future = self._then(self._create)
+        return future
+
+    def _require(self, name):
+        if self._created is None:
+            raise RuntimeError('must create before %s' % name)
+
+    def add_file(self, *args, **kwargs):
+        """Schedule :meth:`Publisher.add_file <sgpublish.publisher.Publisher.add_file>`.
+
+        :return: A future of the destination path.
+
+        """
+        self._require('add_file')
+        return self._then(lambda: self.publisher.add_file(*args, **kwargs))
+
+    def add_files(self, *args, **kwargs):
+        """Schedule :meth:`Publisher.add_files <sgpublish.publisher.Publisher.add_files>`."""
+        self._require('add_files')
+        return self._then(lambda: self.publisher.add_files(*args, **kwargs))
+
+    def commit(self):
+        """Schedule :meth:`Publisher.commit <sgpublish.publisher.Publisher.commit>`.
+
+        :return: A future of the committed PublishEvent.
+
+        """
+        self._require('commit')
+
+        def commit():
+            self.publisher.commit()
+            return self.publisher.entity
+
+        return self._then(commit)
+
+    def rollback(self):
+        """Schedule :meth:`Publisher.rollback <sgpublish.publisher.Publisher.rollback>`.
+
+        Does nothing if the publisher was never created.
+
+        """
+
+        def rollback():
+            if self.publisher is not None:
+                self.publisher.rollback()
+
+        # This must run even if an earlier stage failed.
+        return self._then(rollback, after_failure=True)
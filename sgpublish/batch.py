@@ -0,0 +1,324 @@
+"""Creating many publishes at once.
+
+Every :class:`~sgpublish.publisher.Publisher` makes several serial round
+trips to Shotgun: a ``create`` for the stub, a ``find`` for its version, and
+an ``update`` on commit. :func:`publish_many` does the same work for many
+publishes, but groups those requests into as few round trips as possible,
+while still isolating (and rolling back) the publishes which fail.
+
+"""
+
+import collections
+import logging
+
+from . import executor
+from . import stubs
+from . import timing
+from .publisher import Publisher, stream_heads
+
+
+log = logging.getLogger(__name__)
+
+
+class BatchResult(object):
+
+    """The outcome of one publish within :func:`publish_many`.
+
+    .. attribute:: spec
+
+        The ``dict`` which described this publish.
+
+    .. attribute:: publisher
+
+        The :class:`~sgpublish.publisher.Publisher`, or ``None`` if it could
+        not even be constructed.
+
+    .. attribute:: error
+
+        The exception which failed this publish, or ``None``.
+
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.publisher = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<BatchResult %r>' % getattr(self.publisher, 'entity', None)
+        return '<BatchResult error=%r>' % self.error
+
+    def _fail(self, error):
+        log.exception('publish %r failed' % (self.spec.get('name') or self.spec.get('code')))
+        self.error = error
+        if self.publisher is not None and getattr(self.publisher, 'entity', None):
+            try:
+                self.publisher.rollback()
+            except Exception:
+                log.exception('error during rollback')
+
+    def _attempt(self, func, *args, **kwargs):
+        if not self.ok:
+            return
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            self._fail(e)
+
+
+def _live(results):
+    return [result for result in results if result.ok]
+
+
+def _set_automatic_versions(session, publishers):
+    """Start determining the versions of many publishes.
+
+    Streams already in :data:`~sgpublish.publisher.stream_heads` are set
+    immediately, and the head of each other stream is found with a sorted
+    (single row) query; those queries run in parallel on the ``"shotgun"``
+    pool.
+
+    :return: A list of futures.
+
+    """
+
+    streams = collections.OrderedDict()
+    for publisher in publishers:
+        key = (publisher.link['type'], publisher.link['id'], publisher.type, publisher.name)
+        streams.setdefault(key, []).append(publisher)
+
+    futures = []
+    for group in streams.itervalues():
+        publisher = group[0]
+        head = stream_heads.get(publisher.link, publisher.type, publisher.name)
+        if head is None:
+            futures.append(executor.submit('shotgun', _find_stream_head, session, group))
+        else:
+            _set_versions(group, head)
+    return futures
+
+
+def _find_stream_head(session, publishers):
+    """Find the head of the stream the publishers share, and set their versions."""
+
+    publisher = publishers[0]
+    # Only the highest non-failed commit matters; sorting on the server
+    # keeps this from growing with the stream's history.
+    head = session.find_one('PublishEvent', [
+        ('sg_link', 'is', publisher.link),
+        ('sg_type', 'is', publisher.type),
+        ('code', 'is', publisher.name),
+        ('sg_version', 'greater_than', 0),
+    ], ['sg_link', 'sg_version', 'created_at'],
+        order=[{'field_name': 'sg_version', 'direction': 'desc'}],
+    )
+    if head:
+        stream_heads.update(publisher.link, publisher.type, publisher.name, head)
+    _set_versions(publishers, head)
+
+
+def _set_versions(publishers, head):
+    for publisher in publishers:
+        if head:
+            publisher._version = head['sg_version'] + 1
+            publisher._parent = head
+        else:
+            publisher._version = 1
+
+
+def _create_stubs(session, results):
+
+    requests = []
+    for result in results:
+        data = result._attempt(result.publisher._initial_data)
+        if data is None:
+            continue
+        # Claim a pooled stub where we can; see sgpublish.stubs.
+        stub_id = stubs.pool.claim(session, data['project'], data['created_by'])
+        if stub_id:
+            requests.append((result, data, stub_id, {
+                'request_type': 'update',
+                'entity_type': 'PublishEvent',
+                'entity_id': stub_id,
+                'data': stubs.update_fields(data),
+            }))
+        else:
+            requests.append((result, data, None, {
+                'request_type': 'create',
+                'entity_type': 'PublishEvent',
+                'data': data,
+            }))
+    if not requests:
+        return
+
+    try:
+        entities = session.batch([request for _, _, _, request in requests])
+    except Exception:
+        # Batches are all-or-nothing, so try them one at a time to find out
+        # which are actually at fault. The stubs weren't touched, so they
+        # go back into the pool.
+        log.warning('batch create failed; creating stubs individually', exc_info=True)
+        for result, data, stub_id, _ in reversed(requests):
+            if stub_id:
+                stubs.pool.release(data['project'], data['created_by'], stub_id)
+        for result, _, _, _ in requests:
+            result._attempt(result.publisher._create_stub)
+    else:
+        for (result, data, stub_id, _), entity in zip(requests, entities):
+            if stub_id:
+                entity = dict(data, type='PublishEvent', id=stub_id)
+            result.publisher.entity = session.merge(entity)
+
+
+def _update_entities(session, results):
+
+    requests = [(result, {
+        'request_type': 'update',
+        'entity_type': 'PublishEvent',
+        'entity_id': result.publisher.entity['id'],
+        'data': result._updates,
+    }) for result in results]
+    if not requests:
+        return
+
+    try:
+        session.batch([request for _, request in requests])
+    except Exception:
+        log.warning('batch update failed; updating individually', exc_info=True)
+        for result, request in requests:
+            result._attempt(session.update, 'PublishEvent', request['entity_id'], request['data'])
+
+
+def _wait_all(results, attr):
+    for result in results:
+        for future in getattr(result, attr, None) or ():
+            result._attempt(future.result)
+
+
+def add_files_from_spec(publisher, files=(), relative_to=None, metadata=None, export=None):
+    """Add the ``files``, ``metadata``, and ``export`` of a spec to a publisher.
+
+    See :func:`publish_many` for what each may be.
+
+    """
+    if metadata:
+        publisher.metadata.update(metadata)
+    paths = []
+    for file_ in files:
+        if isinstance(file_, basestring):
+            paths.append(file_)
+        else:
+            publisher.add_file(*file_)
+    if paths:
+        publisher.add_files(paths, relative_to)
+    if export is not None:
+        export(publisher)
+
+
+def publish_many(specs, sgfs=None):
+    """Create and commit many publishes, batching their Shotgun requests.
+
+    Each spec is a ``dict`` of keyword arguments for the
+    :class:`~sgpublish.publisher.Publisher`, plus any of:
+
+    - ``files``: paths to add via :meth:`~sgpublish.publisher.Publisher.add_files`,
+      or ``(src_path, dst_name)`` pairs to add via
+      :meth:`~sgpublish.publisher.Publisher.add_file`;
+    - ``relative_to``: passed to :meth:`~sgpublish.publisher.Publisher.add_files`;
+    - ``metadata``: a ``dict`` to merge into the publisher's metadata;
+    - ``export``: called with the publisher, to write anything else into it.
+
+    The stubs are created in one Shotgun batch, the versions are found with
+    one (single row) query per stream, all in parallel, and the second stage
+    updates are sent in another batch. If any publish fails, it is rolled
+    back and the rest continue.
+
+    ::
+
+        >>> results = sgpublish.publish_many([
+        ...     dict(link=task, type='maya_camera', name='camera', files=[path])
+        ...     for task, path in cameras
+        ... ])
+        >>> failed = [r for r in results if not r.ok]
+
+    :param sgfs: Shared by all publishes; defaults to that of the first one.
+    :return: A list of :class:`BatchResult`, in the same order as the specs.
+
+    """
+
+    results = []
+    for spec in specs:
+        result = BatchResult(spec)
+        results.append(result)
+
+        kwargs = dict(spec)
+        for key in ('files', 'relative_to', 'metadata', 'export'):
+            kwargs.pop(key, None)
+        if sgfs is not None:
+            kwargs.setdefault('sgfs', sgfs)
+
+        result.publisher = publisher = Publisher.__new__(Publisher)
+        result._attempt(publisher._prepare, **kwargs)
+        if result.ok and sgfs is None:
+            sgfs = publisher.sgfs
+
+    live = _live(results)
+    if not live:
+        return results
+    session = sgfs.session
+
+    # First stage; everything which can go alongside the stubs.
+    for result in live:
+        result._futures = result._attempt(result.publisher._start_first_stage,
+            automatic_version=False,
+            fetch_link=False,
+        )
+    shared_futures = _set_automatic_versions(session,
+        [result.publisher for result in live if result.publisher._version is None],
+    )
+    shared_futures.append(executor.submit('shotgun', session.fetch_core, [result.publisher.link for result in live]))
+
+    _create_stubs(session, live)
+
+    _wait_all(live, '_futures')
+    for future in shared_futures:
+        try:
+            future.result()
+        except Exception as e:
+            for result in _live(live):
+                result._fail(e)
+
+    # Directories, and whatever is going into them.
+    for result in _live(live):
+        result._attempt(result.publisher._setup_directory)
+    for result in _live(live):
+        spec = result.spec
+        result._attempt(add_files_from_spec, result.publisher,
+            files=spec.get('files') or (),
+            relative_to=spec.get('relative_to'),
+            metadata=spec.get('metadata'),
+            export=spec.get('export'),
+        )
+
+    # Second stage.
+    for result in _live(live):
+        result._updates = result._attempt(result.publisher._prepare_commit)
+    for result in _live(live):
+        result._futures = result._attempt(result.publisher._commit_files)
+    _wait_all(_live(live), '_futures')
+
+    _update_entities(session, _live(live))
+
+    for result in _live(live):
+        result._attempt(result.publisher._finish_commit)
+
+    for result in results:
+        if result.publisher is not None and getattr(result.publisher, 'timings', None) is not None:
+            timing.emit(result.publisher)
+
+    return results
@@ -0,0 +1,136 @@
+"""A content-addressed store for published files.
+
+Successive versions of a publish stream tend to contain mostly the same
+files. Instead of copying every one of them again, a :class:`BlobStore` keeps
+a single copy of each unique file (named by the digest of its contents), and
+hardlinks it into each publish which contains it.
+
+A store is shared by everyone publishing into a project, so its directories
+are made writable by their group (which they inherit, via the setgid bit),
+whatever the umask of whoever creates them. Blobs themselves are read-only,
+and owned by whoever first stored them. On hosts with
+``fs.protected_hardlinks`` enabled (the default on Linux), others may not
+hardlink a blob they don't own; their publishes get a reflink of the blob
+where the filesystem supports them (which still shares its data), and a copy
+otherwise. To deduplicate everything on such hosts, publish as a single user
+(e.g. via :mod:`sgpublish.daemon`).
+
+"""
+
+import errno
+import logging
+import os
+import shutil
+
+from . import utils
+from .copier import copy_file
+from .permissions import publish_mode
+
+
+log = logging.getLogger(__name__)
+
+
+#: The mode of the store's directories; see the module docs.
+DIRECTORY_MODE = 02775
+
+
+def _makedirs(path):
+    """Make a directory (and its parents) with :data:`DIRECTORY_MODE`."""
+    if os.path.isdir(path):
+        return
+    parent = os.path.dirname(path)
+    if parent != path:
+        _makedirs(parent)
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return
+    # Explicitly, since mkdir is subject to the umask.
+    os.chmod(path, DIRECTORY_MODE)
+
+
+class BlobStore(object):
+
+    """A directory of files named by the digest of their contents.
+
+    :param str root: The directory to store blobs in; created as needed.
+    :param str algorithm: A :mod:`hashlib` algorithm to name blobs with.
+
+    The store should be on the same device as the publishes, otherwise the
+    blobs will be copied (rather than hardlinked) into place.
+
+    """
+
+    def __init__(self, root, algorithm='sha256'):
+        self.root = os.path.abspath(root)
+        self.algorithm = algorithm
+
+    @classmethod
+    def for_project(cls, sgfs, project, **kwargs):
+        """Get the store which lives within the given project's directory."""
+        project_path = sgfs.path_for_entity(project)
+        if not project_path:
+            raise ValueError('%s %d has no directory' % (project['type'], project['id']))
+        return cls(os.path.join(project_path, '.sgpublish', 'blobs', kwargs.get('algorithm', 'sha256')), **kwargs)
+
+    def path_for_digest(self, digest):
+        """Where the blob with the given digest would live."""
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path_for_digest(digest))
+
+    def add(self, src_path):
+        """Put a file into the store (if it isn't already there).
+
+        :return: ``(digest, size)`` of the file.
+
+        """
+
+        digest = utils.hash_file(src_path, self.algorithm)
+        blob_path = self.path_for_digest(digest)
+        size = os.path.getsize(src_path)
+
+        if os.path.exists(blob_path):
+            return digest, size
+
+        # Copy it beside the final location and rename it into place, so that
+        # a concurrent publish of the same content will never see a partial
+        # blob (and one of the renames will simply win).
+        blob_dir = os.path.dirname(blob_path)
+        _makedirs(blob_dir)
+        tmp_path = os.path.join(blob_dir, '.%s.%d.%s' % (digest, os.getpid(), os.urandom(4).encode('hex')))
+        try:
+            shutil.copy(src_path, tmp_path)
+            # Already as published, since others can't chmod it once linked.
+            os.chmod(tmp_path, publish_mode(os.stat(tmp_path).st_mode))
+            os.rename(tmp_path, blob_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        return digest, size
+
+    def link(self, src_path, dst_path):
+        """Store a file, and hardlink the blob to ``dst_path``.
+
+        Falls back to a reflink (or copy) of the blob if it can't be
+        hardlinked, e.g. if it is on another device, or owned by another user.
+
+        :return: ``(digest, size)`` of the file.
+
+        """
+
+        digest, size = self.add(src_path)
+        blob_path = self.path_for_digest(digest)
+        try:
+            os.link(blob_path, dst_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            log.debug('could not hardlink blob %s (%s); copying' % (digest, e))
+            copy_file(blob_path, dst_path, 'reflink')
+        return digest, size
@@ -0,0 +1,42 @@
+from __future__ import absolute_import
+
+import argparse
+import logging
+
+from .. import executor
+from .. import stubs
+from ..daemon import DEFAULT_ADDRESS, PublishDaemon
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Publish on behalf of other processes.')
+    parser.add_argument('-a', '--address', default=DEFAULT_ADDRESS,
+        help='Unix socket to listen on; defaults to %(default)s')
+    parser.add_argument('-j', '--jobs', type=int,
+        help='how many publishes to run at once')
+    parser.add_argument('--stubs', type=int, metavar='N',
+        help='keep N empty PublishEvents ready for each project, to start publishes sooner')
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.jobs:
+        executor.configure(publish=args.jobs)
+    if args.stubs:
+        stubs.pool.enabled = True
+        stubs.pool.size = args.stubs
+
+    daemon = PublishDaemon(args.address)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
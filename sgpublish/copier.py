@@ -0,0 +1,965 @@
+"""Bulk copying of files into a publish.
+
+Publishes of geocaches and render layers may contain thousands of files, and
+on network filesystems copying them one at a time is bound by round-trip
+latency instead of bandwidth. The :class:`Copier` queues copies, groups them
+by destination directory (so that each directory is only created once), and
+runs the groups on the shared ``"io"`` thread pool. Whole directory trees
+may also be queued; they are enumerated by :func:`sgpublish.walker.walk` as
+the copy runs, so that copying starts immediately and memory use does not
+grow with the size of the tree.
+
+Files may also be placed without streaming them through Python; see
+:func:`copy_file` for the available methods. Data which is copied is subject
+to the bandwidth limits of :mod:`sgpublish.scheduler`.
+
+"""
+
+import collections
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import stat
+import sys
+import time
+
+import concurrent.futures
+
+from . import executor
+from . import permissions
+from . import scheduler
+from . import utils
+from . import walker
+from .permissions import publish_mode
+
+
+log = logging.getLogger(__name__)
+
+
+#: Maximum number of files handled by a single task on the pool; large
+#: directories are split so that they may be copied in parallel.
+DEFAULT_BATCH_SIZE = 64
+
+
+_STREAM_CHUNK_SIZE = 1048576
+
+# Blocks of zeros are left as holes by a sparse copy; this is their size if
+# the filesystem doesn't say.
+_DEFAULT_BLOCK_SIZE = 4096
+
+# For finding the data within sparse files; Python 2 doesn't expose these,
+# but Linux has them.
+_SEEK_DATA = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+_SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
+
+#: Files at least this large are copied by :func:`chunked_copy` (when they
+#: would otherwise be streamed) by journaled publishes, so that a failed copy
+#: may be continued when the publish is resumed.
+CHUNKED_THRESHOLD = 1 << 30
+
+# The size of each in-kernel copy while bandwidth is limited.
+_THROTTLED_CHUNK_SIZE = 8 << 20
+
+#: The size of each chunk of a :func:`chunked_copy`.
+CHUNK_SIZE = 64 << 20
+
+#: Appended to the destination path to name the progress of a :func:`chunked_copy`.
+PARTIAL_SUFFIX = '.sgpublish-partial'
+
+# Chunks only need to be checked against themselves, so use the fastest hash.
+_CHUNK_ALGORITHM = 'xxhash' if utils.xxhash is not None else 'md5'
+
+#: Methods understood by :func:`copy_file`.
+METHODS = ('copy', 'move', 'link', 'reflink', 'auto')
+
+# From <linux/fs.h>; clones the extents of one file into another on
+# filesystems which support copy-on-write (e.g. btrfs, xfs, ZFS).
+_FICLONE = 0x40049409
+
+# Errors which mean "this filesystem can't do that"; we fall back on these.
+_unsupported_errnos = set(getattr(errno, name) for name in (
+    'EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOTTY', 'ENOSYS', 'EPERM', 'EBADF',
+) if hasattr(errno, name))
+
+# (src_dev, dst_dev) pairs which have failed to reflink, so that we don't
+# keep attempting it for every file of a large publish.
+_no_reflink = set()
+
+
+def _finish_copy(src_stat, dst_fh, read_only):
+    """Set the mode of a freshly copied file via its descriptor."""
+    mode = publish_mode(src_stat.st_mode) if read_only else stat.S_IMODE(src_stat.st_mode)
+    os.fchmod(dst_fh.fileno(), mode)
+
+
+def _set_times(src_stat, dst_path):
+    os.utime(dst_path, (src_stat.st_atime, src_stat.st_mtime))
+
+
+def _stream_copy(src_path, dst_path, read_only=False, hasher=None):
+    with open(src_path, 'rb') as src_fh:
+        src_stat = os.fstat(src_fh.fileno())
+        with open(dst_path, 'wb') as dst_fh:
+            while True:
+                chunk = src_fh.read(_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if hasher is not None:
+                    hasher.update(chunk)
+                dst_fh.write(chunk)
+                scheduler.throttle(len(chunk))
+            _finish_copy(src_stat, dst_fh, read_only)
+    _set_times(src_stat, dst_path)
+
+
+def _is_sparse(src_stat):
+    """Does the file occupy fewer blocks than its size requires?"""
+    blocks = getattr(src_stat, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < src_stat.st_size
+
+
+def _data_extents(fd, size):
+    """Yield the ``(start, end)`` of each region of the file which may hold data.
+
+    Uses ``SEEK_DATA`` and ``SEEK_HOLE`` where supported; otherwise the whole
+    file is one region.
+
+    """
+
+    if _SEEK_DATA is None:
+        yield 0, size
+        return
+
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, _SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole from here to the end.
+                return
+            if pos == 0 and e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield 0, size
+                return
+            raise
+        end = min(size, os.lseek(fd, start, _SEEK_HOLE))
+        yield start, end
+        pos = end
+
+
+def _update_zeros(hasher, size):
+    zeros = '\0' * min(size, _STREAM_CHUNK_SIZE)
+    while size > 0:
+        hasher.update(zeros[:size])
+        size -= len(zeros)
+
+
+def _sparse_copy(src_path, dst_path, read_only=False, hasher=None):
+    """Copy only the data of a file, leaving holes where it has them.
+
+    Holes are found via :func:`_data_extents`, and blocks (of the source's
+    ``st_blksize``) of zeros within the data are left as holes too.
+
+    """
+
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        size = src_stat.st_size
+        block_size = getattr(src_stat, 'st_blksize', 0) or _DEFAULT_BLOCK_SIZE
+        zeros = '\0' * block_size
+
+        with open(dst_path, 'wb') as dst_fh:
+            hashed = 0
+            for start, end in _data_extents(src_fd, size):
+
+                if hasher is not None and start > hashed:
+                    _update_zeros(hasher, start - hashed)
+
+                os.lseek(src_fd, start, os.SEEK_SET)
+                pos = start
+                while pos < end:
+                    chunk = os.read(src_fd, min(_STREAM_CHUNK_SIZE, end - pos))
+                    if not chunk:
+                        break
+                    if hasher is not None:
+                        hasher.update(chunk)
+
+                    # Write each run of blocks with data at once; the final
+                    # (empty) block past the end flushes the last run.
+                    run_start = None
+                    for offset in xrange(0, len(chunk) + block_size, block_size):
+                        block = chunk[offset:offset + block_size]
+                        if block and block != zeros[:len(block)]:
+                            if run_start is None:
+                                run_start = offset
+                            continue
+                        if run_start is not None:
+                            run_end = min(offset, len(chunk))
+                            dst_fh.seek(pos + run_start)
+                            dst_fh.write(chunk[run_start:run_end])
+                            scheduler.throttle(run_end - run_start)
+                            run_start = None
+
+                    pos += len(chunk)
+                hashed = pos
+
+            if hasher is not None and size > hashed:
+                _update_zeros(hasher, size - hashed)
+
+            dst_fh.truncate(size)
+            _finish_copy(src_stat, dst_fh, read_only)
+
+    finally:
+        os.close(src_fd)
+    _set_times(src_stat, dst_path)
+
+
+def copy_symlink(src_path, dst_path):
+    """Recreate a symlink with the same (possibly relative) target."""
+    target = os.readlink(src_path)
+    try:
+        os.symlink(target, dst_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        # From an earlier attempt.
+        os.unlink(dst_path)
+        os.symlink(target, dst_path)
+
+
+def _reflink(src_path, dst_path, read_only=False):
+    with open(src_path, 'rb') as src_fh:
+        src_stat = os.fstat(src_fh.fileno())
+        with open(dst_path, 'wb') as dst_fh:
+            try:
+                fcntl.ioctl(dst_fh.fileno(), _FICLONE, src_fh.fileno())
+            except IOError as e:
+                dst_fh.close()
+                os.unlink(dst_path)
+                raise OSError(e.errno, e.strerror)
+            _finish_copy(src_stat, dst_fh, read_only)
+    _set_times(src_stat, dst_path)
+
+
+def _kernel_copy(src_path, dst_path, read_only=False):
+    """Copy within the kernel via ``copy_file_range`` or ``sendfile``.
+
+    Raises ``OSError(ENOSYS)`` if neither is provided by this Python.
+
+    """
+
+    copy_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if not (copy_range or sendfile):
+        raise OSError(errno.ENOSYS, 'no in-kernel copy available')
+
+    with open(src_path, 'rb') as src_fh:
+        src_stat = os.fstat(src_fh.fileno())
+        with open(dst_path, 'wb') as dst_fh:
+            src_fd = src_fh.fileno()
+            dst_fd = dst_fh.fileno()
+            remaining = src_stat.st_size
+            offset = 0
+            # Smaller pieces when throttled, so that others may interleave.
+            max_count = _THROTTLED_CHUNK_SIZE if scheduler.service.active else 1 << 30
+            try:
+                while remaining > 0:
+                    count = min(remaining, max_count)
+                    if copy_range:
+                        done = copy_range(src_fd, dst_fd, count)
+                    else:
+                        done = sendfile(dst_fd, src_fd, offset, count)
+                    if not done:
+                        break
+                    offset += done
+                    remaining -= done
+                    scheduler.throttle(done)
+            except OSError:
+                dst_fh.close()
+                os.unlink(dst_path)
+                raise
+            _finish_copy(src_stat, dst_fh, read_only)
+    _set_times(src_stat, dst_path)
+
+
+def _read_progress(progress_path, header):
+    """The chunk digests of a previous attempt, if it matches ``header``."""
+    try:
+        fh = open(progress_path)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    with fh:
+        try:
+            if json.loads(fh.readline()) != header:
+                return []
+        except ValueError:
+            return []
+        # A partially written last line is not a digest of the right length.
+        digests = [line.strip() for line in fh]
+    length = len(utils.new_hasher(_CHUNK_ALGORITHM).hexdigest())
+    return list(itertools.takewhile(lambda digest: len(digest) == length, digests))
+
+
+def _write_progress(progress_path, header, digests):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        fh.write(json.dumps(header) + '\n')
+        for digest in digests:
+            fh.write(digest + '\n')
+    os.rename(tmp_path, progress_path)
+
+
+def _hash_chunk(data):
+    hasher = utils.new_hasher(_CHUNK_ALGORITHM)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def chunked_copy(src_path, dst_path, read_only=False, hasher=None, chunk_size=None):
+    """Copy a (large) file in fixed-size chunks, continuing any previous attempt.
+
+    Each chunk is written, flushed to disk, and read back to verify it
+    against the digest of the source chunk. Its digest is then appended to a
+    progress file beside the destination (see :data:`PARTIAL_SUFFIX`), which
+    is removed once the copy is complete.
+
+    If the progress file exists (and describes the same source), the chunks
+    it lists are verified against the destination, and the copy continues
+    from the first which is missing or does not match.
+
+    :param int chunk_size: Defaults to :data:`CHUNK_SIZE`.
+    :return: The number of bytes which were actually copied (i.e. not
+        recovered from a previous attempt).
+
+    """
+
+    chunk_size = chunk_size or CHUNK_SIZE
+    progress_path = dst_path + PARTIAL_SUFFIX
+
+    with open(src_path, 'rb') as src_fh:
+        src_stat = os.fstat(src_fh.fileno())
+        header = {
+            'size': src_stat.st_size,
+            'mtime': src_stat.st_mtime,
+            'chunk_size': chunk_size,
+            'algorithm': _CHUNK_ALGORITHM,
+        }
+
+        digests = _read_progress(progress_path, header) if os.path.exists(dst_path) else []
+        if os.path.exists(dst_path) and not os.access(dst_path, os.W_OK):
+            os.chmod(dst_path, stat.S_IRUSR | stat.S_IWUSR)
+        dst_fh = os.fdopen(os.open(dst_path, os.O_RDWR | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR), 'r+b')
+
+        with dst_fh:
+
+            # Verify what a previous attempt claims to have done.
+            for i, digest in enumerate(digests):
+                data = dst_fh.read(chunk_size)
+                if _hash_chunk(data) != digest:
+                    log.warning('chunk %d of %s does not match; copying from there' % (i, dst_path))
+                    digests = digests[:i]
+                    break
+                if hasher is not None:
+                    hasher.update(data)
+            if digests:
+                log.info('continuing copy of %s from chunk %d' % (dst_path, len(digests)))
+            _write_progress(progress_path, header, digests)
+
+            offset = len(digests) * chunk_size
+            src_fh.seek(offset)
+            copied = 0
+
+            with open(progress_path, 'a') as progress_fh:
+                while True:
+                    data = src_fh.read(chunk_size)
+                    if not data:
+                        break
+                    digest = _hash_chunk(data)
+
+                    dst_fh.seek(offset)
+                    dst_fh.write(data)
+                    dst_fh.flush()
+                    os.fsync(dst_fh.fileno())
+
+                    dst_fh.seek(offset)
+                    if _hash_chunk(dst_fh.read(len(data))) != digest:
+                        raise IOError(errno.EIO, 'chunk at %d did not verify' % offset, dst_path)
+
+                    if hasher is not None:
+                        hasher.update(data)
+                    progress_fh.write(digest + '\n')
+                    scheduler.throttle(len(data))
+                    progress_fh.flush()
+
+                    offset += len(data)
+                    copied += len(data)
+
+            dst_fh.truncate(src_stat.st_size)
+            _finish_copy(src_stat, dst_fh, read_only)
+
+    _set_times(src_stat, dst_path)
+    os.unlink(progress_path)
+    return copied
+
+
+def _special_copy(src_path, dst_path, read_only, hasher, chunked_threshold):
+    """Copy files which must not be streamed naively; sparse or large ones.
+
+    :return: The strategy used, or ``None`` if the file is neither.
+
+    """
+    src_stat = os.stat(src_path)
+    if _is_sparse(src_stat):
+        _sparse_copy(src_path, dst_path, read_only, hasher)
+        return 'sparse'
+    if chunked_threshold and src_stat.st_size >= chunked_threshold:
+        chunked_copy(src_path, dst_path, read_only, hasher)
+        return 'chunked'
+
+
+def _auto(src_path, dst_path, read_only=False, hasher=None, chunked_threshold=None):
+
+    # Cloning would discard the progress of a previous chunked copy.
+    devs = (os.stat(src_path).st_dev, os.stat(os.path.dirname(dst_path)).st_dev)
+    if devs not in _no_reflink and not os.path.exists(dst_path + PARTIAL_SUFFIX):
+        try:
+            _reflink(src_path, dst_path, read_only)
+        except OSError as e:
+            if e.errno not in _unsupported_errnos:
+                raise
+            _no_reflink.add(devs)
+        else:
+            if hasher is not None:
+                utils.update_hasher(hasher, dst_path)
+            return 'reflink'
+
+    strategy = _special_copy(src_path, dst_path, read_only, hasher, chunked_threshold)
+    if strategy:
+        return strategy
+
+    # If we must read the data to hash it, then we may as well copy it while
+    # we do so instead of doing both in the kernel and then reading it again.
+    if hasher is None:
+        try:
+            _kernel_copy(src_path, dst_path, read_only)
+            return 'kernel'
+        except OSError as e:
+            if e.errno not in _unsupported_errnos:
+                raise
+
+    _stream_copy(src_path, dst_path, read_only, hasher)
+    return 'copy'
+
+
+def same_device(src_path, dst_dir):
+    """Is ``src_path`` on the same device as the (existing) ``dst_dir``?
+
+    If so, it may be moved into ``dst_dir`` with an atomic rename.
+
+    """
+    return os.lstat(src_path).st_dev == os.stat(dst_dir).st_dev
+
+
+def _move(src_path, dst_path, read_only, hasher, chunked_threshold):
+    """Rename if on the same device, otherwise copy and then delete."""
+
+    if same_device(src_path, os.path.dirname(dst_path)):
+        try:
+            os.rename(src_path, dst_path)
+            return 'rename'
+        except OSError as e:
+            # e.g. across bind mounts of the same filesystem.
+            if e.errno != errno.EXDEV:
+                raise
+
+    if os.path.islink(src_path):
+        copy_symlink(src_path, dst_path)
+        strategy = 'symlink'
+    else:
+        strategy = _auto(src_path, dst_path, read_only, hasher, chunked_threshold)
+    os.unlink(src_path)
+    return strategy + '+delete'
+
+
+def _place(src_path, dst_path, method, read_only, hasher, chunked_threshold):
+
+    if method == 'copy':
+        strategy = _special_copy(src_path, dst_path, read_only, hasher, chunked_threshold)
+        if strategy:
+            return strategy
+        _stream_copy(src_path, dst_path, read_only, hasher)
+        return 'copy'
+
+    if method == 'auto':
+        return _auto(src_path, dst_path, read_only, hasher, chunked_threshold)
+
+    if method == 'move':
+        strategy = _move(src_path, dst_path, read_only, hasher, chunked_threshold)
+        if strategy != 'rename':
+            # Already given permissions and hashed as it was copied.
+            return strategy
+
+    elif method == 'link':
+        if read_only:
+            # The publish would share its permissions with the source, and
+            # could still be written to through it.
+            log.debug('not hardlinking %s into a read-only publish; falling back to auto' % src_path)
+            return _auto(src_path, dst_path, read_only, hasher, chunked_threshold)
+        try:
+            os.link(src_path, dst_path)
+            strategy = 'link'
+        except OSError as e:
+            if e.errno not in _unsupported_errnos:
+                raise
+            log.debug('could not hardlink %s; falling back to auto' % src_path)
+            return _auto(src_path, dst_path, read_only, hasher, chunked_threshold)
+
+    elif method == 'reflink':
+        try:
+            _reflink(src_path, dst_path, read_only)
+            strategy = 'reflink'
+        except OSError as e:
+            if e.errno not in _unsupported_errnos:
+                raise
+            log.debug('could not reflink %s; falling back to auto' % src_path)
+            return _auto(src_path, dst_path, read_only, hasher, chunked_threshold)
+
+    else:
+        raise RuntimeError('bad copy method %r' % method)
+
+    # Moved, linked, and cloned files didn't pass through our hands.
+    if read_only and strategy != 'reflink':
+        permissions.set_file(dst_path)
+    if hasher is not None:
+        utils.update_hasher(hasher, dst_path)
+    return strategy
+
+
+def copy_file(src_path, dst_path, method='copy', read_only=False, hasher=None,
+    chunked_threshold=None
+):
+    """Copy (or move) a single file into place.
+
+    The destination directory must already exist. Modification times are
+    preserved by every method so that later publishes may detect unchanged
+    files (see :class:`Copier`'s ``delta_from``). Methods are:
+
+    - ``"copy"``: a plain copy of the data, permission bits, and times.
+    - ``"move"``: rename the file if it is on the same device as the
+      destination (see :func:`same_device`), otherwise copy it as ``"auto"``
+      would and then delete the source. The strategy is ``"rename"``, or that
+      of the copy with ``"+delete"`` appended (e.g. ``"kernel+delete"``).
+    - ``"link"``: hardlink the file if it is on the same device, otherwise
+      falling back to ``"auto"``. Since the file would share its inode (and
+      so its permissions) with the source, ``read_only`` files are never
+      linked, and also fall back to ``"auto"``.
+    - ``"reflink"``: clone the file (via ``FICLONE``) on filesystems which
+      support copy-on-write, otherwise falling back to ``"auto"``.
+    - ``"auto"``: the cheapest way to get an independent copy; a reflink,
+      then an in-kernel ``copy_file_range``/``sendfile``, then a plain copy.
+
+    Files which would be copied through Python (or the kernel) are copied
+    such that their holes are preserved if they are sparse, or else by
+    :func:`chunked_copy` if they are at least ``chunked_threshold`` bytes (so
+    that a failed copy may be retried without starting from scratch).
+
+    :param bool read_only: Give the file its final published permissions
+        (see :mod:`sgpublish.permissions`) as it is written.
+    :param hasher: A :mod:`hashlib`-like object to feed the file's contents
+        to. Data which is streamed through Python is hashed as it is copied,
+        and files placed by other means are read once they are in place.
+    :param int chunked_threshold: ``None`` or ``0`` (the default) disables
+        chunked copies, which only pay off if the copy may be retried into
+        the same place (e.g. by a journaled publish; see :data:`CHUNKED_THRESHOLD`).
+    :return: ``(strategy, size)``; the strategy actually used, and the number
+        of bytes placed.
+
+    """
+    size = os.path.getsize(src_path)
+    return _place(src_path, dst_path, method, read_only, hasher, chunked_threshold), size
+
+
+def is_unchanged(src_path, ref_path, use_hash=False):
+    """Is ``ref_path`` a faithful copy of ``src_path``?
+
+    Sizes must match, and then either the modification times or (if
+    ``use_hash``) the digests of the contents.
+
+    """
+    try:
+        ref_stat = os.stat(ref_path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    src_stat = os.stat(src_path)
+    if src_stat.st_size != ref_stat.st_size:
+        return False
+    if use_hash:
+        return utils.hash_file(src_path) == utils.hash_file(ref_path)
+    return int(src_stat.st_mtime) == int(ref_stat.st_mtime)
+
+
+class CopyStats(object):
+
+    """Aggregate results of a :class:`Copier` run."""
+
+    def __init__(self, files=0, bytes=0, elapsed=0.0):
+        self.files = files
+        self.bytes = bytes
+        self.elapsed = elapsed
+        self.strategies = collections.Counter()
+
+    @property
+    def throughput(self):
+        """Bytes per second, or ``None`` if nothing was timed."""
+        return self.bytes / self.elapsed if self.elapsed else None
+
+    def __repr__(self):
+        return '<CopyStats files=%d bytes=%d elapsed=%.3f>' % (self.files, self.bytes, self.elapsed)
+
+    def __str__(self):
+        throughput = self.throughput
+        return '%d files, %.1f MB in %.2fs (%s)' % (
+            self.files,
+            self.bytes / 1048576.0,
+            self.elapsed,
+            '%.1f MB/s' % (throughput / 1048576.0) if throughput is not None else 'n/a',
+        )
+
+
+class Copier(object):
+
+    """Copies many files into place with bounded concurrency.
+
+    :param int max_workers: The maximum number of batches to run at once on
+        the shared ``"io"`` pool (see :mod:`sgpublish.executor`); defaults to
+        the size of that pool.
+    :param int batch_size: The maximum number of files in one pool task.
+    :param blob_store: If provided, files (except those being moved) are
+        placed via :meth:`BlobStore.link() <sgpublish.blobstore.BlobStore.link>`,
+        and their digests collected in :attr:`digests`.
+    :type blob_store: :class:`~sgpublish.blobstore.BlobStore` or None
+    :param str delta_from: A previous publish to compare against; files which
+        are unchanged (see :func:`is_unchanged`) since they were placed at the
+        same relative path in it are hardlinked from there instead of copied.
+        Their destinations are collected in :attr:`reused`.
+    :param str delta_root: What destination paths are relative to when
+        looking for them in ``delta_from``.
+    :param bool delta_hash: Compare file contents instead of modification times.
+    :param bool read_only: Give files their published permissions as they are
+        placed, and directories created by the copier theirs once the run is
+        complete; see :mod:`sgpublish.permissions`.
+    :param str checksum: An algorithm (see :func:`sgpublish.utils.new_hasher`)
+        to checksum files with while they are copied. ``(size, mtime, digest)``
+        of each is collected in :attr:`checksums`.
+    :param int chunked_threshold: Passed to :func:`copy_file`.
+    :param callback: Called (from the thread of :meth:`run`) with a list of
+        ``(dst_path, strategy, size, blob_digest, checksum)`` as each batch of
+        files is completely placed, e.g. to journal progress.
+    :param str priority: The :mod:`~sgpublish.scheduler` priority of the
+        copies; defaults to that of the thread which creates the copier.
+
+    ::
+
+        >>> copier = Copier(max_workers=4)
+        >>> copier.add('/path/to/src.abc', '/path/to/publish/src.abc')
+        >>> stats = copier.run()
+
+    If any copy fails then all queued (but not yet started) work is cancelled,
+    and the first exception is re-raised once the running work completes. The
+    caller is responsible for cleaning up any partial results.
+
+    """
+
+    def __init__(self, max_workers=None, batch_size=None, blob_store=None,
+        delta_from=None, delta_root=None, delta_hash=False, read_only=False,
+        checksum=None, chunked_threshold=None, callback=None, priority=None
+    ):
+        self.max_workers = max_workers or executor.max_workers('io')
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.blob_store = blob_store
+        self.delta_from = delta_from
+        self.delta_root = delta_root
+        self.delta_hash = delta_hash
+        self.read_only = read_only
+        self.checksum = checksum
+        self.chunked_threshold = chunked_threshold
+        self.callback = callback
+        self.priority = priority or scheduler.service.current_priority()
+        if delta_from and not delta_root:
+            raise ValueError('delta_from requires delta_root')
+        self._jobs = collections.OrderedDict()
+        self._trees = []
+        self._streams = []
+        self._moved_dirs = []
+        self.stats = None
+        self.digests = {}
+        self.reused = []
+        self.created_dirs = []
+        self.checksums = {}
+
+    def __len__(self):
+        """The number of queued files, not counting those within trees."""
+        return sum(len(jobs) for jobs in self._jobs.itervalues())
+
+    def add(self, src_path, dst_path, method='copy'):
+        """Queue a copy of ``src_path`` to ``dst_path``."""
+        dst_dir = os.path.dirname(dst_path)
+        self._jobs.setdefault(dst_dir, []).append((src_path, dst_path, method))
+
+    def add_many(self, entries):
+        """Queue ``(src_path, dst_path, method)`` from an iterable.
+
+        The iterable is only consumed as the copy runs, so a generator (e.g.
+        over a :class:`~sgpublish.pending.PendingFiles` on disk) need never
+        be held in memory all at once. Its files are not counted by ``len()``.
+
+        """
+        self._streams.append(entries)
+
+    def add_tree(self, src_dir, dst_dir, method='copy', exclude=()):
+        """Queue a copy of everything within ``src_dir`` to ``dst_dir``.
+
+        The relative structure is preserved, including empty directories.
+        Symlinks are recreated with the same targets, and sparse files keep
+        their holes (when copied).
+
+        A tree which is moved onto the same device is renamed as a whole
+        (reported as a single ``"rename"`` of ``dst_dir``); otherwise each
+        file is moved individually, and the emptied source directories are
+        removed once the run is complete.
+
+        :param exclude: Destination paths to skip (e.g. those already done).
+
+        """
+        self._trees.append((src_dir, dst_dir, method, exclude))
+
+    def _rename_tree(self, src_dir, dst_dir, method, exclude):
+        """Move a whole tree with one rename, if possible.
+
+        :return: The results of the rename, or ``None`` if it must be walked.
+
+        """
+
+        # A partial tree (e.g. from an interrupted publish) must be merged.
+        if method != 'move' or exclude or os.path.lexists(dst_dir):
+            return
+
+        parent = os.path.dirname(dst_dir)
+        self._makedirs(parent)
+        if not same_device(src_dir, parent):
+            log.debug('%s is on another device; moving file by file' % src_dir)
+            return
+
+        try:
+            os.rename(src_dir, dst_dir)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            return
+
+        if self.read_only:
+            permissions.fix_tree(dst_dir)
+        return [(dst_dir, 'rename', 0, None, None)]
+
+    def _iter_tree(self, src_dir, dst_dir, method, exclude):
+        batch = []
+        for src_path, kind in walker.walk(src_dir, self.max_workers):
+            dst_path = os.path.join(dst_dir, os.path.relpath(src_path, src_dir)) if src_path != src_dir else dst_dir
+            if kind == 'dir':
+                # Walked before anything within it.
+                self._makedirs(dst_path)
+                if method == 'move':
+                    self._moved_dirs.append(src_path)
+            elif dst_path not in exclude:
+                batch.append((src_path, dst_path, 'symlink' if kind == 'link' else method))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _iter_stream(self, entries):
+        batch = []
+        last_dir = None
+        for src_path, dst_path, method in entries:
+            dst_dir = os.path.dirname(dst_path)
+            if dst_dir != last_dir:
+                self._makedirs(dst_dir)
+                last_dir = dst_dir
+            batch.append((src_path, dst_path, method))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _iter_batches(self):
+        for jobs in self._jobs.itervalues():
+            for i in xrange(0, len(jobs), self.batch_size):
+                yield jobs[i:i + self.batch_size]
+        for entries in self._streams:
+            for batch in self._iter_stream(entries):
+                yield batch
+        for tree in self._trees:
+            for batch in self._iter_tree(*tree):
+                yield batch
+
+    def _reuse(self, src_path, dst_path):
+        ref_path = os.path.join(self.delta_from, os.path.relpath(dst_path, self.delta_root))
+        if not is_unchanged(src_path, ref_path, self.delta_hash):
+            return False
+        try:
+            os.link(ref_path, dst_path)
+        except OSError as e:
+            if e.errno not in _unsupported_errnos and e.errno != errno.EMLINK:
+                raise
+            return False
+        return True
+
+    def _copy_one(self, src_path, dst_path, method):
+
+        if method == 'symlink':
+            copy_symlink(src_path, dst_path)
+            return 'symlink', 0, None, None
+
+        hasher = utils.new_hasher(self.checksum) if self.checksum else None
+        blob_digest = None
+
+        if self.delta_from and method != 'move' and self._reuse(src_path, dst_path):
+            strategy = 'reuse'
+            size = os.path.getsize(dst_path)
+            if self.read_only:
+                permissions.set_file(dst_path)
+            if hasher is not None:
+                utils.update_hasher(hasher, dst_path)
+
+        elif self.blob_store is not None and method != 'move':
+            strategy = 'blob'
+            blob_digest, size = self.blob_store.link(src_path, dst_path)
+            if self.read_only:
+                permissions.set_file(dst_path)
+            if hasher is not None and self.checksum != self.blob_store.algorithm:
+                utils.update_hasher(hasher, dst_path)
+
+        else:
+            strategy, size = copy_file(src_path, dst_path, method, self.read_only, hasher, self.chunked_threshold)
+
+        if hasher is None:
+            checksum = None
+        else:
+            if strategy == 'blob' and self.checksum == self.blob_store.algorithm:
+                digest = blob_digest
+            else:
+                digest = hasher.hexdigest()
+            checksum = (size, os.stat(dst_path).st_mtime, digest)
+
+        return strategy, size, blob_digest, checksum
+
+    def _makedirs(self, path):
+        if os.path.isdir(path):
+            return
+        self._makedirs(os.path.dirname(path))
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            self.created_dirs.append(path)
+
+    def _run_batch(self, jobs):
+        results = []
+        with scheduler.priority(self.priority):
+            for src_path, dst_path, method in jobs:
+                results.append((dst_path, ) + self._copy_one(src_path, dst_path, method))
+        return results
+
+    def _record(self, stats, results):
+        for dst_path, strategy, size, digest, checksum in results:
+            stats.files += 1
+            stats.bytes += size
+            stats.strategies[strategy] += 1
+            if digest is not None:
+                self.digests[dst_path] = digest
+            if checksum is not None:
+                self.checksums[dst_path] = checksum
+            if strategy == 'reuse':
+                self.reused.append(dst_path)
+        if self.callback is not None:
+            self.callback(results)
+
+    def run(self):
+        """Copy all queued files, blocking until they are done.
+
+        :return: The :class:`CopyStats` for the run, also stored as :attr:`stats`.
+
+        """
+
+        start_time = time.time()
+        stats = CopyStats()
+
+        # Create every destination directory up front, once, so that the
+        # workers only have to deal with files.
+        for dst_dir in sorted(self._jobs):
+            self._makedirs(dst_dir)
+
+        # Trees which can be moved with a single rename don't need walking.
+        for tree in list(self._trees):
+            results = self._rename_tree(*tree)
+            if results is not None:
+                self._trees.remove(tree)
+                self._record(stats, results)
+
+        # Keep at most max_workers batches on the shared pool at once, so
+        # that other work may interleave with a large copy.
+        batches = self._iter_batches()
+        in_flight = set()
+        try:
+            while True:
+                while len(in_flight) < self.max_workers:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    in_flight.add(executor.submit('io', self._run_batch, batch))
+                if not in_flight:
+                    break
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    self._record(stats, future.result())
+        except:
+            for future in in_flight:
+                future.cancel()
+            concurrent.futures.wait(in_flight)
+            raise
+
+        self._jobs.clear()
+        del self._trees[:]
+        del self._streams[:]
+
+        # Clean up after trees which were moved file by file; anything which
+        # was skipped (e.g. sockets) is left behind.
+        for path in reversed(self._moved_dirs):
+            try:
+                os.rmdir(path)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    raise
+                log.warning('could not remove %s after moving it: %s' % (path, e))
+        del self._moved_dirs[:]
+
+        # Directories are only locked once everything is in them.
+        if self.read_only:
+            for path in reversed(self.created_dirs):
+                os.chmod(path, permissions.DIRECTORY_MODE)
+
+        stats.elapsed = time.time() - start_time
+        self.stats = stats
+        return stats
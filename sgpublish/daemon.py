@@ -0,0 +1,493 @@
+"""A long-running process which publishes on behalf of others.
+
+Every process which publishes pays for its own Shotgun connection and its
+own SGFS caches. A :class:`PublishDaemon` instead accepts publish jobs over a
+local socket, and runs them on the shared ``"publish"`` pool (see
+:mod:`sgpublish.executor`) with a single, warm, SGFS::
+
+    $ sgpublish-daemon --address /tmp/sgpublish.sock
+
+    >>> client = DaemonClient('/tmp/sgpublish.sock')
+    >>> job_id = client.submit(link={'type': 'Task', 'id': 1234},
+    ...     type='maya_scene', name='model', files=['/path/to/scene.ma'])
+    >>> client.wait(job_id)['state']
+    'done'
+
+The daemon listens on a Unix socket which only its own user may connect to
+(which is checked again for each connection where the platform allows), since
+it publishes as that user. Files are read by the daemon, and so must be
+readable by its user.
+
+The protocol is one JSON object per line in each direction. Every request
+has an ``"op"``; every response has ``"ok"``, and either the result or an
+``"error"``:
+
+``{"op": "ping"}``
+    ``{"ok": true, "pid": 1234, "pools": {...}, "io": {...}, "stubs": {...}}``,
+    with the pools as given by :func:`sgpublish.executor.status`, the
+    bandwidth limits and queue by :func:`sgpublish.scheduler.status`, and the
+    PublishEvent stub pool by :meth:`sgpublish.stubs.StubPool.status`.
+
+``{"op": "submit", "job": {...}}``
+    ``{"ok": true, "job_id": 1}``. A job has ``link``, ``type``, ``name``,
+    ``files`` (paths, or ``[src_path, dst_name]`` pairs, where ``dst_name``
+    is relative to the publish), and optionally ``relative_to``,
+    ``metadata``, and any of :data:`JOB_KWARGS`. The daemon always picks
+    the publish's directory.
+
+``{"op": "status", "job_id": 1}``
+    ``{"ok": true, "job": {"state": "running", ...}}``; see :meth:`Job.status`.
+
+``{"op": "wait", "job_id": 1, "timeout": 60}``
+    As ``status``, once the job is finished (or the timeout expires).
+
+``{"op": "list"}``
+    ``{"ok": true, "jobs": [...]}``
+
+``{"op": "shutdown"}``
+    Stops accepting requests once running jobs are finished.
+
+"""
+
+import collections
+import errno
+import itertools
+import json
+import logging
+import os
+import socket
+import SocketServer
+import stat
+import struct
+import sys
+import threading
+import time
+import traceback
+
+from sgfs import SGFS
+
+from . import executor
+from . import scheduler
+from . import stubs
+from .batch import add_files_from_spec
+from .journal import decode
+from .publisher import Publisher
+
+
+log = logging.getLogger(__name__)
+
+
+def _default_address():
+    # Home directories are often shared between hosts, but each host needs
+    # its own daemon, so prefer the (local, private) runtime directory.
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'sgpublish-daemon.sock')
+    return os.path.expanduser('~/.sgpublish-daemon.%s.sock' % socket.gethostname())
+
+
+#: Where the daemon listens by default; ``$SGPUBLISH_DAEMON``, else
+#: ``$XDG_RUNTIME_DIR/sgpublish-daemon.sock``, else
+#: ``~/.sgpublish-daemon.<hostname>.sock``.
+DEFAULT_ADDRESS = os.environ.get('SGPUBLISH_DAEMON') or _default_address()
+
+#: Publisher arguments which jobs may provide.
+JOB_KWARGS = frozenset((
+    'link', 'type', 'name', 'version', 'parent', 'template',
+    'created_by', 'description', 'frames_path', 'movie_path', 'movie_url',
+    'path', 'source_publish', 'source_publishes', 'thumbnail_path',
+    'trigger_event', 'extra_fields', 'review_version_fields',
+    'blob_store', 'delta', 'checksum', 'journal', 'chunked_threshold',
+    'thumbnail_max_size', 'copy_workers', 'fix_permissions', 'io_priority',
+    'metadata_threshold',
+))
+
+# Job keys which are entities, and so are merged into the session.
+_entity_kwargs = ('link', 'template', 'parent', 'created_by', 'source_publish', 'trigger_event')
+
+# Keys of jobs which are not passed to the Publisher.
+_job_extras = frozenset(('files', 'relative_to', 'metadata'))
+
+# Python 2 doesn't expose this, though Linux has it.
+_SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17 if sys.platform.startswith('linux') else None)
+
+#: How many finished jobs are remembered for ``status``.
+MAX_FINISHED = 1000
+
+
+class DaemonError(Exception):
+    """Raised by the :class:`DaemonClient` when a request fails, or by the
+    :class:`PublishDaemon` when another is already listening."""
+
+
+def _check_files(files):
+    """Only paths, or ``[src_path, dst_name]`` pairs within the publish."""
+    if not isinstance(files, (list, tuple)):
+        raise ValueError('files must be a list')
+    for file_ in files:
+        if isinstance(file_, basestring):
+            continue
+        if not (isinstance(file_, (list, tuple)) and len(file_) == 2 and all(isinstance(x, basestring) for x in file_)):
+            raise ValueError('files must be paths or [src_path, dst_name] pairs: %r' % (file_, ))
+        dst_name = os.path.normpath(file_[1])
+        if os.path.isabs(dst_name) or dst_name == '..' or dst_name.startswith('../'):
+            raise ValueError('dst_name must be within the publish: %r' % file_[1])
+
+
+class Job(object):
+
+    """One publish requested of the daemon."""
+
+    def __init__(self, id_, spec):
+        self.id = id_
+        self.spec = spec
+        self.state = 'queued'
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.progress = None
+        self.publisher = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def status(self):
+        """A JSON-able summary of the job.
+
+        Has the ``id``, ``state`` (one of ``"queued"``, ``"running"``,
+        ``"done"``, or ``"failed"``), and ``progress`` as last reported by
+        the commit; then ``publish``, ``version``, and ``directory`` once they
+        are known, and ``error`` if it failed.
+
+        """
+        status = {
+            'id': self.id,
+            'state': self.state,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+            'progress': self.progress,
+        }
+        publisher = self.publisher
+        if publisher is not None:
+            status['publish'] = publisher.entity.minimal if publisher.entity.get('id') else None
+            status['version'] = publisher.version
+            status['directory'] = publisher.directory
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+    def _progress(self, stage, done, total):
+        self.progress = [stage, done, total]
+
+    def run(self, sgfs):
+
+        self.state = 'running'
+        try:
+
+            spec = decode(self.spec)
+            extras = dict((key, spec.pop(key, None)) for key in _job_extras)
+            for key in _entity_kwargs:
+                if isinstance(spec.get(key), dict):
+                    spec[key] = sgfs.session.merge(spec[key])
+            if spec.get('source_publishes'):
+                spec['source_publishes'] = [sgfs.session.merge(x) for x in spec['source_publishes']]
+            # Jobs only place files via add_file, which sets their permissions.
+            spec.setdefault('fix_permissions', False)
+            self.publisher = publisher = Publisher(sgfs=sgfs, **spec)
+
+            try:
+                add_files_from_spec(publisher,
+                    files=extras['files'] or (),
+                    relative_to=extras['relative_to'],
+                    metadata=extras['metadata'],
+                )
+            except:
+                publisher.rollback()
+                raise
+
+            publisher.commit(progress_callback=self._progress)
+
+        except Exception as e:
+            log.exception('publish job %d failed' % self.id)
+            self.state = 'failed'
+            self.error = {
+                'type': e.__class__.__name__,
+                'message': str(e),
+                'traceback': traceback.format_exc(),
+            }
+
+        else:
+            self.state = 'done'
+
+        finally:
+            self.finished_at = time.time()
+            self.finished.set()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request must be an object')
+                response = self.server.daemon.handle_request(request)
+                response['ok'] = True
+            except Exception as e:
+                if not isinstance(e, (ValueError, KeyError)):
+                    log.exception('error handling request')
+                response = {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def server_bind(self):
+        # So that nobody else may connect between the bind and the chmod.
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0600)
+
+    def verify_request(self, request, client_address):
+        # Where the platform tells us who is connecting, it must be us.
+        if _SO_PEERCRED is None:
+            return True
+        creds = request.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        if uid != os.getuid():
+            log.warning('refused connection from uid %d (pid %d)' % (uid, pid))
+            return False
+        return True
+
+
+class PublishDaemon(object):
+
+    """Accepts publish jobs over a local socket.
+
+    :param str address: The path of the Unix socket; defaults to
+        :data:`DEFAULT_ADDRESS`.
+    :param sgfs: The SGFS used by every job; one is constructed if not given.
+
+    """
+
+    def __init__(self, address=None, sgfs=None):
+
+        self.sgfs = sgfs or SGFS()
+        self._jobs = collections.OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+
+        address = address or DEFAULT_ADDRESS
+        self._remove_stale_socket(address)
+        self.server = _UnixServer(address, _Handler)
+        self.server.daemon = self
+        self.address = self.server.server_address
+        self._inode = os.lstat(self.address).st_ino
+
+        self._thread = None
+
+    def _remove_stale_socket(self, path):
+        """Remove the socket of a daemon which is no longer running.
+
+        :raises DaemonError: If the path isn't a socket, or if a daemon is
+            still listening on it.
+
+        """
+
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if not stat.S_ISSOCK(st.st_mode):
+            raise DaemonError('%s exists and is not a socket' % path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+        else:
+            raise DaemonError('daemon already running at %s' % path)
+        finally:
+            sock.close()
+
+        log.info('removing stale socket %s' % path)
+        os.unlink(path)
+
+    def submit(self, spec):
+        """Queue a publish job; see the module documentation for the spec.
+
+        :return: The :class:`Job`.
+
+        """
+
+        if not isinstance(spec, dict):
+            raise ValueError('job must be an object')
+        unknown = set(spec) - JOB_KWARGS - _job_extras
+        if unknown:
+            raise ValueError('unknown job keys: %s' % ', '.join(sorted(unknown)))
+        for key in ('link', 'type', 'name'):
+            if not spec.get(key) and not spec.get('template'):
+                raise ValueError('job requires %s' % key)
+        if spec.get('files') is not None:
+            _check_files(spec['files'])
+
+        job = Job(next(self._job_ids), spec)
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        executor.submit('publish', job.run, self.sgfs)
+        log.info('queued publish job %d' % job.id)
+        return job
+
+    def _forget_finished(self):
+        finished = [job.id for job in self._jobs.itervalues() if job.finished.is_set()]
+        for id_ in finished[:max(0, len(finished) - MAX_FINISHED)]:
+            del self._jobs[id_]
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError('no job %r' % job_id)
+        return job
+
+    def handle_request(self, request):
+        """Dispatch one request of the protocol; returns the response."""
+
+        op = request.get('op')
+
+        if op == 'ping':
+            return {
+                'pid': os.getpid(),
+                'pools': executor.status(),
+                'io': scheduler.status(),
+                'stubs': stubs.pool.status(),
+            }
+
+        if op == 'submit':
+            return {'job_id': self.submit(request.get('job')).id}
+
+        if op == 'status':
+            return {'job': self.get_job(request.get('job_id')).status()}
+
+        if op == 'wait':
+            job = self.get_job(request.get('job_id'))
+            job.finished.wait(request.get('timeout'))
+            return {'job': job.status()}
+
+        if op == 'list':
+            with self._jobs_lock:
+                jobs = list(self._jobs.itervalues())
+            return {'jobs': [job.status() for job in jobs]}
+
+        if op == 'shutdown':
+            # Can't shut down from within a request, or we would deadlock.
+            threading.Thread(target=self.shutdown).start()
+            return {}
+
+        raise ValueError('unknown op %r' % op)
+
+    def serve_forever(self):
+        log.info('publish daemon listening on %r' % (self.address, ))
+        self.server.serve_forever()
+
+    def start(self):
+        """Serve from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name='sgpublish-daemon')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self, wait=True):
+        """Stop serving, and (optionally) wait for queued jobs to finish."""
+        self.server.shutdown()
+        # Remove our socket while it still accepts connections, so that a new
+        # daemon can't take its place in between; and only if it is ours.
+        try:
+            if os.lstat(self.address).st_ino == self._inode:
+                os.unlink(self.address)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.server.server_close()
+        if wait:
+            with self._jobs_lock:
+                jobs = list(self._jobs.itervalues())
+            for job in jobs:
+                job.finished.wait()
+
+
+class DaemonClient(object):
+
+    """Talks to a :class:`PublishDaemon`.
+
+    :param str address: As given to the daemon; defaults to :data:`DEFAULT_ADDRESS`.
+    :param float timeout: Socket timeout for each request, in seconds.
+
+    """
+
+    def __init__(self, address=None, timeout=None):
+        self.address = address or DEFAULT_ADDRESS
+        self.timeout = timeout
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        return sock
+
+    def request(self, op, **kwargs):
+        """Send one request, and return the response.
+
+        :raises DaemonError: If the daemon reports an error.
+
+        """
+        kwargs['op'] = op
+        sock = self._connect()
+        try:
+            fh = sock.makefile('rw')
+            fh.write(json.dumps(kwargs) + '\n')
+            fh.flush()
+            line = fh.readline()
+        finally:
+            sock.close()
+        if not line:
+            raise DaemonError('daemon closed the connection')
+        response = json.loads(line)
+        if not response.pop('ok', False):
+            raise DaemonError(response.get('error'))
+        return response
+
+    def ping(self):
+        return self.request('ping')
+
+    def submit(self, **job):
+        """Submit a publish job.
+
+        :return: The job's ID.
+
+        """
+        return self.request('submit', job=job)['job_id']
+
+    def status(self, job_id):
+        return self.request('status', job_id=job_id)['job']
+
+    def wait(self, job_id, timeout=None):
+        """Wait for the job to finish (or the timeout), and return its status."""
+        return self.request('wait', job_id=job_id, timeout=timeout)['job']
+
+    def list(self):
+        return self.request('list')['jobs']
+
+    def shutdown(self):
+        return self.request('shutdown')
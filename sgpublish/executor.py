@@ -0,0 +1,185 @@
+"""Thread pools shared by everything within sgpublish.
+
+Instead of each :class:`~sgpublish.publisher.Publisher` (and each of its
+commits) creating, and leaking, its own thread pool, work is submitted to one
+of a few named pools which live for the life of the process:
+
+``"shotgun"``
+    Requests to the Shotgun server.
+
+``"io"``
+    Filesystem work, such as copying files into a publish.
+
+``"publish"``
+    Entire publishing stages (e.g. those of the
+    :class:`~sgpublish.asyncpublisher.AsyncPublisher`), which themselves
+    wait on the other pools.
+
+Pools are created on first use, and may be resized or shut down at any time;
+a pool which has been shut down will be recreated when it is next used::
+
+    >>> from sgpublish import executor
+    >>> executor.configure(io=16)
+    >>> future = executor.submit('io', shutil.copy, src_path, dst_path)
+    >>> executor.queue_depth('io')
+    1
+    >>> executor.shutdown()
+
+Work running on a pool should not submit to, and then wait on, the same pool,
+as that may deadlock once the pool is saturated.
+
+"""
+
+import logging
+import threading
+
+import concurrent.futures
+
+
+log = logging.getLogger(__name__)
+
+
+#: The default number of workers for each pool.
+DEFAULT_SIZES = {
+    'shotgun': 8,
+    'io': 8,
+    'publish': 4,
+}
+
+#: The size of pools which are not in :data:`DEFAULT_SIZES`.
+FALLBACK_SIZE = 4
+
+
+class _Pool(object):
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+
+    def _run(self, func, args, kwargs):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def _cancelled(self, future):
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    def submit(self, func, *args, **kwargs):
+        with self.lock:
+            self.queued += 1
+        try:
+            future = self.executor.submit(self._run, func, args, kwargs)
+        except:
+            with self.lock:
+                self.queued -= 1
+            raise
+        future.add_done_callback(self._cancelled)
+        return future
+
+
+class ExecutorService(object):
+
+    """A set of named, lazily created thread pools.
+
+    :param dict sizes: Number of workers for each named pool; defaults to
+        :data:`DEFAULT_SIZES`.
+
+    """
+
+    def __init__(self, sizes=None):
+        self._sizes = dict(DEFAULT_SIZES)
+        self._sizes.update(sizes or {})
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, name):
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                size = self._sizes.get(name, FALLBACK_SIZE)
+                log.debug('starting %r pool with %d workers' % (name, size))
+                pool = self._pools[name] = _Pool(name, size)
+            return pool
+
+    def configure(self, **sizes):
+        """Set the number of workers for the named pools.
+
+        Pools which are already running are replaced; work already submitted
+        to them will still complete.
+
+        """
+        with self._lock:
+            self._sizes.update(sizes)
+            old_pools = [self._pools.pop(name) for name in sizes if name in self._pools]
+        for pool in old_pools:
+            pool.executor.shutdown(wait=False)
+
+    def max_workers(self, name):
+        """The number of workers the named pool has (or would have)."""
+        return self._sizes.get(name, FALLBACK_SIZE)
+
+    def submit(self, name, func, *args, **kwargs):
+        """Schedule ``func(*args, **kwargs)`` on the named pool.
+
+        :return: A :class:`concurrent.futures.Future`.
+
+        """
+        return self._get_pool(name).submit(func, *args, **kwargs)
+
+    def queue_depth(self, name=None):
+        """The number of calls waiting for a worker.
+
+        :param name: A pool, or ``None`` for the total of all pools.
+
+        """
+        with self._lock:
+            pools = self._pools.values() if name is None else [self._pools[name]] if name in self._pools else []
+        return sum(pool.queued for pool in pools)
+
+    def status(self):
+        """A snapshot of every running pool.
+
+        :return: ``{name: {'max_workers': n, 'queued': n, 'running': n}}``.
+
+        """
+        with self._lock:
+            pools = self._pools.values()
+        return dict((pool.name, {
+            'max_workers': pool.max_workers,
+            'queued': pool.queued,
+            'running': pool.running,
+        }) for pool in pools)
+
+    def shutdown(self, wait=True):
+        """Shut down every pool.
+
+        Pools will be started again if anything else is submitted.
+
+        """
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+        for pool in pools:
+            pool.executor.shutdown(wait=wait)
+
+
+#: The process-wide service used by sgpublish.
+service = ExecutorService()
+
+configure = service.configure
+max_workers = service.max_workers
+submit = service.submit
+queue_depth = service.queue_depth
+status = service.status
+shutdown = service.shutdown
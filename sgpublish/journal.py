@@ -0,0 +1,249 @@
+"""A write-ahead journal of a publish's commit, so that it may be resumed.
+
+A :class:`~sgpublish.publisher.Publisher` created with ``journal=True``
+records everything it is about to do when it commits (the Shotgun updates,
+the files to copy, the metadata to tag with) before it does any of it, and
+then records each piece of work as it completes. If the process dies partway
+through, or the commit fails and is rolled back, the directory is left as it
+is and :meth:`Publisher.resume() <sgpublish.publisher.Publisher.resume>` will
+finish only the outstanding work::
+
+    >>> publisher = Publisher.resume(publish_id)
+
+The journal is a file of JSON lines within the publish directory, and is
+removed once the commit has completed. Every record is flushed to disk before
+the work it describes is considered done, so a partial last line (from a
+crash mid-write) is simply ignored.
+
+"""
+
+import errno
+import json
+import logging
+import os
+import stat
+import threading
+
+from .pending import PendingFiles
+
+
+log = logging.getLogger(__name__)
+
+
+#: The name of the journal within the publish directory.
+JOURNAL_NAME = '.sgpublish.journal'
+
+# How many queued files are written in each record.
+_QUEUED_CHUNK_SIZE = 1000
+
+
+def encode(value):
+    """Reduce Shotgun entities to their minimal form, recursively."""
+    minimal = getattr(value, 'minimal', None)
+    if minimal is not None:
+        return minimal
+    if isinstance(value, dict):
+        return dict((k, encode(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    return value
+
+
+def decode(value):
+    """Undo JSON's promotion of every string to unicode, recursively."""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if isinstance(value, dict):
+        return dict((decode(k), decode(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+
+class JournalState(object):
+
+    """What a :class:`Journal` says has been done.
+
+    .. attribute:: commit
+
+        The record written as the commit began (with the updates, metadata,
+        etc.), or ``None`` if the commit never began.
+
+    .. attribute:: queued
+
+        The :class:`~sgpublish.pending.PendingFiles` which the commit was to
+        copy, or ``None`` if they were not recorded separately (by older
+        journals, whose commit record has them as ``files``).
+
+    .. attribute:: copied
+
+        ``{dst_path: (strategy, blob_digest, checksum)}`` of every file which
+        has been completely placed.
+
+    .. attribute:: stages
+
+        ``{name: record}`` of every other stage which has completed.
+
+    """
+
+    def __init__(self):
+        self.commit = None
+        self.queued = None
+        self.copied = {}
+        self.stages = {}
+
+    def apply(self, record):
+        event = record.get('event')
+        if event == 'queued':
+            if self.queued is None:
+                self.queued = PendingFiles()
+            for src_path, dst_path, method in record['files']:
+                self.queued.append(src_path, dst_path, method)
+        elif event == 'commit':
+            self.commit = record
+        elif event == 'copied':
+            for dst_path, strategy, digest, checksum in record['files']:
+                self.copied[dst_path] = (strategy, digest, tuple(checksum) if checksum else None)
+        elif event == 'stage':
+            self.stages[record['stage']] = record
+        elif event == 'rollback':
+            # The second stage on Shotgun was undone.
+            self.stages.pop('updated', None)
+
+
+class Journal(object):
+
+    """An append-only log of a commit, within the publish directory.
+
+    :param str directory: The publish directory.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL_NAME)
+        self._lock = threading.Lock()
+        self._fh = None
+
+    @classmethod
+    def find(cls, path):
+        """Find the journal of the publish which contains the given path.
+
+        :param str path: A path within the publish, e.g. its ``sg_path``.
+        :return: A :class:`Journal`, or ``None``.
+
+        """
+        while path and path != os.path.dirname(path):
+            if os.path.exists(os.path.join(path, JOURNAL_NAME)):
+                return cls(path)
+            path = os.path.dirname(path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _open(self):
+        try:
+            return open(self.path, 'a')
+        except IOError as e:
+            if e.errno != errno.EACCES or not os.path.exists(self.path):
+                raise
+        # The publish's permissions may have already been set.
+        os.chmod(self.path, os.stat(self.path).st_mode | stat.S_IWUSR)
+        return open(self.path, 'a')
+
+    def write(self, event, **data):
+        """Durably append a record."""
+        data['event'] = event
+        self._append(json.dumps(encode(data), default=str) + '\n')
+
+    def _append(self, line, sync=True):
+        with self._lock:
+            if self._fh is None:
+                self._fh = self._open()
+            self._fh.write(line)
+            self._fh.flush()
+            if sync:
+                os.fsync(self._fh.fileno())
+
+    def write_queued(self, files):
+        """Record the files to be copied, a chunk at a time.
+
+        They are durable once the next record (i.e. the ``commit``) is written.
+
+        :param files: ``(src_path, dst_path, method)`` tuples, e.g. a
+            :class:`~sgpublish.pending.PendingFiles`.
+
+        """
+        chunk = []
+        for entry in files:
+            chunk.append(entry)
+            if len(chunk) >= _QUEUED_CHUNK_SIZE:
+                self._append(json.dumps({'event': 'queued', 'files': chunk}) + '\n', sync=False)
+                chunk = []
+        if chunk:
+            self._append(json.dumps({'event': 'queued', 'files': chunk}) + '\n', sync=False)
+
+    def write_stage(self, stage, **data):
+        """Record that a stage of the commit has completed."""
+        self.write('stage', stage=stage, **data)
+
+    def write_copied(self, results):
+        """Record that files have been placed.
+
+        :param results: ``(dst_path, strategy, size, blob_digest, checksum)``
+            tuples, as given to the :class:`~sgpublish.copier.Copier`'s
+            ``callback``.
+
+        """
+        if results:
+            self.write('copied', files=[
+                (dst_path, strategy, digest, checksum)
+                for dst_path, strategy, size, digest, checksum in results
+            ])
+
+    def iter_records(self):
+        """Yield each of the records in the journal, in order."""
+        try:
+            fh = open(self.path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with fh:
+            for line in fh:
+                try:
+                    record = decode(json.loads(line))
+                except ValueError:
+                    # A partial record at the end from an interrupted write.
+                    log.warning('ignoring partial record in %s' % self.path)
+                    return
+                yield record
+
+    def read(self):
+        """All of the records in the journal, in order."""
+        return list(self.iter_records())
+
+    def replay(self):
+        """Reduce the journal to a :class:`JournalState`."""
+        state = JournalState()
+        for record in self.iter_records():
+            state.apply(record)
+        return state
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def remove(self):
+        """Remove the journal once the commit has completed."""
+        self.close()
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,131 @@
+"""Checksum manifests of the contents of a publish.
+
+The manifest is a JSON file at the top of the publish listing the relative
+path, size, modification time, and digest of every file within it. Files
+copied into the publish via the :class:`~sgpublish.copier.Copier` are hashed
+as they are copied, so only files written by other means (e.g. a scene saved
+directly into the publish) need to be read again to complete it.
+
+"""
+
+import json
+import os
+
+from . import utils
+from .journal import JOURNAL_NAME
+
+
+#: The name of the manifest within the publish directory.
+MANIFEST_NAME = '.sgpublish.manifest'
+
+# Files which are not part of the contents of the publish.
+_ignore_names = set((MANIFEST_NAME, JOURNAL_NAME, '.sgfs.yml', '.sgfs-cache.sqlite'))
+
+
+def build(directory, checksums, algorithm='sha256'):
+    """Assemble the entries of a manifest.
+
+    :param str directory: The publish directory.
+    :param dict checksums: Already computed ``{abs_path: (size, mtime, digest)}``,
+        e.g. from :attr:`Copier.checksums <sgpublish.copier.Copier.checksums>`.
+    :param str algorithm: What to hash any other files in the directory with.
+    :return: A sorted list of ``(rel_path, size, mtime, digest)``.
+
+    """
+
+    entries = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        dir_names.sort()
+        for name in file_names:
+            if dir_path == directory and name in _ignore_names:
+                continue
+            path = os.path.join(dir_path, name)
+            if os.path.islink(path):
+                continue
+            rel_path = os.path.relpath(path, directory)
+            try:
+                size, mtime, digest = checksums[path]
+            except KeyError:
+                stat = os.stat(path)
+                size, mtime = stat.st_size, stat.st_mtime
+                digest = utils.hash_file(path, algorithm)
+            entries.append((rel_path, size, mtime, digest))
+
+    entries.sort()
+    return entries
+
+
+def write(directory, entries, algorithm='sha256'):
+    """Write a manifest into the publish.
+
+    :return: A summary of the manifest, suitable for the publish's metadata.
+
+    """
+
+    path = os.path.join(directory, MANIFEST_NAME)
+    encoded = json.dumps({
+        'algorithm': algorithm,
+        'files': entries,
+    }, indent=0, sort_keys=True)
+    # Written aside and renamed into place, since a resumed commit may be
+    # replacing one which has already been made read-only.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(encoded)
+    os.rename(tmp_path, path)
+
+    hasher = utils.new_hasher(algorithm)
+    hasher.update(encoded)
+
+    return {
+        'path': MANIFEST_NAME,
+        'algorithm': algorithm,
+        'digest': hasher.hexdigest(),
+        'files': len(entries),
+        'bytes': sum(entry[1] for entry in entries),
+    }
+
+
+def read(directory):
+    """Read the manifest of the given publish directory.
+
+    :return: ``(algorithm, entries)``, or ``(None, None)`` if there is none.
+
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None, None
+    with open(path, 'rb') as fh:
+        data = json.load(fh)
+    return data['algorithm'], [tuple(entry) for entry in data['files']]
+
+
+def verify(directory, full=False):
+    """Check that the files in a publish match its manifest.
+
+    By default only sizes and modification times are compared; with ``full``
+    the contents of every file are hashed again.
+
+    :return: A sorted list of relative paths which are missing or changed.
+    :raises ValueError: if there is no manifest.
+
+    """
+
+    algorithm, entries = read(directory)
+    if entries is None:
+        raise ValueError('no manifest in %r' % directory)
+
+    changed = []
+    for rel_path, size, mtime, digest in entries:
+        path = os.path.join(directory, rel_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            changed.append(rel_path)
+            continue
+        if stat.st_size != size or int(stat.st_mtime) != int(mtime):
+            changed.append(rel_path)
+        elif full and utils.hash_file(path, algorithm) != digest:
+            changed.append(rel_path)
+
+    return sorted(changed)
@@ -11,6 +11,8 @@ from sgfs.ui.picker import presets as picker_presets
 from sgfs.ui.picker.nodes.base import Node as BaseNode
 from sgfs import SGFS
 
+from sgpublish import metadata
+
 
 class ScenePickerNode(BaseNode):
 
@@ -85,7 +87,7 @@ class Preview(QtGui.QWidget):
         path = sgfs.path_for_entity(entity)
         tags = sgfs.get_directory_entity_tags(path)
         tags = [t for t in tags if t['entity'] is entity]
-        tag = tags[0]
+        tag = metadata.inflate(tags[0], path, missing_ok=True)
 
         maya_data = tag.get('maya', {})
         time_range = '%s - %s' % (maya_data.get('min_time'), maya_data.get('max_time'))
@@ -0,0 +1,171 @@
+"""Keeping large publish metadata out of Shotgun.
+
+A publisher's :attr:`~sgpublish.publisher.Publisher.metadata` is sent to
+Shotgun as the ``sg_metadata`` JSON of the PublishEvent, and saved into the
+tag of the publish directory. Exporters may put a lot in there (e.g. every
+``fileInfo`` of a Maya scene, and every reference), all of which would be
+sent with every update.
+
+Metadata whose JSON is larger than :data:`THRESHOLD` is instead written into
+a gzipped sidecar within the publish (see :data:`SIDECAR_NAME`), and Shotgun
+and the tag are given a summary; the smallest top-level values (and the
+smallest fields of top-level dicts which are too large, e.g. the times of
+``maya`` but not its ``file_info``), and a pointer to the sidecar under
+:data:`POINTER_KEY`. Wherever metadata is read, it should be passed through
+:func:`inflate` (or :func:`load` for a PublishEvent) to get it all back::
+
+    >>> metadata = sgpublish.metadata.load(publish)
+    >>> metadata['maya']['references']
+
+"""
+
+import errno
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+#: The name of the sidecar within the publish directory.
+SIDECAR_NAME = '.sgpublish.metadata.json.gz'
+
+#: Metadata whose JSON is larger than this many bytes goes into the sidecar.
+THRESHOLD = 32 << 10
+
+#: How many bytes of values to keep in the summary (or half the threshold, if smaller).
+SUMMARY_SIZE = 4 << 10
+
+#: The key of the pointer to the sidecar within a summary.
+POINTER_KEY = '__sgpublish_sidecar__'
+
+
+def offload(metadata, directory, threshold=None):
+    """Write large metadata into a sidecar, and summarize it.
+
+    :param dict metadata: The full metadata.
+    :param str directory: The publish directory to write the sidecar into.
+    :param int threshold: Defaults to :data:`THRESHOLD`; ``0`` never offloads.
+    :return: The metadata as it is if it is small enough, otherwise the
+        summary. Its pointer lists the keys which were ``omitted``, and those
+        of which only some fields were kept (``partial``).
+
+    """
+
+    threshold = THRESHOLD if threshold is None else threshold
+    encoded = json.dumps(metadata)
+    if not threshold or len(encoded) <= threshold:
+        return metadata
+
+    # Written aside and renamed into place, since a resumed commit may be
+    # replacing one which has already been made read-only.
+    path = os.path.join(directory, SIDECAR_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as raw_fh:
+        with gzip.GzipFile(SIDECAR_NAME, 'wb', fileobj=raw_fh) as fh:
+            fh.write(encoded)
+    os.rename(tmp_path, path)
+
+    # Keep as many of the smallest values as fit, and then as many of the
+    # smallest fields of those dicts which don't (e.g. the ``min_time`` and
+    # ``max_time`` of ``maya``, but not its ``file_info``).
+    summary = {}
+    omitted = []
+    remaining = min(SUMMARY_SIZE, threshold // 2)
+    partial = []
+    for size, key in _by_size(metadata):
+        if size <= remaining:
+            summary[key] = metadata[key]
+            remaining -= size
+        elif isinstance(metadata[key], dict):
+            partial.append(key)
+        else:
+            omitted.append(key)
+    for key in partial:
+        value = metadata[key]
+        kept = summary[key] = {}
+        for size, name in _by_size(value):
+            if size > remaining:
+                break
+            kept[name] = value[name]
+            remaining -= size
+
+    summary[POINTER_KEY] = {
+        'name': SIDECAR_NAME,
+        'path': path,
+        'size': len(encoded),
+        'sha256': hashlib.sha256(encoded).hexdigest(),
+        'omitted': sorted(omitted),
+        'partial': sorted(partial),
+    }
+    log.debug('offloaded %d bytes of metadata to %s' % (len(encoded), path))
+    return summary
+
+
+def _by_size(data):
+    return sorted((len(json.dumps(value)) + len(json.dumps(key)), key) for key, value in data.iteritems())
+
+
+def is_summary(metadata):
+    """Was this metadata offloaded by :func:`offload`?"""
+    return isinstance(metadata, dict) and POINTER_KEY in metadata
+
+
+def inflate(metadata, directory=None, missing_ok=False):
+    """Get the full metadata from a summary made by :func:`offload`.
+
+    Anything else in the summary (e.g. the ``entity`` of a directory's tag)
+    is kept. Metadata which is not a summary is returned as it is.
+
+    :param str directory: Where to look for the sidecar first, e.g. if the
+        publish has been moved; otherwise the path it was written to is used.
+    :param bool missing_ok: Return the summary (without the pointer) if the
+        sidecar can't be found, instead of raising an :class:`IOError`.
+    :raises ValueError: If the sidecar does not match the summary.
+
+    """
+
+    if not is_summary(metadata):
+        return metadata
+    pointer = metadata[POINTER_KEY]
+
+    full = dict(metadata)
+    del full[POINTER_KEY]
+
+    paths = [pointer['path']]
+    if directory:
+        paths.insert(0, os.path.join(directory, pointer['name']))
+
+    for path in paths:
+        try:
+            with gzip.open(path, 'rb') as fh:
+                encoded = fh.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        if hashlib.sha256(encoded).hexdigest() != pointer['sha256']:
+            raise ValueError('metadata sidecar does not match its summary', path)
+        full.update(json.loads(encoded))
+        return full
+
+    if missing_ok:
+        log.warning('metadata sidecar not found at %s; only the summary is available' % paths[0])
+        return full
+    raise IOError(errno.ENOENT, 'metadata sidecar not found', paths[0])
+
+
+def load(publish, directory=None, missing_ok=False):
+    """The full metadata of a PublishEvent.
+
+    :param publish: The PublishEvent; its ``sg_metadata`` is fetched if needed.
+    :param str directory: Passed to :func:`inflate`, as is ``missing_ok``.
+
+    """
+    raw = publish.fetch('sg_metadata') if hasattr(publish, 'fetch') else publish.get('sg_metadata')
+    if not raw:
+        return {}
+    return inflate(json.loads(raw) if isinstance(raw, basestring) else raw, directory, missing_ok)
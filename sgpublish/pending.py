@@ -0,0 +1,222 @@
+"""The queue of files to be copied into a publish on commit.
+
+Publishes of long image sequences may queue a million files, and the queue
+lives in the (often memory constrained) process which is exporting, e.g.
+Maya. Entries are therefore stored compactly, with the directories they are
+in shared between them, and once there are more than :data:`SPILL_THRESHOLD`
+of them they are moved into a temporary database on disk (if :mod:`sqlite3`
+is available), so that memory use no longer grows with the queue.
+
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+log = logging.getLogger(__name__)
+
+
+#: How many entries are held in memory before they are moved to disk.
+SPILL_THRESHOLD = 100000
+
+# Rows fetched at once when iterating over a spilled queue.
+_FETCH_SIZE = 1000
+
+
+class _Entry(object):
+
+    __slots__ = ('src_dir', 'src_name', 'dst_dir', 'dst_name', 'method')
+
+    def __init__(self, src_dir, src_name, dst_dir, dst_name, method):
+        self.src_dir = src_dir
+        self.src_name = src_name
+        self.dst_dir = dst_dir
+        self.dst_name = dst_name
+        self.method = method
+
+    def as_tuple(self):
+        return (
+            os.path.join(self.src_dir, self.src_name),
+            os.path.join(self.dst_dir, self.dst_name),
+            self.method,
+        )
+
+
+class PendingFiles(object):
+
+    """An ordered queue of ``(src_path, dst_path, method)``, indexed by destination.
+
+    Checking whether a destination is queued is constant time, as is (when
+    amortized) finding a free suffix for a name, so queueing many thousands
+    of files is linear instead of quadratic.
+
+    :param entries: An iterable of ``(src_path, dst_path, method)`` to start with.
+    :param int spill_threshold: Defaults to :data:`SPILL_THRESHOLD`; ``0``
+        keeps everything in memory.
+
+    """
+
+    def __init__(self, entries=(), spill_threshold=None):
+
+        self.spill_threshold = SPILL_THRESHOLD if spill_threshold is None else spill_threshold
+        self._lock = threading.Lock()
+
+        # In memory until spilled.
+        self._entries = []
+        # {dst_dir: set(dst_names)}
+        self._index = {}
+        # So that every entry in a directory shares one copy of its path.
+        self._dirs = {}
+        self._count = 0
+
+        # Once spilled.
+        self._db = None
+
+        # {(base, ext): the highest suffix known to be taken}
+        self._suffixes = {}
+
+        for entry in entries:
+            self.append(*entry)
+
+    @property
+    def spilled(self):
+        """Have the entries been moved to disk?"""
+        return self._db is not None
+
+    def _intern_dir(self, path):
+        return self._dirs.setdefault(path, path)
+
+    def append(self, src_path, dst_path, method):
+        """Queue a file.
+
+        :raises ValueError: If ``dst_path`` is already queued.
+
+        """
+        with self._lock:
+            if self._db is not None:
+                try:
+                    self._db.execute('INSERT INTO files (src, dst, method) VALUES (?, ?, ?)', (src_path, dst_path, method))
+                except sqlite3.IntegrityError:
+                    raise ValueError('already queued', dst_path)
+                self._count += 1
+                return
+
+            dst_dir, dst_name = os.path.split(dst_path)
+            names = self._index.get(dst_dir)
+            if names is None:
+                dst_dir = self._intern_dir(dst_dir)
+                names = self._index[dst_dir] = set()
+            elif dst_name in names:
+                raise ValueError('already queued', dst_path)
+            else:
+                dst_dir = self._intern_dir(dst_dir)
+
+            src_dir, src_name = os.path.split(src_path)
+            self._entries.append(_Entry(self._intern_dir(src_dir), src_name, dst_dir, dst_name, intern(str(method))))
+            names.add(dst_name)
+            self._count += 1
+
+            if self.spill_threshold and self._count > self.spill_threshold and sqlite3 is not None:
+                self._spill()
+
+    def _spill(self):
+
+        log.debug('moving %d queued files to disk' % self._count)
+
+        # An empty name is a private database on disk, which is deleted when
+        # it is closed.
+        db = sqlite3.connect('', check_same_thread=False, isolation_level=None)
+        db.text_factory = str
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute('''CREATE TABLE files (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            src TEXT NOT NULL,
+            dst TEXT NOT NULL UNIQUE,
+            method TEXT NOT NULL
+        )''')
+        db.execute('BEGIN')
+        db.executemany('INSERT INTO files (src, dst, method) VALUES (?, ?, ?)', (
+            entry.as_tuple() for entry in self._entries
+        ))
+        db.execute('COMMIT')
+
+        self._db = db
+        self._entries = []
+        self._index = {}
+        self._dirs = {}
+
+    def close(self):
+        """Discard everything, including anything on disk."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            self._entries = []
+            self._index = {}
+            self._dirs = {}
+            self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        entries = self._entries
+        if self._db is None:
+            # Entries are only ever appended, so this is safe while others append.
+            for i in xrange(len(entries)):
+                yield entries[i].as_tuple()
+            return
+        last_seq = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT seq, src, dst, method FROM files WHERE seq > ? ORDER BY seq LIMIT ?',
+                    (last_seq, _FETCH_SIZE),
+                ).fetchall()
+            if not rows:
+                return
+            for last_seq, src_path, dst_path, method in rows:
+                yield src_path, dst_path, method
+
+    def __contains__(self, dst_path):
+        with self._lock:
+            if self._db is not None:
+                return self._db.execute('SELECT 1 FROM files WHERE dst = ?', (dst_path, )).fetchone() is not None
+            dst_dir, dst_name = os.path.split(dst_path)
+            names = self._index.get(dst_dir)
+            return names is not None and dst_name in names
+
+    def dst_paths(self):
+        for src_path, dst_path, method in self:
+            yield dst_path
+
+    def is_taken(self, dst_path):
+        """Is ``dst_path`` queued, or already on disk?"""
+        return dst_path in self or os.path.exists(dst_path)
+
+    def free_suffix(self, dst_path):
+        """Find a number to append to the name to make it free.
+
+        Suffixes are tried as ``base_1.ext``, ``base_2.ext``, etc., starting
+        after the highest one previously found to be taken, so repeatedly
+        queueing the same name does not probe every earlier suffix again.
+
+        :return: The suffix, or ``0`` if ``dst_path`` itself is free.
+
+        """
+        if not self.is_taken(dst_path):
+            return 0
+        key = os.path.splitext(dst_path)
+        i = self._suffixes.get(key, 0)
+        while True:
+            i += 1
+            if not self.is_taken('%s_%d%s' % (key[0], i, key[1])):
+                return i
+            self._suffixes[key] = i
@@ -0,0 +1,107 @@
+"""Permissions of published files.
+
+Publishes are made read-only to everyone (the equivalent of ``chmod -R a=rX``),
+except for the top-level directory which is left writable by the owner but
+sticky (``chmod a+t,u+w``) so that nobody else may remove anything from it.
+
+These are applied in-process as files are placed by the
+:class:`~sgpublish.copier.Copier`; :func:`fix_tree` is for everything else
+(e.g. files written directly into the publish by an exporter).
+
+"""
+
+import collections
+import logging
+import os
+import stat
+
+from . import executor
+
+
+log = logging.getLogger(__name__)
+
+
+_all_read = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+_all_exec = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+#: The mode of published directories.
+DIRECTORY_MODE = _all_read | _all_exec
+
+#: The mode of the top-level publish directory.
+ROOT_MODE = DIRECTORY_MODE | stat.S_ISVTX | stat.S_IWUSR
+
+
+def publish_mode(mode):
+    """The mode that a file or directory with the given mode should have once
+    it is published; equivalent to ``a=rX``.
+
+    :param int mode: The current ``st_mode`` (including the file type bits).
+
+    """
+    if stat.S_ISDIR(mode) or (mode & _all_exec):
+        return _all_read | _all_exec
+    return _all_read
+
+
+def set_file(path, st_mode=None):
+    """Make a single file (or directory) read-only, if it isn't already.
+
+    :return: True if the mode was changed.
+
+    """
+    if st_mode is None:
+        st_mode = os.lstat(path).st_mode
+    if stat.S_ISLNK(st_mode):
+        return False
+    mode = publish_mode(st_mode)
+    if stat.S_IMODE(st_mode) == mode:
+        return False
+    os.chmod(path, mode)
+    return True
+
+
+def set_root(path):
+    """Set the permissions of the top-level publish directory."""
+    os.chmod(path, ROOT_MODE)
+
+
+def _fix_directory(path):
+
+    changed = 0
+    subdirs = []
+
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        st_mode = os.lstat(child).st_mode
+        if stat.S_ISDIR(st_mode):
+            subdirs.append(child)
+        changed += set_file(child, st_mode)
+
+    return changed, subdirs
+
+
+def fix_tree(root):
+    """Make an existing tree read-only, in parallel.
+
+    Directories are scanned concurrently on the shared ``"io"`` pool, and only
+    entries with the wrong mode are changed; symlinks are not followed. The
+    root itself is given :data:`ROOT_MODE`.
+
+    :return: The number of entries whose mode was changed.
+
+    """
+
+    changed = 0
+    pending = collections.deque([executor.submit('io', _fix_directory, root)])
+    try:
+        while pending:
+            count, subdirs = pending.popleft().result()
+            changed += count
+            pending.extend(executor.submit('io', _fix_directory, path) for path in subdirs)
+    except:
+        for future in pending:
+            future.cancel()
+        raise
+
+    set_root(root)
+    return changed
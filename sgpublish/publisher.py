@@ -1,11 +1,11 @@
 from subprocess import check_call
+import collections
 import datetime
-import itertools
 import json
 import logging
 import os
-import shutil
 import re
+import threading
 
 import concurrent.futures
 
@@ -13,8 +13,21 @@ from sgfs import SGFS
 from sgsession import Session, Entity
 from shotgun_api3.shotgun import Fault as ShotgunFault
 
+from . import executor
+from . import manifest
+from . import metadata
+from . import permissions
+from . import scheduler
+from . import stubs
+from . import thumbnails
+from . import timing
 from . import utils
 from . import versions
+from .blobstore import BlobStore
+from .copier import Copier, copy_file, same_device, CHUNKED_THRESHOLD, METHODS as COPY_METHODS, PARTIAL_SUFFIX
+from .journal import Journal, JournalState
+from .pending import PendingFiles
+from .timing import Timings, timed
 
 
 log = logging.getLogger(__name__)
@@ -32,6 +45,127 @@ _kwarg_to_field = {
 }
 
 
+class StreamHeadCache(object):
+
+    """The latest committed publish of each stream seen by this process.
+
+    When enabled, :class:`Publisher` will allocate versions from here
+    instead of asking Shotgun, and record its own publishes here when they
+    commit. This is only safe when this process is the only one publishing
+    to the streams in question, hence it is disabled by default::
+
+        >>> sgpublish.publisher.stream_heads.enabled = True
+
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._heads = {}
+        self._lock = threading.Lock()
+
+    def _key(self, link, type_, name):
+        return (link['type'], link['id'], str(type_), str(name))
+
+    def get(self, link, type_, name):
+        """The head publish of the given stream, or ``None``."""
+        if not self.enabled:
+            return
+        return self._heads.get(self._key(link, type_, name))
+
+    def update(self, link, type_, name, publish):
+        """Record a publish (with ``sg_version``), if it is the highest seen."""
+        if not self.enabled:
+            return
+        key = self._key(link, type_, name)
+        head = {
+            'type': publish['type'],
+            'id': publish['id'],
+            'sg_version': publish['sg_version'],
+        }
+        with self._lock:
+            existing = self._heads.get(key)
+            if existing is None or existing['sg_version'] < head['sg_version']:
+                self._heads[key] = head
+
+    def clear(self):
+        with self._lock:
+            self._heads.clear()
+
+
+#: The process-wide :class:`StreamHeadCache`.
+stream_heads = StreamHeadCache()
+
+
+# Everything a template provides to the publishes derived from it.
+_template_fields = ['sg_link', 'sg_type', 'code', 'sg_version']
+_template_fields.extend(_kwarg_to_field.itervalues())
+
+
+def _minimal(value):
+    """Strip entities down so that they may outlive their session."""
+    if isinstance(value, Entity):
+        return value.minimal
+    if isinstance(value, list):
+        return [_minimal(x) for x in value]
+    return value
+
+
+class TemplateCache(object):
+
+    """What has been resolved about publishes used as templates.
+
+    Each entry may have the ``"fields"`` copied from the template, and its
+    ``"path"`` and the ``"meta"`` from its tag, and is keyed by the Shotgun
+    server and the publish's ID. Since a template's fields may still be edited
+    after it was committed, this is disabled by default::
+
+        >>> sgpublish.publisher.template_cache.enabled = True
+
+    The least recently used entries are dropped beyond ``max_size``.
+
+    """
+
+    def __init__(self, enabled=False, max_size=1000):
+        self.enabled = enabled
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, template):
+        shotgun = template.session.shotgun
+        return (getattr(shotgun, 'base_url', None) or shotgun, template['type'], template['id'])
+
+    def get(self, template):
+        """The cached ``dict`` for the given publish entity, or ``None``."""
+        if not self.enabled:
+            return
+        key = self._key(template)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return dict(entry)
+
+    def update(self, template, **data):
+        if not self.enabled:
+            return
+        key = self._key(template)
+        with self._lock:
+            entry = self._entries.pop(key, {})
+            entry.update(data)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+#: The process-wide :class:`TemplateCache`.
+template_cache = TemplateCache()
+
+
 class Publisher(object):
 
     """A publishing assistant.
@@ -74,12 +208,97 @@ class Publisher(object):
         provided.
     :type sgfs: :class:`~sgfs.sgfs.SGFS` or None
 
+    :param int copy_workers: How many threads to copy queued files with during
+        :meth:`.commit`; see :class:`~sgpublish.copier.Copier`.
+
+    :param blob_store: Deduplicate files added via :meth:`add_file` into this
+        content-addressed store, and hardlink them into the publish. ``True``
+        will use the store within the project's directory.
+    :type blob_store: :class:`~sgpublish.blobstore.BlobStore`, bool, or None
+
+    :param delta: Hardlink files which are unchanged since the parent publish
+        (the previous version in the stream) instead of copying them. ``True``
+        compares sizes and modification times, ``"hash"`` compares contents.
+    :type delta: bool or str
+
+    :param bool fix_permissions: Scan the whole publish for files which are not
+        yet read-only on :meth:`.commit`. Files queued via :meth:`add_file` are
+        always made read-only as they are copied, so by default (``None``)
+        this is only done if something else may have written into the
+        :attr:`directory`; i.e. if it was supplied, or has been read.
+
+    :param str checksum: Write a manifest of the publish's contents with digests
+        made via this algorithm (e.g. ``"sha256"`` or ``"xxhash"``); see
+        :mod:`sgpublish.manifest`. Queued files are hashed as they are copied.
+
+    :param int thumbnail_max_size: The thumbnail is downscaled (if PIL is
+        available) to fit within a square of this many pixels before it is
+        copied into the publish and uploaded; ``None`` disables this. If a
+        related publish (the template or parent) has an identical thumbnail,
+        it is shared instead of uploaded. See :mod:`sgpublish.thumbnails`.
+
+    :param int chunked_threshold: Copy queued files of at least this many bytes
+        in chunks which can be continued if the commit is resumed; see
+        :func:`sgpublish.copier.chunked_copy`. Defaults to
+        :data:`~sgpublish.copier.CHUNKED_THRESHOLD` if journaled, and
+        otherwise ``0`` (off).
+
+    :param str io_priority: ``"interactive"`` or ``"batch"``; how queued files
+        compete for bandwidth when it is limited. Defaults to
+        ``$SGPUBLISH_IO_PRIORITY``, or interactive. See :mod:`sgpublish.scheduler`.
+
+    :param int metadata_threshold: Write :attr:`metadata` whose JSON is larger
+        than this many bytes into a compressed sidecar in the publish, and only
+        give Shotgun and the tag a summary; see :mod:`sgpublish.metadata`.
+        ``0`` disables this.
+
+    :param bool journal: Keep a journal of the commit within the publish, so
+        that if it is interrupted (or fails) it may be finished via
+        :meth:`resume` instead of starting again; see :mod:`sgpublish.journal`.
+        A journaled publish is not moved aside when it is rolled back.
+
+    .. attribute:: timings
+
+        The :class:`~sgpublish.timing.Timings` of each phase of the publish
+        (e.g. ``publisher.timings['copy']``), which are also saved into the
+        tag metadata, and passed to the hooks in :mod:`sgpublish.timing`
+        once the commit is done.
+
     """
 
     def __init__(self, link=None, type=None, name=None, version=None, parent=None,
         directory=None, sgfs=None, template=None, **kwargs
     ):
 
+        self._prepare(link, type, name, version, parent, directory, sgfs, template, **kwargs)
+
+        # Prep for async processes. We can do a lot of "frivolous" Shotgun
+        # queries at the same time since we must do at least one.
+        futures = self._start_first_stage()
+
+        # First stage of the publish: create an "empty" PublishEvent.
+        self._create_stub()
+
+        # Lets have our async processes catch up.
+        for future in futures:
+            future.result()
+
+        self._setup_directory()
+
+    def _prepare(self, link=None, type=None, name=None, version=None, parent=None,
+        directory=None, sgfs=None, template=None, **kwargs
+    ):
+        """Validate and store everything prior to talking to Shotgun."""
+
+        # How long everything takes; see sgpublish.timing.
+        self.timings = Timings()
+
+        # Publishes (and their paths) whose thumbnails we may share.
+        self._thumbnail_sources = []
+
+        # Finding the template's thumbnail.
+        self._template_future = None
+
         if not sgfs:
             if isinstance(template, Entity):
                 sgfs = SGFS(session=template.session)
@@ -90,35 +309,7 @@ class Publisher(object):
         self.sgfs = sgfs
 
         if template:
-
-            template = sgfs.session.merge(template)
-            to_fetch = ['sg_link', 'sg_type', 'code', 'sg_version']
-            to_fetch.extend(_kwarg_to_field.itervalues())
-            template.fetch(to_fetch)
-
-            tpl_link, tpl_type, tpl_name, tpl_version = template.get(('sg_link', 'sg_type', 'code', 'sg_version'))
-            link = link or tpl_link
-            type = type or tpl_type
-            name = name or tpl_name
-            version = version or tpl_version
-
-            kwargs.setdefault('source_publish', template)
-            kwargs.setdefault('source_publishes', [template])
-            for key, field in _kwarg_to_field.iteritems():
-                kwargs.setdefault(key, template.get(field))
-
-            if not kwargs.get('thumbnail_path'):
-                # We certainly jump through a lot of hoops to do this...
-                # Perhaps this should be sgfs.get_entity_tags(entity)
-                publish_path = sgfs.path_for_entity(template)
-                if publish_path:
-                    tags = sgfs.get_directory_entity_tags(publish_path)
-                    tags = [tag for tag in tags if tag['entity'] == template]
-                    if tags:
-                        meta = tags[0].get('sgpublish', {})
-                        thumbnail = meta.get('thumbnail')
-                        if thumbnail:
-                            kwargs['thumbnail_path'] = os.path.join(publish_path, thumbnail)
+            link, type, name, version = self._apply_template(template, link, type, name, version, kwargs)
 
         if not (link and type and name):
             raise ValueError('requires link, type, and name')
@@ -135,14 +326,63 @@ class Publisher(object):
         self._review_version_entity = None
         self._review_version_fields = kwargs.pop('review_version_fields', None)
 
+        # How many threads to copy files with on commit.
+        self.copy_workers = kwargs.pop('copy_workers', None)
+        self.copy_stats = None
+
+        # How many files were placed by each strategy; {strategy: count}. Each
+        # file's strategy is journaled, and moves which weren't renames logged.
+        self.copy_strategies = collections.Counter()
+
+        # Where to deduplicate files into.
+        self.blob_store = kwargs.pop('blob_store', None)
+
+        # Reuse unchanged files from the parent publish.
+        self.delta = kwargs.pop('delta', False)
+
+        # Look for files which we did not copy ourselves when setting permissions.
+        self.fix_permissions = kwargs.pop('fix_permissions', None)
+
+        # Algorithm to checksum the contents with.
+        self.checksum = kwargs.pop('checksum', None)
+
+        # Thumbnails are downscaled to fit within this.
+        self.thumbnail_max_size = kwargs.pop('thumbnail_max_size', thumbnails.MAX_SIZE)
+
+        # Bandwidth priority of our copies; see sgpublish.scheduler.
+        self.io_priority = kwargs.pop('io_priority', None) or scheduler.DEFAULT_PRIORITY
+        if self.io_priority not in scheduler.PRIORITIES:
+            raise ValueError('bad io_priority %r' % self.io_priority)
+
+        # Record the commit so that it may be resumed.
+        self.journal = kwargs.pop('journal', False)
+        self._journal = None
+        self._journal_state = JournalState()
+
+        # Copy large files such that they may be continued; only worthwhile
+        # if the commit may be resumed in the same directory.
+        self.chunked_threshold = kwargs.pop('chunked_threshold', None)
+        if self.chunked_threshold is None:
+            self.chunked_threshold = CHUNKED_THRESHOLD if self.journal else 0
+
         # To only allow us to commit once.
         self._committed = False
+        self._commit_future = None
+        self._progress_callback = None
+        self._error_callback = None
 
         # Will be set into the tag.
         self.metadata = {}
 
-        # Files to copy on commit; (src_path, dst_path)
-        self._files = []
+        # Metadata larger than this goes into a sidecar; see sgpublish.metadata.
+        self.metadata_threshold = kwargs.pop('metadata_threshold', None)
+        self._summary_metadata = None
+
+        # Files to copy on commit; (src_path, dst_path, method)
+        self._files = PendingFiles()
+
+        # Destinations of those files which are actually directories.
+        self._trees = set()
 
         # Set attributes from kwargs.
         for name in (
@@ -169,26 +409,118 @@ class Publisher(object):
         # Get everything into the right type before sending it to Shotgun.
         self._normalize_attributes()
 
-        # Prep for async processes. We can do a lot of "frivolous" Shotgun
-        # queries at the same time since we must do at least one.
-        executor = concurrent.futures.ThreadPoolExecutor(8)
+        self._version = None if version is None else int(version)
+        self._requested_directory = directory
+        self._directory_supplied = directory is not None
+        self._directory_handed_out = False
+        self._rolled_back = False
+
+    @timed('template')
+    def _apply_template(self, template, link, type, name, version, kwargs):
+        """Default the publish's fields (and ``kwargs``) to those of the template.
+
+        Only the fields are needed before the stub can be created; finding
+        the template's thumbnail is started in the background, and is applied
+        by :meth:`_setup_directory`. Both are cached in :data:`template_cache`
+        (when it is enabled).
+
+        :return: ``(link, type, name, version)``
+
+        """
+
+        sgfs = self.sgfs
+        template = sgfs.session.merge(template)
+
+        cached = template_cache.get(template)
+        if cached and 'fields' in cached:
+            template = sgfs.session.merge(dict(cached['fields'], type=template['type'], id=template['id']))
+        else:
+            template.fetch(_template_fields)
+            template_cache.update(template, fields=dict(
+                (field, _minimal(template.get(field))) for field in _template_fields
+            ))
+
+        tpl_link, tpl_type, tpl_name, tpl_version = template.get(('sg_link', 'sg_type', 'code', 'sg_version'))
+        link = link or tpl_link
+        type = type or tpl_type
+        name = name or tpl_name
+        version = version or tpl_version
+
+        kwargs.setdefault('source_publish', template)
+        kwargs.setdefault('source_publishes', [template])
+        for key, field in _kwarg_to_field.iteritems():
+            kwargs.setdefault(key, template.get(field))
+
+        if not kwargs.get('thumbnail_path'):
+            self._template_future = executor.submit('io', self.timings.wrap('template_path', self._resolve_template_path), template)
+
+        return link, type, name, version
+
+    def _resolve_template_path(self, template):
+        """Find the template's directory, and the ``sgpublish`` metadata of its tag.
+
+        :return: ``(template, path, metadata)``
+
+        """
+
+        cached = template_cache.get(template)
+        if cached and 'path' in cached:
+            return template, cached['path'], cached['meta']
+
+        # We certainly jump through a lot of hoops to do this...
+        # Perhaps this should be sgfs.get_entity_tags(entity)
+        meta = {}
+        publish_path = self.sgfs.path_for_entity(template)
+        if publish_path:
+            tags = self.sgfs.get_directory_entity_tags(publish_path)
+            tags = [tag for tag in tags if tag['entity'] == template]
+            if tags:
+                meta = dict(metadata.inflate(tags[0], publish_path, missing_ok=True).get('sgpublish') or {})
+
+        template_cache.update(template, path=publish_path, meta=meta)
+        return template, publish_path, meta
+
+    def _apply_template_thumbnail(self):
+        """Use the template's thumbnail, unless one has been provided."""
+
+        template, publish_path, meta = self._template_future.result()
+        self._template_future = None
+
+        thumbnail = meta.get('thumbnail')
+        if publish_path and thumbnail and not self.thumbnail_path:
+            self.thumbnail_path = os.path.join(publish_path, thumbnail)
+            self._thumbnail_sources.append((template, publish_path))
+
+    def _start_first_stage(self, automatic_version=True, fetch_link=True):
+        """Start the queries which may run alongside the stub's creation.
+
+        :return: A list of futures to wait on.
+
+        """
+
         futures = []
 
         # Figure out the version number (async).
-        if version is None:
-            futures.append(executor.submit(self._set_automatic_version))
-        else:
-            self._version = int(version)
+        if automatic_version and self._version is None:
+            futures.append(executor.submit('shotgun', self._set_automatic_version))
 
         # Grab all data on the link (assuming that is all that is used when
         # creating publish templates).
-        futures.append(executor.submit(self.link.fetch_core))
+        if fetch_link:
+            futures.append(executor.submit('shotgun', self.timings.wrap('fetch_link', self.link.fetch_core)))
 
         # Create the review version stub (async).
         if self._review_version_fields is not None:
-            futures.append(executor.submit(self._get_review_version))
+            futures.append(executor.submit('shotgun', self._get_review_version))
 
-        # First stage of the publish: create an "empty" PublishEvent.
+        # Started by the template.
+        if self._template_future is not None:
+            futures.append(self._template_future)
+
+        return futures
+
+    def _initial_data(self):
+        """The fields of the "empty" PublishEvent of the first stage."""
         initial_data = {
             'code': self.name,
             'created_by': self.created_by,
@@ -205,17 +537,47 @@ class Publisher(object):
             'sg_version': 0, # Signifies that this is "empty".
         }
         initial_data.update(self.extra_fields)
+        return initial_data
+
+    @timed('create')
+    def _create_stub(self):
+        data = self._initial_data()
         try:
-            self.entity = self.sgfs.session.create('PublishEvent', initial_data)
+            stub_id = stubs.pool.claim(self.sgfs.session, data['project'], data['created_by'])
+            if stub_id:
+                try:
+                    self._claim_stub(stub_id, data)
+                    return
+                except ShotgunFault:
+                    log.warning('could not claim PublishEvent stub %d; creating one' % stub_id, exc_info=True)
+                    stubs.pool.discard(self.sgfs.session, stub_id)
+            self.entity = self.sgfs.session.create('PublishEvent', data)
         except ShotgunFault:
-            if not self.link.exists():
-                raise RuntimeError('%s %d (%r) has been retired' % (link['type'], link['id'], link.get('name')))
-            else:
-                raise
+            self._check_link()
+            raise
 
-        # Lets have our async processes catch up.
-        for future in futures:
-            future.result()
+    def _claim_stub(self, stub_id, data):
+        """Turn a stub from the :mod:`~sgpublish.stubs` pool into our "empty" PublishEvent."""
+        self.sgfs.session.update('PublishEvent', stub_id, stubs.update_fields(data))
+        self.entity = self.sgfs.session.merge(dict(data, type='PublishEvent', id=stub_id))
+
+    def _check_link(self):
+        """Raise a nicer error if the link has been retired."""
+        if not self.link.exists():
+            raise RuntimeError('%s %d (%r) has been retired' % (self.link['type'], self.link['id'], self.link.get('name')))
+
+    @timed('directory')
+    def _setup_directory(self):
+        """Create the (unique) directory of the publish.
+
+        Requires that the first stage has completed.
+
+        """
+
+        if self._template_future is not None:
+            self._apply_template_thumbnail()
+
+        directory = self._requested_directory
 
         # Manually forced directory.
         if directory is not None:
@@ -228,22 +590,13 @@ class Publisher(object):
             self._directory_supplied = False
 
             # Find a unique name using the template result as a base.
-            base_path = self.sgfs.path_from_template(link, '%s_publish' % type, dict(
+            base_path = self.sgfs.path_from_template(self.link, '%s_publish' % self.type, dict(
                 publish=self, # For b/c.
                 publisher=self,
                 PublishEvent=self.entity,
                 self=self.entity, # To mimick Shotgun templates.
             ))
-            unique_iter = ('%s_%d' % (base_path, i) for i in itertools.count(1))
-            for path in itertools.chain([base_path], unique_iter):
-                try:
-                    os.makedirs(path)
-                except OSError as e:
-                    if e.errno != 17: # File exists
-                        raise
-                else:
-                    self._directory = path
-                    break
+            self._directory = utils.make_unique_directory(base_path)
 
         # Make the directory so that tools which want to manually copy files
         # don't have to.
@@ -255,24 +608,41 @@ class Publisher(object):
         if any(tag['entity'].exists() for tag in tags):
             raise ValueError('directory is already tagged: %r' % self._directory)
 
+    @timed('version')
     def _set_automatic_version(self):
 
-        existing_entities = self.sgfs.session.find(
-            'PublishEvent',
-            [
-                ('sg_link', 'is', self.link),
-                ('sg_type', 'is', self.type),
-                ('code', 'is', self.name),
-            ],
-            ['sg_version', 'created_at'],
-        )
+        head = stream_heads.get(self.link, self.type, self.name)
 
-        self._version = 1
-        for e in existing_entities:
-            # Only increment for non-failed commits.
-            if e['sg_version']:
-                self._version = e['sg_version'] + 1
-                self._parent = e
+        if head is None:
+            # Only the highest non-failed commit matters.
+            head = self.sgfs.session.find_one(
+                'PublishEvent',
+                [
+                    ('sg_link', 'is', self.link),
+                    ('sg_type', 'is', self.type),
+                    ('code', 'is', self.name),
+                    ('sg_version', 'greater_than', 0),
+                ],
+                ['sg_version', 'created_at'],
+                order=[{'field_name': 'sg_version', 'direction': 'desc'}],
+            )
+            if head:
+                stream_heads.update(self.link, self.type, self.name, head)
+
+        if head:
+            self._version = head['sg_version'] + 1
+            self._parent = head
+        else:
+            self._version = 1
+
+    def _get_parent_directory(self):
+        """The directory of the parent publish, or None."""
+        if not self._parent:
+            return
+        parent = self.sgfs.session.merge(self._parent)
+        path = self.sgfs.path_for_entity(parent)
+        if path and os.path.exists(path):
+            return path
 
     def _normalize_url(self, url):
         if url is None:
@@ -340,7 +710,15 @@ class Publisher(object):
 
     @property
     def directory(self):
-        """The path into which all files must be placed."""
+        """The path into which all files must be placed.
+
+        Since anything may then be written into it, reading this means that
+        the whole publish is scanned for permissions on :meth:`commit`
+        (unless ``fix_permissions`` was given).
+
+        """
+        if self._directory is not None:
+            self._directory_handed_out = True
         return self._directory
 
     def isabs(self, dst_name):
@@ -364,11 +742,21 @@ class Publisher(object):
         :param str src_path: The path to copy into the publish.
         :param dst_name: Where to copy it to.
         :type dst_name: str or None.
+        :param str method: How to get the file into the publish; one of
+            ``"copy"``, ``"move"``, ``"link"``, ``"reflink"``, or ``"auto"``.
+            See :func:`sgpublish.copier.copy_file`; how each file was actually
+            placed is counted in :attr:`copy_strategies`, recorded for each
+            file in the journal (if ``journal`` is set), and logged for each
+            move which had to copy the file instead.
 
         ``dst_name`` will default to the basename of the source path. ``dst_name``
         will be treated as relative to the :attr:`.path` if it is not contained
         withing the :attr:`.directory`.
 
+        If ``src_path`` is a directory, then everything within it is copied,
+        preserving its structure and symlinks; see
+        :meth:`Copier.add_tree() <sgpublish.copier.Copier.add_tree>`.
+
         """
         dst_name = dst_name or os.path.basename(src_path)
         if make_unique:
@@ -377,30 +765,50 @@ class Publisher(object):
             raise ValueError('the file already exists in the publish')
         dst_path = self.abspath(dst_name)
 
-        if method not in ('copy', 'move'):
+        if method not in COPY_METHODS:
             raise ValueError('bad add_file method %r' % method)
 
+        if os.path.isdir(src_path):
+            self._trees.add(dst_path)
+
+        if method == 'move' and os.path.lexists(src_path) and not same_device(src_path, self._directory):
+            log.info('%s is not on the same device as the publish; it will be copied and then deleted' % src_path)
+
         if immediate:
             self._add_file(src_path, dst_path, method)
         else:
-            self._files.append((src_path, dst_path, method))
+            self._files.append(src_path, dst_path, method)
 
         return dst_path
 
     def _add_file(self, src_path, dst_path, method):
+        if dst_path in self._trees:
+            copier = Copier(self.copy_workers,
+                chunked_threshold=self.chunked_threshold,
+                callback=self._record_strategies,
+                priority=self.io_priority,
+            )
+            copier.add_tree(src_path, dst_path, method)
+            copier.run()
+            return
+        utils.makedirs(os.path.dirname(dst_path))
+        with scheduler.priority(self.io_priority):
+            strategy, size = copy_file(src_path, dst_path, method, chunked_threshold=self.chunked_threshold)
+        self._record_strategy(dst_path, strategy)
 
-        dst_dir = os.path.dirname(dst_path)
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
+    def add_files(self, files, relative_to=None, **kwargs):
+        """Queue many files via :meth:`add_file`.
 
-        if method == 'copy':
-            shutil.copy(src_path, dst_path)
-        elif method == 'move':
-            shutil.move(src_path, dst_path)
-        else:
-            raise RuntimeError('bad add_file method %r' % method)
+        :param files: Any iterable of paths, e.g. a generator over an image
+            sequence; it is consumed as it is queued, and never held in full.
+            The queue itself is compact, and moves to disk once it is very
+            large; see :mod:`sgpublish.pending`.
+        :param str relative_to: Structure the publish relative to this
+            directory, instead of flattening everything into the top.
 
-    def add_files(self, files, relative_to=None, **kwargs):
+        Other keyword arguments are passed to :meth:`add_file`.
+
+        """
 
         for i, path in enumerate(files):
 
@@ -420,25 +828,112 @@ class Publisher(object):
                 self.path = dst_path
 
 
+    def _iter_file_paths(self):
+        return self._files.dst_paths()
+
     def file_exists(self, dst_name):
         """If added via :meth:`.add_file`, would it clash with an existing file?"""
-        dst_path = self.abspath(dst_name)
-        return os.path.exists(dst_path) or any(x[1] == dst_path for x in self._files)
+        return self._files.is_taken(self.abspath(dst_name))
 
     def unique_name(self, dst_name):
         """Append numbers to the end of the name if nessesary to make the name
         unique for :meth:`.add_file`.
 
         """
-        if not self.file_exists(dst_name):
+        i = self._files.free_suffix(self.abspath(dst_name))
+        if not i:
             return dst_name
         base, ext = os.path.splitext(dst_name)
-        for i in itertools.count(1):
-            unique_name = '%s_%d%s' % (base, i, ext)
-            if not self.file_exists(unique_name):
-                return unique_name
+        return '%s_%d%s' % (base, i, ext)
+
+    def commit(self, background=False, progress_callback=None, error_callback=None):
+        """Complete the second stage of the publish.
+
+        The publish is locked (and its attributes normalized) immediately.
+        Everything else (copying queued files, setting permissions, updating
+        Shotgun, uploading the thumbnail, and tagging) may happen in the
+        background, so that the caller can get on with something else once
+        everything has been written into the :attr:`directory`. If any of it
+        fails the publish is rolled back, exactly as in the foreground.
+
+        :param bool background: Finish the commit on the shared ``"publish"``
+            pool (see :mod:`sgpublish.executor`), and return immediately.
+        :param progress_callback: Called with ``(stage, done, total)`` as the
+            commit progresses; ``"copy"`` is reported after every batch of
+            files (``total`` is ``None`` if directories were queued), and then
+            ``"updated"``, ``"thumbnail"``, ``"files"``, ``"tagged"``,
+            ``"promoted"`` as each is completed, and finally ``"done"``.
+        :param error_callback: Called with the exception if the commit fails.
+        :return: A :class:`concurrent.futures.Future` of the PublishEvent if
+            ``background``, otherwise ``None``.
+
+        Callbacks are called from whichever thread does the work, so any
+        interaction with a UI must be passed back to its own thread.
+
+        """
+
+        self._progress_callback = progress_callback
+        self._error_callback = error_callback
 
-    def commit(self):
+        updates = self._prepare_commit()
+
+        if not background:
+            self._run_commit(updates)
+            return
+
+        def run():
+            self._run_commit(updates)
+            return self.entity
+
+        self._commit_future = executor.submit('publish', run)
+        return self._commit_future
+
+    def _run_commit(self, updates):
+
+        try:
+
+            # Start the second stage of the publish.
+            futures = []
+            if not self._stage_done('updated'):
+                future = executor.submit('shotgun', self.timings.wrap('update', self.sgfs.session.update),
+                    'PublishEvent',
+                    self.entity['id'],
+                    updates,
+                )
+                futures.append(self._complete_when_done(future, 'updated'))
+
+            futures.extend(self._commit_files())
+
+            # Wait for the Shotgun updates.
+            for future in futures:
+                future.result()
+
+            self._finish_commit()
+
+        except Exception as e:
+            self.rollback()
+            if self._error_callback is not None:
+                try:
+                    self._error_callback(e)
+                except Exception:
+                    log.exception('error in commit error callback')
+            raise
+
+        except:
+            self.rollback()
+            raise
+
+        finally:
+            timing.emit(self)
+
+        self._report_progress('done')
+
+    def _prepare_commit(self):
+        """Lock the publish, and assemble the updates of the second stage.
+
+        :return: The fields to update the PublishEvent with.
+
+        """
 
         # As soon as one publish attempt is made, we force a full retry.
         if self._committed:
@@ -450,6 +945,11 @@ class Publisher(object):
 
         try:
 
+            # Large metadata only goes to Shotgun and the tag as a summary.
+            self._summary_metadata = metadata.offload(self.metadata, self._directory, self.metadata_threshold)
+            if metadata.is_summary(self._summary_metadata):
+                permissions.set_file(os.path.join(self._directory, metadata.SIDECAR_NAME))
+
             updates = {
                 'description': self.description,
                 'sg_path': self.path,
@@ -459,7 +959,7 @@ class Publisher(object):
                 'sg_source_publishes': self.source_publishes or [],
                 'sg_trigger_event_id': self.trigger_event['id'] if self.trigger_event else None,
                 'sg_version': self._version,
-                'sg_metadata': json.dumps(self.metadata),
+                'sg_metadata': json.dumps(self._summary_metadata),
             }
             updates.update(self.extra_fields)
 
@@ -468,75 +968,328 @@ class Publisher(object):
             # or promote for review.
             self.entity.update(updates)
 
-            executor = concurrent.futures.ThreadPoolExecutor(4)
-            futures = []
+            self._prepare_thumbnail()
 
-            # Start the second stage of the publish.
-            futures.append(executor.submit(self.sgfs.session.update,
-                'PublishEvent',
-                self.entity['id'],
-                updates,
-            ))
+            if self.journal:
+                self._begin_journal(updates)
+
+        except:
+            self.rollback()
+            raise
 
-            if self.thumbnail_path:
+        return updates
 
-                # Start the thumbnail upload in the background.
-                futures.append(executor.submit(self.sgfs.session.upload_thumbnail,
-                    self.entity['type'],
-                    self.entity['id'],
-                    self.thumbnail_path,
-                ))
-
-                # Schedule it for copy.
-                thumbnail_name = os.path.relpath(self.thumbnail_path, self.directory)
-                if thumbnail_name.startswith('.'):
-                    thumbnail_name = 'thumbnail' + os.path.splitext(self.thumbnail_path)[1]
-                    thumbnail_name = self.add_file(
-                        self.thumbnail_path,
-                        thumbnail_name,
-                        make_unique=True
-                    )
-
-            # Copy in the scheduled files.
+    @timed('thumbnail_prepare')
+    def _prepare_thumbnail(self):
+        """Get a (downscaled) thumbnail into the publish, and hash it.
+
+        The copy in the publish is what is uploaded, and the original is left
+        untouched.
+
+        """
+
+        self._thumbnail_name = None
+        self._thumbnail_digest = None
+        if not self.thumbnail_path:
+            return
+
+        thumbnail_name = os.path.relpath(self.thumbnail_path, self._directory)
+        size = thumbnails.image_size(self.thumbnail_path)
+        max_size = self.thumbnail_max_size
+        too_large = bool(size and max_size and max(size) > max_size)
+
+        if too_large or thumbnail_name.startswith('.'):
+            thumbnail_name = self.unique_name('thumbnail' + os.path.splitext(self.thumbnail_path)[1])
+            thumbnail_path = self.abspath(thumbnail_name)
+            utils.makedirs(os.path.dirname(thumbnail_path))
+            if too_large:
+                thumbnails.downscale(self.thumbnail_path, thumbnail_path, max_size)
+            else:
+                copy_file(self.thumbnail_path, thumbnail_path)
+            permissions.set_file(thumbnail_path)
+            self.thumbnail_path = thumbnail_path
+
+        self._thumbnail_name = thumbnail_name
+        self._thumbnail_digest = utils.hash_file(self.thumbnail_path)
+
+    def _find_shared_thumbnail(self):
+        """Find a related publish which already has an identical thumbnail.
+
+        The template (if its thumbnail was used) and parent are considered.
+
+        """
+
+        candidates = list(self._thumbnail_sources)
+        parent_directory = self._get_parent_directory()
+        if parent_directory:
+            candidates.append((self.sgfs.session.merge(self._parent), parent_directory))
+
+        for entity, publish_path in candidates:
+            tags = [tag for tag in self.sgfs.get_directory_entity_tags(publish_path) if tag['entity'] == entity]
+            meta = metadata.inflate(tags[0], publish_path, missing_ok=True).get('sgpublish', {}) if tags else {}
+            digest = meta.get('thumbnail_digest')
+            if digest is None and meta.get('thumbnail'):
+                # Published before we recorded digests.
+                path = os.path.join(publish_path, meta['thumbnail'])
+                digest = utils.hash_file(path) if os.path.exists(path) else None
+            if digest == self._thumbnail_digest:
+                return entity
+
+    def _upload_thumbnail(self):
+        """Share an identical thumbnail if there is one, or upload ours."""
+
+        source = self._find_shared_thumbnail() if self._thumbnail_digest else None
+        if source is not None:
+            try:
+                self.sgfs.session.share_thumbnail([self.entity.minimal], source_entity=source.minimal)
+            except Exception:
+                log.warning('could not share thumbnail of %s %d; uploading' % (source['type'], source['id']), exc_info=True)
+            else:
+                log.debug('shared thumbnail of %s %d' % (source['type'], source['id']))
+                return
+
+        self.sgfs.session.upload_thumbnail(
+            self.entity['type'],
+            self.entity['id'],
+            self.thumbnail_path,
+        )
+
+    def _begin_journal(self, updates):
+        """Record everything the rest of the commit needs to be resumed."""
+
+        blob_store = self.blob_store
+        if isinstance(blob_store, BlobStore):
+            blob_store = {'root': blob_store.root, 'algorithm': blob_store.algorithm}
+
+        self._journal = Journal(self._directory)
+        # Streamed ahead of the commit record, as the queue may be huge.
+        self._journal.write_queued(self._files)
+        self._journal.write('commit',
+            id=self.entity['id'],
+            link=self.link,
+            type=self.type,
+            name=self.name,
+            version=self._version,
+            parent=self._parent,
+            created_by=self.created_by,
+            directory_supplied=self._directory_supplied,
+            updates=updates,
+            metadata=self.metadata,
+            summary_metadata=self._summary_metadata,
+            thumbnail_path=self.thumbnail_path,
+            thumbnail_name=self._thumbnail_name,
+            thumbnail_digest=self._thumbnail_digest,
+            thumbnail_sources=self._thumbnail_sources,
+            copy_workers=self.copy_workers,
+            blob_store=blob_store,
+            delta=self.delta,
+            fix_permissions=self._should_fix_permissions(),
+            checksum=self.checksum,
+            chunked_threshold=self.chunked_threshold,
+            review_version_fields=self._review_version_fields,
+            review_version_entity=self._review_version_entity,
+        )
+
+    def _should_fix_permissions(self):
+        """Must the whole publish be scanned for permissions?"""
+        if self.fix_permissions is None:
+            return self._directory_supplied or self._directory_handed_out
+        return bool(self.fix_permissions)
+
+    def _stage_done(self, stage):
+        return stage in self._journal_state.stages
+
+    def _report_progress(self, stage, done=None, total=None):
+        if self._progress_callback is not None:
+            try:
+                self._progress_callback(stage, done, total)
+            except Exception:
+                log.exception('error in commit progress callback')
+
+    def _complete_stage(self, stage, **data):
+        """Journal and report that a stage of the commit is complete."""
+        if self._journal is not None:
+            self._journal.write_stage(stage, **data)
+        self._report_progress(stage)
+
+    def _complete_when_done(self, future, stage):
+        """Complete the stage once the given future succeeds."""
+        def callback(future):
+            if future.exception() is None:
+                self._complete_stage(stage)
+        future.add_done_callback(callback)
+        return future
+
+    def _record_strategies(self, results):
+        for dst_path, strategy, size, digest, checksum in results:
+            self._record_strategy(dst_path, strategy)
+
+    def _record_strategy(self, dst_path, strategy):
+        self.copy_strategies[strategy] += 1
+        if strategy.endswith('+delete'):
+            # A move which had to copy; worth knowing which file paid for it.
+            log.info('moved %s via %s' % (dst_path, strategy))
+
+    def _on_copied(self, results):
+        """Journal and report each batch of files placed by the copier."""
+        if self._journal is not None:
+            self._journal.write_copied(results)
+        self._record_strategies(results)
+        self._copied_count += len(results)
+        self._report_progress('copy', self._copied_count, self._copy_total)
+
+    def _commit_files(self):
+        """Get all of the files into the publish.
+
+        :return: A list of futures (e.g. the thumbnail upload) to wait on.
+
+        """
+
+        futures = []
+
+        # Start the thumbnail upload in the background.
+        if self.thumbnail_path and not self._stage_done('thumbnail'):
+            future = executor.submit('shotgun', self.timings.wrap('thumbnail', self._upload_thumbnail))
+            futures.append(self._complete_when_done(future, 'thumbnail'))
+
+        # Copy in the scheduled files (minus those a previous attempt did).
+        blob_store = self.blob_store
+        if blob_store is True:
+            blob_store = BlobStore.for_project(self.sgfs, self.link.project())
+        self._delta_from = self._get_parent_directory() if self.delta else None
+        self._copier = copier = Copier(self.copy_workers,
+            blob_store=blob_store or None,
+            delta_from=self._delta_from,
+            delta_root=self._directory,
+            delta_hash=self.delta == 'hash',
+            read_only=True,
+            checksum=self.checksum,
+            chunked_threshold=self.chunked_threshold,
+            callback=self._on_copied,
+            priority=self.io_priority,
+        )
+        copied = self._journal_state.copied
+        for dst_path, (strategy, digest, checksum) in copied.iteritems():
+            if strategy == 'reuse':
+                copier.reused.append(dst_path)
+            if digest is not None:
+                copier.digests[dst_path] = digest
+            if checksum is not None:
+                copier.checksums[dst_path] = checksum
+        if self._trees:
             for file_args in self._files:
-                self._add_file(*file_args)
+                # Skipping trees which were moved with a single rename.
+                if file_args[1] in self._trees and file_args[1] not in copied:
+                    copier.add_tree(*file_args, exclude=copied)
+        # Streamed from the queue as the copy runs, instead of all at once.
+        copier.add_many(
+            file_args for file_args in self._files
+            if file_args[1] not in copied and file_args[1] not in self._trees
+        )
+        self._copied_count = 0
+        self._copy_total = None if self._trees else len(self._files) - len(copied)
+
+        files_stage = self._journal_state.stages.get('files')
+        if files_stage is not None:
+            self._manifest_summary = files_stage.get('manifest')
+            return futures
+
+        with self.timings.span('copy') as span:
+            self.copy_stats = copier.run()
+            span.files = self.copy_stats.files
+            span.bytes = self.copy_stats.bytes
+        log.info('copied into %s: %s' % (self._directory, self.copy_stats))
+
+        # Record what went into the publish.
+        self._manifest_summary = None
+        if self.checksum:
+            with self.timings.span('manifest') as span:
+                entries = manifest.build(self._directory, copier.checksums, self.checksum)
+                self._manifest_summary = manifest.write(self._directory, entries, self.checksum)
+                permissions.set_file(os.path.join(self._directory, manifest.MANIFEST_NAME))
+                span.files = self._manifest_summary['files']
+                span.bytes = self._manifest_summary['bytes']
+
+        # Set permissions. I would like to own it by root, but we need root
+        # to do that. We also leave the directory writable, but sticky.
+        # The copier has already done everything it placed.
+        with self.timings.span('permissions') as span:
+            if self._should_fix_permissions():
+                span.files = permissions.fix_tree(self._directory)
+            else:
+                permissions.set_root(self._directory)
 
-            # Set permissions. I would like to own it by root, but we need root
-            # to do that. We also leave the directory writable, but sticky.
-            check_call(['chmod', '-R', 'a=rX', self._directory])
-            check_call(['chmod', 'a+t,u+w', self._directory])
+        self._complete_stage('files', manifest=self._manifest_summary)
 
-            # Wait for the Shotgun updates.
-            for future in futures:
-                future.result()
+        return futures
 
-            # Tag the directory. Ideally we would like to do this before the
-            # futures are waited for, but we only want to tag the directory
-            # if everything was successful.
-            our_metadata = {}
-            if self._parent:
-                our_metadata['parent'] = self.sgfs.session.merge(self._parent).minimal
-            if self.thumbnail_path:
-                our_metadata['thumbnail'] = thumbnail_name.encode('utf8') if isinstance(thumbnail_name, unicode) else thumbnail_name
-            full_metadata = dict(self.metadata)
-            full_metadata['sgpublish'] = our_metadata
-            self.sgfs.tag_directory_with_entity(self._directory, self.entity, full_metadata)
+    def _finish_commit(self):
+        """Tag the directory and promote for review.
 
-            # Again, we would like to do with with the futures, but the current
-            # version of this depends on the directory being tagged.
-            if self._review_version_fields is not None:
-                self._promote_for_review()
+        Must only be called once the second stage is on Shotgun.
 
+        """
 
-        except:
-            self.rollback()
-            raise
+        copier = self._copier
+
+        # Tag the directory. Ideally we would like to do this before the
+        # futures are waited for, but we only want to tag the directory
+        # if everything was successful.
+        our_metadata = {}
+        if self._parent:
+            our_metadata['parent'] = self.sgfs.session.merge(self._parent).minimal
+        if self._thumbnail_name:
+            thumbnail_name = self._thumbnail_name
+            our_metadata['thumbnail'] = thumbnail_name.encode('utf8') if isinstance(thumbnail_name, unicode) else thumbnail_name
+            if self._thumbnail_digest:
+                our_metadata['thumbnail_digest'] = self._thumbnail_digest
+        if self._delta_from:
+            reused = set(copier.reused)
+            our_metadata['delta'] = {
+                'reused': sorted(os.path.relpath(path, self._directory) for path in reused),
+                'copied': sorted(os.path.relpath(path, self._directory) for path in self._iter_file_paths() if path not in reused),
+            }
+        if self._manifest_summary:
+            our_metadata['manifest'] = self._manifest_summary
+        if copier.digests:
+            our_metadata['blobs'] = {
+                'algorithm': copier.blob_store.algorithm,
+                'files': dict(
+                    (os.path.relpath(path, self._directory), digest)
+                    for path, digest in copier.digests.iteritems()
+                ),
+            }
+        # Everything up to (but not including) tagging.
+        our_metadata['timings'] = self.timings.as_list()
+        full_metadata = dict(self._summary_metadata)
+        full_metadata['sgpublish'] = our_metadata
+        if not self._stage_done('tagged'):
+            with self.timings.span('tag'):
+                self.sgfs.tag_directory_with_entity(self._directory, self.entity, full_metadata)
+            self._complete_stage('tagged')
+
+        stream_heads.update(self.link, self.type, self.name, self.entity)
+
+        # Again, we would like to do with with the futures, but the current
+        # version of this depends on the directory being tagged.
+        if self._review_version_fields is not None and not self._stage_done('promoted'):
+            self._promote_for_review()
+            self._complete_stage('promoted')
+
+        # Nothing left to resume.
+        if self._journal is not None:
+            self._journal.remove()
 
     def __enter__(self):
         return self
 
     def rollback(self):
 
+        # Only once, or we would move the failed directory aside again.
+        if self._rolled_back:
+            return
+        self._rolled_back = True
+
         # Remove the entity's ID.
         id_ = self.entity.pop('id', None) or 0
 
@@ -544,18 +1297,135 @@ class Publisher(object):
         if id_ and self.entity.get('sg_version'):
             self.sgfs.session.update('PublishEvent', id_, {'sg_version': 0})
 
+        # Leave a journaled publish where it is, to be resumed.
+        if self._journal is not None:
+            self._journal.write('rollback')
+            self._journal.close()
+            log.warning('publish %d in %s may be finished via Publisher.resume(%d)' % (id_, self._directory, id_))
+            return
+
         # Move the folder aside.
-        if not self._directory_supplied and os.path.exists(self._directory):
+        if not self._directory_supplied and self._directory and os.path.exists(self._directory):
             failed_directory = '%s.%d.failed' % (self._directory, id_)
             check_call(['mv', self._directory, failed_directory])
             self._directory = failed_directory
 
+    @classmethod
+    def resume(cls, publish_id, directory=None, sgfs=None):
+        """Finish a journaled commit which was interrupted or rolled back.
+
+        Only the work which the journal does not record as done is repeated;
+        files which were completely copied are not copied again. See the
+        ``journal`` parameter, and :mod:`sgpublish.journal`.
+
+        :param int publish_id: The ID of the ``PublishEvent``.
+        :param str directory: The publish directory; defaults to searching
+            upwards from the publish's ``sg_path``, which is only known to
+            Shotgun once the commit's first request has completed.
+        :param sgfs: The SGFS to use.
+        :type sgfs: :class:`~sgfs.sgfs.SGFS` or None
+        :return: The committed :class:`Publisher`.
+
+        """
+
+        sgfs = sgfs or SGFS()
+        publish_id = int(publish_id)
+        entity = sgfs.session.merge({'type': 'PublishEvent', 'id': publish_id})
+
+        if directory is not None:
+            journal = Journal(os.path.abspath(directory))
+        else:
+            journal = Journal.find(entity.fetch('sg_path'))
+            if journal is None:
+                raise ValueError('cannot find journal of PublishEvent %d; please provide its directory' % publish_id)
+
+        state = journal.replay()
+        record = state.commit
+        if record is None:
+            raise ValueError('no commit to resume in %r' % journal.directory)
+        if record['id'] != publish_id:
+            raise ValueError('journal in %r is for PublishEvent %d, not %d' % (journal.directory, record['id'], publish_id))
+
+        blob_store = record['blob_store']
+        if isinstance(blob_store, dict):
+            blob_store = BlobStore(blob_store['root'], blob_store['algorithm'])
+
+        self = cls.__new__(cls)
+        self._prepare(
+            link=record['link'],
+            type=record['type'],
+            name=record['name'],
+            version=record['version'],
+            parent=record['parent'],
+            directory=journal.directory,
+            sgfs=sgfs,
+            created_by=record['created_by'],
+            thumbnail_path=record['thumbnail_path'],
+            copy_workers=record['copy_workers'],
+            blob_store=blob_store,
+            delta=record['delta'],
+            fix_permissions=record['fix_permissions'],
+            checksum=record['checksum'],
+            chunked_threshold=record.get('chunked_threshold'),
+            review_version_fields=record['review_version_fields'],
+            journal=True,
+        )
+
+        updates = record['updates']
+        self.entity = entity
+        self.entity.update(updates)
+        self.description = updates['description']
+        self.path = updates['sg_path']
+        self.frames_path = updates['sg_path_to_frames']
+        self.movie_path = updates['sg_path_to_movie']
+        self.metadata = record['metadata']
+        self._summary_metadata = record.get('summary_metadata', self.metadata)
+
+        self._directory = journal.directory
+        self._directory_supplied = record['directory_supplied']
+        self._review_version_entity = record['review_version_entity']
+        self._thumbnail_name = record['thumbnail_name']
+        self._thumbnail_digest = record.get('thumbnail_digest')
+        self._thumbnail_sources = [
+            (sgfs.session.merge(entity), path)
+            for entity, path in record.get('thumbnail_sources') or ()
+        ]
+        self._files = state.queued if state.queued is not None else PendingFiles(record.get('files') or ())
+        self._trees = set(dst_path for src_path, dst_path, method in self._files if os.path.isdir(src_path))
+        self._committed = True
+        self._journal = journal
+        self._journal_state = state
+
+        # Clear out anything which was only partially copied (except trees
+        # and chunked copies, which continue by themselves). A move which
+        # completed just before the interruption has no source left to retry.
+        for src_path, dst_path, method in self._files:
+            if dst_path in state.copied or not os.path.lexists(dst_path):
+                continue
+            if dst_path in self._trees or os.path.exists(dst_path + PARTIAL_SUFFIX):
+                continue
+            if method == 'move' and not os.path.lexists(src_path):
+                state.copied[dst_path] = ('move', None, None)
+            else:
+                os.unlink(dst_path)
+
+        log.info('resuming publish %d in %s; %d of %d files to copy' % (
+            publish_id, self._directory, len(self._files) - len(state.copied), len(self._files),
+        ))
+        self._run_commit(updates)
+        return self
+
     def __exit__(self, *exc_info):
         if exc_info and exc_info[0] is not None:
+            # Don't pull the publish out from under a background commit.
+            if self._commit_future is not None:
+                concurrent.futures.wait([self._commit_future])
             self.rollback()
             return
-        self.commit()
+        if not self._committed:
+            self.commit()
 
+    @timed('review_stub')
     def _get_review_version(self):
         """Get a Version entity which will reference the PublishEvent once done.
 
@@ -571,6 +1441,7 @@ class Publisher(object):
             })
         return self._review_version_entity
 
+    @timed('promote')
     def _promote_for_review(self):
         if not self._committed:
             raise RuntimeError('can only promote AFTER publishing commits')
@@ -0,0 +1,388 @@
+"""Bandwidth limits and priorities for the data copied into publishes.
+
+When many publishes commit at once (e.g. from a farm) their copies can
+saturate the filer. Every chunk of data which sgpublish copies through Python
+or the kernel (reflinks, renames, and hardlinks move no data) is passed to
+:func:`throttle`, which blocks as needed to keep within:
+
+- a per-process rate, in bytes per second;
+- a per-host rate, shared by every process on the host through a small,
+  locked, state file (in a sticky directory which every user may write to,
+  like ``/tmp``). Since anyone may write to it, it is never followed through
+  a symlink, and implausible state is discarded.
+
+Both are token buckets which hold at most ``burst`` bytes (one second's
+worth by default). They are unlimited until configured::
+
+    >>> from sgpublish import scheduler
+    >>> scheduler.configure(process_rate=200 << 20, host_rate=400 << 20)
+
+Or via ``$SGPUBLISH_PROCESS_RATE`` and ``$SGPUBLISH_HOST_RATE``.
+
+Copies have a priority; :data:`INTERACTIVE` (the default) or :data:`BATCH`.
+Within a process, interactive copies are always given the bandwidth ahead of
+waiting batch copies. Across processes, batch copies are charged ``1 /
+batch_share`` times their size while interactive copies are active on the
+host, leaving most of the bandwidth to the interactive ones. Farm jobs should
+set ``$SGPUBLISH_IO_PRIORITY`` to ``batch``, or pass ``io_priority='batch'`` to
+the :class:`~sgpublish.publisher.Publisher`.
+
+What is waiting is available via :func:`status`.
+
+"""
+
+import contextlib
+import errno
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+#: Copies which a user is waiting on.
+INTERACTIVE = 'interactive'
+
+#: Copies which nobody is watching, e.g. from the farm.
+BATCH = 'batch'
+
+PRIORITIES = (INTERACTIVE, BATCH)
+
+#: The priority of copies which don't specify one.
+DEFAULT_PRIORITY = os.environ.get('SGPUBLISH_IO_PRIORITY') or INTERACTIVE
+
+#: Where the per-host bucket is kept by default.
+DEFAULT_HOST_STATE_PATH = os.path.join(tempfile.gettempdir(), 'sgpublish-io', 'host.json')
+
+# The mode of the directory of the host state, if we create it.
+_HOST_STATE_DIR_MODE = 01777
+
+# Host state which claims a debt of more than this many seconds (or to have
+# been updated this far in the future) is discarded.
+_MAX_DEBT = 60.0
+_MAX_CLOCK_SKEW = 5.0
+
+#: The share of the bandwidth left to batch copies while interactive ones are active.
+DEFAULT_BATCH_SHARE = 0.25
+
+#: How long after an interactive copy batch copies are still penalized, in seconds.
+INTERACTIVE_WINDOW = 2.0
+
+
+def _env_rate(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+class _Bucket(object):
+
+    """A token bucket of bytes, whose state is a ``dict``."""
+
+    def __init__(self, rate, burst, batch_share):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.batch_share = batch_share
+
+    def new_state(self, now):
+        return {'tokens': self.burst, 'updated': now, 'interactive_at': None}
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['tokens'] = min(self.burst, state['tokens'] + elapsed * self.rate)
+        state['updated'] = now
+
+    def _reserve(self, state, nbytes, priority, now):
+        """Take ``nbytes`` if there are enough; otherwise return how long until there will be."""
+
+        self._refill(state, now)
+
+        cost = nbytes
+        if priority == INTERACTIVE:
+            state['interactive_at'] = now
+        elif state.get('interactive_at') is not None and now - state['interactive_at'] < INTERACTIVE_WINDOW:
+            cost = nbytes / self.batch_share
+
+        # Anything larger than the burst goes into debt, which the next
+        # reservation must wait out.
+        # (Within half a byte, as the refill is subject to rounding.)
+        shortfall = min(cost, self.burst) - state['tokens']
+        if shortfall > 0.5:
+            return shortfall / self.rate
+
+        state['tokens'] -= cost
+        return 0
+
+
+class _ProcessBucket(_Bucket):
+
+    def __init__(self, rate, burst, batch_share, now):
+        super(_ProcessBucket, self).__init__(rate, burst, batch_share)
+        self.state = self.new_state(now)
+
+    def reserve(self, nbytes, priority, now):
+        return self._reserve(self.state, nbytes, priority, now)
+
+
+class _HostBucket(_Bucket):
+
+    """A bucket shared between processes via a locked JSON file."""
+
+    def __init__(self, rate, burst, batch_share, path):
+        super(_HostBucket, self).__init__(rate, burst, batch_share)
+        self.path = path
+        self._warned = False
+
+    def _open(self):
+
+        directory = os.path.dirname(self.path)
+        try:
+            os.mkdir(directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            # Shared by every user on the host, like /tmp.
+            os.chmod(directory, _HOST_STATE_DIR_MODE)
+        if not stat.S_ISDIR(os.lstat(directory).st_mode):
+            raise IOError(errno.ENOTDIR, 'host IO state directory is not a directory', directory)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0666)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1:
+                raise IOError(errno.EINVAL, 'host IO state is not a plain file', self.path)
+            if st.st_uid == os.getuid():
+                # So that every user on the host may share it.
+                os.fchmod(fd, 0666)
+        except:
+            os.close(fd)
+            raise
+        return os.fdopen(fd, 'r+')
+
+    def _is_valid(self, state, now):
+        """Is state read from the (world-writable) file plausible?"""
+        try:
+            tokens = float(state['tokens'])
+            updated = float(state['updated'])
+            interactive_at = state.get('interactive_at')
+            interactive_at = None if interactive_at is None else float(interactive_at)
+        except (KeyError, TypeError, ValueError):
+            return False
+        # Written this way so that NaN is never valid.
+        return (
+            -_MAX_DEBT * self.rate <= tokens <= self.burst and
+            updated <= now + _MAX_CLOCK_SKEW and
+            (interactive_at is None or interactive_at <= now + _MAX_CLOCK_SKEW)
+        )
+
+    def reserve(self, nbytes, priority, now):
+        try:
+            fh = self._open()
+        except (IOError, OSError) as e:
+            # Better to copy without the host's limit than not at all.
+            if not self._warned:
+                log.warning('not limiting IO per host; cannot use %s: %s' % (self.path, e))
+                self._warned = True
+            return 0
+        with fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.loads(fh.read())
+                except ValueError:
+                    # New, or from an interrupted write.
+                    state = None
+                if not isinstance(state, dict) or not self._is_valid(state, now):
+                    if state is not None:
+                        log.warning('discarding implausible host IO state in %s' % self.path)
+                    state = self.new_state(now)
+                delay = self._reserve(state, nbytes, priority, now)
+                fh.seek(0)
+                fh.truncate()
+                fh.write(json.dumps(state))
+                fh.flush()
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+        return delay
+
+
+class _Waiter(object):
+
+    __slots__ = ('rank', 'seq', 'nbytes', 'priority', 'since')
+
+    def __init__(self, seq, nbytes, priority, since):
+        self.rank = PRIORITIES.index(priority)
+        self.seq = seq
+        self.nbytes = nbytes
+        self.priority = priority
+        self.since = since
+
+    def __lt__(self, other):
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+
+class IOScheduler(object):
+
+    """Grants bandwidth to copies in priority order, within the configured limits.
+
+    Takes the same arguments as :meth:`configure`.
+
+    """
+
+    def __init__(self, **kwargs):
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self.configure(**kwargs)
+
+    def configure(self, process_rate=None, host_rate=None, host_state_path=None,
+        burst=None, batch_share=None, clock=None, sleep=None
+    ):
+        """Set the limits; anything not given is unlimited or the default.
+
+        :param int process_rate: Bytes per second for this process.
+        :param int host_rate: Bytes per second for every process on this host.
+        :param str host_state_path: Where the host's bucket is kept; defaults
+            to :data:`DEFAULT_HOST_STATE_PATH`.
+        :param int burst: How many bytes may be copied at once after a lull;
+            defaults to one second's worth.
+        :param float batch_share: Defaults to :data:`DEFAULT_BATCH_SHARE`.
+        :param clock: Returns the current time in seconds; defaults to
+            :func:`time.time`. Must agree between processes sharing a host bucket.
+        :param sleep: Sleeps for the given number of seconds; defaults to
+            :func:`time.sleep`.
+
+        """
+        with self._cond:
+            self.clock = clock or time.time
+            self.sleep = sleep or time.sleep
+            self.process_rate = process_rate
+            self.host_rate = host_rate
+            batch_share = batch_share or DEFAULT_BATCH_SHARE
+            self._buckets = []
+            if process_rate:
+                self._buckets.append(_ProcessBucket(process_rate, burst, batch_share, self.clock()))
+            if host_rate:
+                self._buckets.append(_HostBucket(host_rate, burst, batch_share, host_state_path or DEFAULT_HOST_STATE_PATH))
+            self.bytes = 0
+            self.throttled = 0.0
+
+    @property
+    def active(self):
+        """Are there any limits?"""
+        return bool(self._buckets)
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """Set the priority of copies from this thread within the ``with``."""
+        if priority not in PRIORITIES:
+            raise ValueError('bad IO priority %r' % priority)
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def current_priority(self):
+        return getattr(self._local, 'priority', None) or DEFAULT_PRIORITY
+
+    def throttle(self, nbytes, priority=None):
+        """Block until ``nbytes`` may be transferred.
+
+        :param str priority: Defaults to that set by :meth:`priority`, or
+            :data:`DEFAULT_PRIORITY`.
+        :return: How long we were blocked for, in seconds.
+
+        """
+
+        buckets = self._buckets
+        if not buckets or not nbytes:
+            return 0
+
+        priority = priority or self.current_priority()
+        start = self.clock()
+
+        with self._cond:
+            waiter = _Waiter(next(self._seq), nbytes, priority, start)
+            heapq.heappush(self._waiting, waiter)
+            try:
+                while True:
+
+                    # Only the first in line may reserve anything.
+                    while self._waiting[0] is not waiter:
+                        self._cond.wait()
+
+                    # Buckets which are in debt are waited out (without the
+                    # lock, so that others may queue up behind us).
+                    for bucket in buckets:
+                        delay = bucket.reserve(nbytes, priority, self.clock())
+                        if delay:
+                            break
+                    if not delay:
+                        break
+                    self._cond.release()
+                    try:
+                        self.sleep(delay)
+                    finally:
+                        self._cond.acquire()
+
+                    # Our earlier reservations stand; only retry the rest.
+                    buckets = buckets[buckets.index(bucket):]
+
+            finally:
+                self._waiting.remove(waiter)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            elapsed = self.clock() - start
+            self.bytes += nbytes
+            self.throttled += elapsed
+
+        return elapsed
+
+    def status(self):
+        """A snapshot of the limits, and of what is waiting on them.
+
+        :return: ``{'process_rate': n, 'host_rate': n, 'bytes': n,
+            'throttled': seconds, 'waiting': {priority: n}, 'queue': [...]}``,
+            where the ``queue`` has the ``priority``, ``bytes``, and seconds
+            ``waited`` of each waiting copy, in the order they will proceed.
+
+        """
+        now = self.clock()
+        with self._cond:
+            queue = sorted(self._waiting)
+            status = {
+                'process_rate': self.process_rate,
+                'host_rate': self.host_rate,
+                'bytes': self.bytes,
+                'throttled': self.throttled,
+            }
+        status['waiting'] = dict((priority, sum(1 for w in queue if w.priority == priority)) for priority in PRIORITIES)
+        status['queue'] = [{
+            'priority': w.priority,
+            'bytes': w.nbytes,
+            'waited': now - w.since,
+        } for w in queue]
+        return status
+
+
+service = IOScheduler(
+    process_rate=_env_rate('SGPUBLISH_PROCESS_RATE'),
+    host_rate=_env_rate('SGPUBLISH_HOST_RATE'),
+)
+
+configure = service.configure
+priority = service.priority
+throttle = service.throttle
+status = service.status
@@ -0,0 +1,249 @@
+"""Empty PublishEvents created ahead of time, so publishes may start sooner.
+
+The first thing a :class:`~sgpublish.publisher.Publisher` does is create an
+"empty" PublishEvent (with an ``sg_version`` of ``0``), and it cannot make
+its directory until that round trip to Shotgun is done. When the pool is
+enabled, a few empty PublishEvents are kept ready for each project (and
+user) in the background, and a publisher claims one with an update instead,
+which is a much quicker request::
+
+    >>> sgpublish.stubs.pool.enabled = True
+
+Since stubs are claimed by whichever publisher asks first, this is only
+worthwhile in long-lived processes which publish repeatedly (e.g. the
+:mod:`~sgpublish.daemon`, or an artist's Maya session). A claimed stub keeps
+the ``created_at`` of when it was made.
+
+Stubs are given back to the pool if a claim could not be used (e.g. the
+batch it was in failed), retired if claiming them failed, and any which are
+left unclaimed when the process exits are retired. Since a process which
+crashes can't retire its stubs, the first :meth:`~StubPool.fill` for each
+project and user also retires any of theirs older than
+:attr:`~StubPool.stale_age`.
+
+"""
+
+import atexit
+import datetime
+import logging
+import threading
+
+from . import executor
+
+
+log = logging.getLogger(__name__)
+
+
+#: The ``code`` of PublishEvents which are waiting in the pool.
+STUB_CODE = '__sgpublish_stub__'
+
+#: How many stubs are kept ready for each project and user by default.
+DEFAULT_SIZE = 2
+
+#: How old (in seconds) unclaimed stubs must be before they are assumed to
+#: have been left by a process which crashed.
+DEFAULT_STALE_AGE = 24 * 60 * 60
+
+
+def update_fields(data):
+    """The fields to update a claimed stub with, given those it would be created with."""
+    data = dict(data)
+    # It already has these, and ``created_by`` can't be changed once made
+    # (which is why stubs are kept per user).
+    data.pop('created_by', None)
+    data.pop('project', None)
+    return data
+
+
+def _id(entity):
+    return entity['id'] if entity else None
+
+
+class StubPool(object):
+
+    """Empty PublishEvents which are ready to be claimed, by project and user.
+
+    Disabled by default; see the module docs.
+
+    :param bool enabled: Are stubs made and claimed?
+    :param int size: How many to keep ready for each project and user.
+    :param float stale_age: How old (in seconds) another process's stubs
+        must be before they are retired by :meth:`fill`.
+
+    """
+
+    def __init__(self, enabled=False, size=DEFAULT_SIZE, stale_age=DEFAULT_STALE_AGE):
+        self.enabled = enabled
+        self.size = size
+        self.stale_age = stale_age
+        self._lock = threading.Lock()
+        # {(project_id, user_id): [stub_ids]}
+        self._stubs = {}
+        # {(project_id, user_id): number being created}
+        self._pending = {}
+        # {(project_id, user_id): (session, project, created_by)} to refill and retire with.
+        self._sources = {}
+        # Keys which have been swept for stale stubs.
+        self._swept = set()
+        self._futures = []
+        self._atexit_registered = False
+        self.claimed = 0
+        self.missed = 0
+
+    def _key(self, project, created_by):
+        return (_id(project), _id(created_by))
+
+    def fill(self, session, project, created_by=None):
+        """Start making stubs for the project until there are :attr:`size` of them.
+
+        Called automatically after each claim; call it early (e.g. when a
+        tool is opened) so that the first publish may use the pool too. The
+        first call for each project and user also retires their stale stubs.
+
+        :return: A list of futures.
+
+        """
+
+        if not self.enabled or not project:
+            return []
+
+        key = self._key(project, created_by)
+        with self._lock:
+            self._sources[key] = (session, project, created_by)
+            sweep = key not in self._swept
+            self._swept.add(key)
+            needed = max(0, self.size - len(self._stubs.get(key, ())) - self._pending.get(key, 0))
+            if not (sweep or needed):
+                return []
+            self._pending[key] = self._pending.get(key, 0) + needed
+            if not self._atexit_registered:
+                atexit.register(self.retire)
+                self._atexit_registered = True
+
+        futures = []
+        if sweep:
+            futures.append(executor.submit('shotgun', self._sweep, session, project, created_by))
+        futures.extend(executor.submit('shotgun', self._create, key, session, project, created_by) for _ in xrange(needed))
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()]
+            self._futures.extend(futures)
+        return futures
+
+    def _sweep(self, session, project, created_by):
+        """Retire stubs which were left unclaimed by processes that crashed."""
+        filters = [
+            ('code', 'is', STUB_CODE),
+            ('project', 'is', project),
+            ('sg_version', 'is', 0),
+            ('created_at', 'less_than', datetime.datetime.now() - datetime.timedelta(seconds=self.stale_age)),
+        ]
+        if created_by:
+            filters.append(('created_by', 'is', created_by))
+        try:
+            stale = session.find('PublishEvent', filters)
+        except Exception:
+            log.warning('could not find stale PublishEvent stubs', exc_info=True)
+            return
+        with self._lock:
+            ours = set(id_ for ids in self._stubs.itervalues() for id_ in ids)
+        for entity in stale:
+            if entity['id'] not in ours:
+                self.discard(session, entity['id'])
+
+    def _create(self, key, session, project, created_by):
+        try:
+            data = {
+                'code': STUB_CODE,
+                'project': project,
+                'sg_version': 0, # Signifies that this is "empty".
+            }
+            if created_by:
+                data['created_by'] = created_by
+            entity = session.create('PublishEvent', data)
+        except Exception:
+            log.warning('could not create PublishEvent stub', exc_info=True)
+            with self._lock:
+                self._pending[key] -= 1
+            return
+        with self._lock:
+            self._pending[key] -= 1
+            self._stubs.setdefault(key, []).append(entity['id'])
+        return entity['id']
+
+    def claim(self, session, project, created_by=None):
+        """Take a stub for the given project and user, if one is ready.
+
+        Either way, the pool is then refilled in the background.
+
+        :return: The ID of the stub, or ``None``.
+
+        """
+
+        if not self.enabled or not project:
+            return
+
+        key = self._key(project, created_by)
+        with self._lock:
+            stubs = self._stubs.get(key)
+            id_ = stubs.pop(0) if stubs else None
+            if id_:
+                self.claimed += 1
+            else:
+                self.missed += 1
+
+        self.fill(session, project, created_by)
+        return id_
+
+    def release(self, project, created_by, id_):
+        """Give back a claimed stub which was not used (i.e. not updated)."""
+        key = self._key(project, created_by)
+        with self._lock:
+            self._stubs.setdefault(key, []).insert(0, id_)
+
+    def discard(self, session, id_):
+        """Retire a claimed stub which could not be used (e.g. the claim failed)."""
+        try:
+            session.delete('PublishEvent', id_)
+        except Exception:
+            log.warning('could not retire PublishEvent stub %d' % id_, exc_info=True)
+        else:
+            log.debug('retired PublishEvent stub %d' % id_)
+
+    def retire(self):
+        """Retire every stub in the pool from Shotgun.
+
+        Waits for those still being made; called when the process exits.
+
+        """
+
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+        with self._lock:
+            stubs = self._stubs
+            self._stubs = {}
+
+        for key, ids in stubs.iteritems():
+            session = self._sources[key][0]
+            for id_ in ids:
+                self.discard(session, id_)
+
+    def status(self):
+        """``{'ready': n, 'pending': n, 'claimed': n, 'missed': n}``"""
+        with self._lock:
+            return {
+                'ready': sum(len(ids) for ids in self._stubs.itervalues()),
+                'pending': sum(self._pending.itervalues()),
+                'claimed': self.claimed,
+                'missed': self.missed,
+            }
+
+
+#: The process-wide :class:`StubPool`.
+pool = StubPool()
@@ -0,0 +1,83 @@
+"""Preparing thumbnails for upload.
+
+Exporters often provide a full resolution frame as the thumbnail, which is
+far larger than Shotgun will ever display. :func:`downscale` writes a copy
+which is no larger than :data:`MAX_SIZE`; this requires PIL (or Pillow), and
+without it thumbnails are copied verbatim.
+
+The digest of the prepared thumbnail is saved in the publish's tag metadata,
+so that later publishes with an identical thumbnail (e.g. republishes via a
+``template``) may share the existing one instead of uploading it again.
+
+"""
+
+import errno
+import logging
+import os
+import shutil
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+
+log = logging.getLogger(__name__)
+
+
+#: The default maximum width and height of thumbnails, in pixels.
+MAX_SIZE = 640
+
+# Formats which can't store an alpha channel (or a palette, etc.).
+_rgb_only_exts = set(('.jpg', '.jpeg'))
+
+
+def image_size(path):
+    """The ``(width, height)`` of an image, or ``None`` if it can't be read.
+
+    Only the header of the image is read.
+
+    """
+    if Image is None:
+        return
+    try:
+        return Image.open(path).size
+    except (IOError, ValueError):
+        return
+
+
+def downscale(src_path, dst_path, max_size=None):
+    """Write a copy of an image which fits within ``max_size`` pixels square.
+
+    Images which are already small enough, which cannot be read, or which
+    cannot be scaled because PIL is not available, are copied verbatim.
+
+    :param int max_size: Defaults to :data:`MAX_SIZE`.
+    :return: ``True`` if the image was scaled.
+
+    """
+
+    max_size = max_size or MAX_SIZE
+
+    if Image is not None:
+        try:
+            image = Image.open(src_path)
+            if max(image.size) > max_size:
+                image.thumbnail((max_size, max_size), getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS)
+                if os.path.splitext(dst_path)[1].lower() in _rgb_only_exts and image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.save(dst_path)
+                return True
+        except (IOError, ValueError, KeyError) as e:
+            log.warning('could not downscale %s: %s' % (src_path, e))
+            try:
+                os.unlink(dst_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    shutil.copyfile(src_path, dst_path)
+    return False
@@ -0,0 +1,240 @@
+"""Timings of each phase of a publish.
+
+Every :class:`~sgpublish.publisher.Publisher` records how long each phase of
+its life took (e.g. creating the stub, copying files, tagging the directory)
+in its :attr:`~sgpublish.publisher.Publisher.timings`, along with the bytes
+and files involved where relevant. They are saved into the publish's tag
+metadata, and once the commit is done (or has failed) they are passed to
+every registered hook::
+
+    >>> from sgpublish import timing
+    >>> timing.add_hook(timing.StatsdHook(('statsd.example.com', 8125)))
+
+A hook is any callable which takes the publisher and its :class:`Timings`.
+
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import socket
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Span(object):
+
+    """One timed phase."""
+
+    __slots__ = ('name', 'start', 'elapsed', 'bytes', 'files', 'ok')
+
+    def __init__(self, name, start, bytes=None, files=None):
+        self.name = name
+        self.start = start
+        self.elapsed = None
+        self.bytes = bytes
+        self.files = files
+        self.ok = True
+
+    def __repr__(self):
+        return '<Span %s %.3fs>' % (self.name, self.elapsed or 0)
+
+    def as_dict(self):
+        data = {'name': self.name, 'start': self.start, 'elapsed': self.elapsed}
+        for key in ('bytes', 'files'):
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        if not self.ok:
+            data['ok'] = False
+        return data
+
+
+class Timings(object):
+
+    """The timed phases of one publish, in the order they completed.
+
+    Phases which may run concurrently are each recorded as they complete, so
+    their elapsed times may sum to more than the wall time of the publish.
+
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(list(self.spans))
+
+    def __getitem__(self, name):
+        """The total elapsed time of the named phase."""
+        spans = [span for span in self if span.name == name]
+        if not spans:
+            raise KeyError(name)
+        return sum(span.elapsed for span in spans)
+
+    def __contains__(self, name):
+        return any(span.name == name for span in self)
+
+    @contextlib.contextmanager
+    def span(self, name, bytes=None, files=None):
+        """Time the body of the ``with``; the :class:`Span` may be updated within it."""
+        span = Span(name, time.time(), bytes, files)
+        try:
+            yield span
+        except:
+            span.ok = False
+            raise
+        finally:
+            span.elapsed = time.time() - span.start
+            with self._lock:
+                self.spans.append(span)
+
+    def wrap(self, name, func):
+        """Return a function which times calls to ``func``, e.g. for a pool."""
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return _timed
+
+    def as_list(self):
+        """The spans as ``dict`` objects, e.g. for metadata."""
+        return [span.as_dict() for span in self]
+
+    def __str__(self):
+        parts = []
+        for span in self:
+            part = '%s %.3fs' % (span.name, span.elapsed)
+            counts = []
+            if span.files is not None:
+                counts.append('%d files' % span.files)
+            if span.bytes is not None:
+                counts.append('%.1f MB' % (span.bytes / 1048576.0))
+            if counts:
+                part += ' (%s)' % ', '.join(counts)
+            if not span.ok:
+                part += ' FAILED'
+            parts.append(part)
+        return ', '.join(parts)
+
+
+def timed(name):
+    """Decorate a method to record a span in its instance's ``timings``."""
+    def _decorator(func):
+        @functools.wraps(func)
+        def _timed(self, *args, **kwargs):
+            with self.timings.span(name):
+                return func(self, *args, **kwargs)
+        return _timed
+    return _decorator
+
+
+#: Callables which are given ``(publisher, timings)`` once a commit is done.
+hooks = []
+
+
+def add_hook(hook):
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def emit(publisher):
+    """Pass the publisher's timings to every hook; errors are only logged."""
+    for hook in list(hooks):
+        try:
+            hook(publisher, publisher.timings)
+        except Exception:
+            log.exception('error in timing hook %r' % hook)
+
+
+def _describe(publisher):
+    entity = getattr(publisher, 'entity', None) or {}
+    # The publish may have failed before any of these were known.
+    return {
+        'id': entity.get('id'),
+        'type': getattr(publisher, 'type', None),
+        'name': getattr(publisher, 'name', None),
+        'version': getattr(publisher, 'version', None),
+        'directory': getattr(publisher, 'directory', None),
+    }
+
+
+class LoggingHook(object):
+
+    """Log the timings of each publish as a single line."""
+
+    def __init__(self, level=logging.INFO, logger=log):
+        self.level = level
+        self.logger = logger
+
+    def __call__(self, publisher, timings):
+        info = _describe(publisher)
+        self.logger.log(self.level, 'timings of %s %s v%s (PublishEvent %s): %s' % (
+            info['type'], info['name'], info['version'], info['id'], timings,
+        ))
+
+
+class JSONLinesHook(object):
+
+    """Append the timings of each publish to a file as one JSON object per line.
+
+    :param str path: The file to append to.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, publisher, timings):
+        record = _describe(publisher)
+        record['spans'] = timings.as_list()
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as fh:
+                fh.write(line)
+
+
+class StatsdHook(object):
+
+    """Send the timings of each publish to a statsd server over UDP.
+
+    Every phase is sent as a timer named ``<prefix>.<type>.<phase>``, and
+    its bytes and files (if any) as counters of the same name with
+    ``.bytes`` and ``.files`` appended.
+
+    :param tuple address: ``(host, port)`` of the server.
+    :param str prefix: Prepended to every metric name.
+
+    """
+
+    def __init__(self, address=('localhost', 8125), prefix='sgpublish'):
+        self.address = address
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _lines(self, publisher, timings):
+        base = '%s.%s' % (self.prefix, _describe(publisher)['type'])
+        for span in timings:
+            name = '%s.%s' % (base, span.name)
+            yield '%s:%d|ms' % (name, int(span.elapsed * 1000))
+            if span.bytes is not None:
+                yield '%s.bytes:%d|c' % (name, span.bytes)
+            if span.files is not None:
+                yield '%s.files:%d|c' % (name, span.files)
+
+    def __call__(self, publisher, timings):
+        for line in self._lines(publisher, timings):
+            try:
+                self._socket.sendto(line, self.address)
+            except socket.error as e:
+                log.debug('could not send to statsd: %s' % e)
+                return
@@ -1,10 +1,17 @@
 import errno
+import hashlib
+import itertools
 import os
 import re
 import re
 import glob
 from shutil import copy
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 
 def makedirs(path):
     try:
@@ -14,6 +21,70 @@ def makedirs(path):
             raise
 
 
+def make_unique_directory(base_path):
+    """Create a new directory at ``base_path``, or ``base_path_N`` for the
+    lowest ``N`` which is free.
+
+    The parent is listed once to find the first free name, so that the cost
+    does not grow with the number of existing siblings. If we lose a race to
+    create it, we fall back to probing the following names.
+
+    :return: The path of the created directory.
+
+    """
+
+    parent, base_name = os.path.split(base_path)
+    try:
+        existing = set(os.listdir(parent))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        existing = set()
+
+    names = itertools.chain([base_name], ('%s_%d' % (base_name, i) for i in itertools.count(1)))
+    for name in names:
+        if name in existing:
+            continue
+        path = os.path.join(parent, name)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            return path
+
+
+def new_hasher(algorithm='sha256'):
+    """Get a hash object for the given algorithm.
+
+    Anything supported by :mod:`hashlib`, or ``"xxhash"`` if the
+    `xxhash <https://pypi.python.org/pypi/xxhash>`_ package is installed.
+
+    """
+    if algorithm in ('xxhash', 'xxh64'):
+        if xxhash is None:
+            raise ValueError('xxhash is not installed')
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def update_hasher(hasher, path, chunk_size=1048576):
+    """Feed the contents of the given file into a hash object."""
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+
+def hash_file(path, algorithm='sha256', chunk_size=1048576):
+    """Get the hex digest of the given file's contents."""
+    return update_hasher(new_hasher(algorithm), path, chunk_size).hexdigest()
+
+
 def strip_version(name):
     return re.sub(r'_v\d+(_r\d+)', '', name)
 
@@ -1,7 +1,8 @@
-from concurrent.futures import ThreadPoolExecutor
-
 from sgfs import SGFS
 
+from . import executor
+from . import metadata
+
 
 def promote_publish(publish, **kwargs):
     
@@ -39,10 +40,12 @@ def promote_publish(publish, **kwargs):
 
     # Look up Maya frame information from the tag.
     sgfs = SGFS(session=publish.session)
-    tags = sgfs.get_directory_entity_tags(sgfs.path_for_entity(publish))
-    if tags and 'maya' in tags[0]:
-        min_time = tags[0]['maya']['min_time']
-        max_time = tags[0]['maya']['max_time']
+    path = sgfs.path_for_entity(publish)
+    tags = sgfs.get_directory_entity_tags(path)
+    maya_data = metadata.inflate(tags[0], path, missing_ok=True).get('maya') if tags else None
+    if maya_data and 'min_time' in maya_data and 'max_time' in maya_data:
+        min_time = maya_data['min_time']
+        max_time = maya_data['max_time']
         fields.update({
             'sg_first_frame': int(min_time),
             'sg_last_frame': int(max_time),
@@ -60,36 +63,35 @@ def promote_publish(publish, **kwargs):
         version = sgfs.session.create('Version', fields)
     
     futures = []
-    with ThreadPoolExecutor(4) as executor:
-        
-        # Share thumbnails.
-        futures.append(executor.submit(sgfs.session.share_thumbnail,
-            entities=[version.minimal],
-            source_entity=publish.minimal,
-        ))
-    
-        # Set the status/version on the task.
-        futures.append(executor.submit(sgfs.session.update,
-            'Task',
-            publish['sg_link']['id'],
-            {
-                'sg_status_list': 'rev',
-                'sg_latest_version': version,
-            },
+
+    # Share thumbnails.
+    futures.append(executor.submit('shotgun', sgfs.session.share_thumbnail,
+        entities=[version.minimal],
+        source_entity=publish.minimal,
+    ))
+
+    # Set the status/version on the task.
+    futures.append(executor.submit('shotgun', sgfs.session.update,
+        'Task',
+        publish['sg_link']['id'],
+        {
+            'sg_status_list': 'rev',
+            'sg_latest_version': version,
+        },
+    ))
+
+    # Set the latest version on the entity.
+    entity = publish['sg_link'].fetch('entity')
+    if entity['type'] in ('Asset', 'Shot'):
+        futures.append(executor.submit('shotgun', sgfs.session.update,
+            entity['type'],
+            entity['id'],
+            {'sg_latest_version': version},
         ))
-    
-        # Set the latest version on the entity.
-        entity = publish['sg_link'].fetch('entity')
-        if entity['type'] in ('Asset', 'Shot'):
-            futures.append(executor.submit(sgfs.session.update,
-                entity['type'],
-                entity['id'],
-                {'sg_latest_version': version},
-            ))
 
-        # Allow them to raise if they must.
-        for future in futures:
-            future.result()
+    # Allow them to raise if they must.
+    for future in futures:
+        future.result()
     
     return version
 
@@ -0,0 +1,100 @@
+"""Parallel enumeration of directory trees.
+
+Listing a tree of many thousands of frames on a network filesystem is bound
+by the latency of each directory listing, so :func:`walk` lists several
+directories at once on the shared ``"io"`` pool (see :mod:`sgpublish.executor`),
+and yields their contents as soon as they are known instead of collecting
+the whole tree first.
+
+Entries are classified without a ``stat`` of each file where the platform
+allows it, via ``scandir`` (the builtin ``os.scandir``, or the ``scandir``
+package on older Pythons); otherwise every entry is ``lstat``-ed.
+
+"""
+
+import collections
+import logging
+import os
+import stat
+
+from . import executor
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+
+log = logging.getLogger(__name__)
+
+
+def _kind_from_mode(mode):
+    if stat.S_ISLNK(mode):
+        return 'link'
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    if stat.S_ISREG(mode):
+        return 'file'
+
+
+def _scandir(path):
+    for entry in scandir(path):
+        if entry.is_symlink():
+            kind = 'link'
+        elif entry.is_dir(follow_symlinks=False):
+            kind = 'dir'
+        elif entry.is_file(follow_symlinks=False):
+            kind = 'file'
+        else:
+            kind = None
+        yield entry.name, kind
+
+
+def _listdir(path):
+    for name in os.listdir(path):
+        yield name, _kind_from_mode(os.lstat(os.path.join(path, name)).st_mode)
+
+
+def _scan(path):
+    entries = []
+    for name, kind in (_scandir if scandir is not None else _listdir)(path):
+        entry_path = os.path.join(path, name)
+        if kind is None:
+            log.warning('skipping special file %s' % entry_path)
+            continue
+        entries.append((entry_path, kind))
+    entries.sort()
+    return path, entries
+
+
+def walk(root, max_workers=None):
+    """Yield ``(path, kind)`` for everything within ``root`` (inclusive).
+
+    ``kind`` is one of ``"dir"``, ``"file"``, or ``"link"``; symlinks are
+    never followed, and anything else (e.g. sockets) is skipped. Every
+    directory is yielded before anything within it, followed by its files
+    and links; its subdirectories follow later.
+
+    :param int max_workers: The maximum number of directories to list at
+        once; defaults to the size of the ``"io"`` pool.
+
+    """
+
+    max_workers = max_workers or executor.max_workers('io')
+    pending = collections.deque([root])
+    in_flight = collections.deque()
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_workers:
+                in_flight.append(executor.submit('io', _scan, pending.popleft()))
+            path, entries = in_flight.popleft().result()
+            yield path, 'dir'
+            for entry_path, kind in entries:
+                if kind == 'dir':
+                    pending.append(entry_path)
+                else:
+                    yield entry_path, kind
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -21,7 +21,7 @@ else:
 from sgsession import Session, Entity
 
 from sgfs import SGFS
-from sgpublish import Publisher
+from sgpublish import Publisher, publish_many
 
 from mayatools.test import requires_maya
 
@@ -84,3 +84,30 @@ class TestCase(BaseTestCase):
             os.makedirs(path)
         return path
 
+
+class PublishTestCase(TestCase):
+
+    """A project with a task to publish to, and an SGFS rooted in the sandbox."""
+
+    def setUp(self):
+
+        sg = Shotgun()
+        self.sg = self.fix = fix = Fixture(sg)
+
+        self.proj_name = 'Test Project ' + mini_uuid()
+        proj = fix.Project(self.proj_name)
+        seq = proj.Sequence('AA', project=proj)
+        shot = seq.Shot('AA_001', project=proj)
+        step = fix.find_or_create('Step', code='Anm', short_name='Anm')
+        task = shot.Task('Animate Something', step=step, entity=shot, project=proj)
+
+        self.proj = minimal(proj)
+        self.seq = minimal(seq)
+        self.shot = minimal(shot)
+        self.step = minimal(step)
+        self.task = minimal(task)
+
+        self.session = Session(self.sg)
+        self.sgfs = SGFS(root=self.sandbox, session=self.session, schema_name='testing')
+
+        self.sgfs.create_structure([self.task], allow_project=True)
@@ -1,33 +1,12 @@
 from common import *
 
+import mock
+
+from sgpublish.asyncpublisher import AsyncPublisher
+
 
     
-class TestBasicPublisher(TestCase):
-    
-    def setUp(self):
-        
-        sg = Shotgun()
-        self.sg = self.fix = fix = Fixture(sg)
-        
-        self.proj_name = 'Test Project ' + mini_uuid()
-        proj = fix.Project(self.proj_name)
-        seq = proj.Sequence('AA', project=proj)
-        shot = seq.Shot('AA_001', project=proj)
-        step = fix.find_or_create('Step', code='Anm', short_name='Anm')
-        task = shot.Task('Animate Something', step=step, entity=shot, project=proj)
-        
-        self.proj = minimal(proj)
-        self.seq = minimal(seq)
-        self.shot = minimal(shot)
-        self.step = minimal(step)
-        self.task = minimal(task)
-
-        self.session = Session(self.sg)
-        self.sgfs = SGFS(root=self.sandbox, session=self.session, schema_name='testing')
-        
-        self.sgfs.create_structure([self.task], allow_project=True)
-        
-        self = None
+class TestBasicPublisher(PublishTestCase):
     
     def test_basic_publish(self):
         
@@ -92,3 +71,224 @@ class TestBasicPublisher(TestCase):
         self.assertEqual(republish.fetch('sg_source_publishes'), [template])
 
 
+
+    def test_publish_many(self):
+
+        paths = []
+        for i in xrange(3):
+            path = os.path.join(self.sandbox, 'many_%d.txt' % i)
+            open(path, 'w').write('file %d' % i)
+            paths.append(path)
+
+        results = publish_many([
+            dict(name='test_publish_many_%d' % i, type='generic', link=self.task, files=[path])
+            for i, path in enumerate(paths)
+        ] + [
+            # This one must fail on its own.
+            dict(name='bad name', type='generic', link=self.task),
+        ], sgfs=self.sgfs)
+
+        self.assertEqual([r.ok for r in results], [True, True, True, False])
+        for i, result in enumerate(results[:3]):
+            publish = self.session.find_one('PublishEvent', [('id', 'is', result.publisher.id)], ['code', 'sg_version'])
+            self.assertEqual(publish['code'], 'test_publish_many_%d' % i)
+            self.assertEqual(publish['sg_version'], 1)
+            self.assertTrue(os.path.exists(os.path.join(result.publisher.directory, 'many_%d.txt' % i)))
+
+    def test_automatic_versions(self):
+
+        for expected in (1, 2, 3):
+            with Publisher(name='test_automatic_versions', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+                pass
+            self.assertEqual(publisher.version, expected)
+            self.assertEqual(publisher.entity.fetch('sg_version'), expected)
+
+        # The parent is the previous version.
+        self.assertEqual(publisher._parent['sg_version'], 2)
+
+    def test_async_publish(self):
+
+        data_file = os.path.join(self.sandbox, 'async_file.txt')
+        open(data_file, 'w').write('this is a dummy file')
+
+        publisher = AsyncPublisher(name='test_async_publish', type='generic', link=self.task, sgfs=self.sgfs)
+        publisher.create()
+        dst_path = publisher.add_file(data_file)
+        entity = publisher.commit().result(timeout=30)
+
+        self.assertEqual(entity['id'], publisher.publisher.id)
+        self.assertEqual(self.session.find_one('PublishEvent', [('id', 'is', entity['id'])]).fetch('sg_version'), 1)
+        self.assertTrue(os.path.exists(dst_path.result()))
+
+    def test_async_failed_stage(self):
+
+        data_file = os.path.join(self.sandbox, 'async_failed_file.txt')
+        open(data_file, 'w').write('this is a dummy file')
+
+        publisher = AsyncPublisher(name='test_async_failed_stage', type='generic', link=self.task, sgfs=self.sgfs)
+        publisher.create()
+        publisher.add_file(data_file)
+        # Already exists in the publish.
+        publisher.add_file(data_file)
+        commit = publisher.commit()
+
+        self.assertTrue(isinstance(commit.exception(timeout=30), ValueError))
+        self.assertFalse(publisher.publisher.entity.get('sg_version'))
+        publisher.rollback().result(timeout=30)
+
+    def test_timings(self):
+
+        import json
+
+        from sgpublish import timing
+
+        data_file = os.path.join(self.sandbox, 'timed_file.txt')
+        open(data_file, 'w').write('this is a dummy file')
+
+        emitted = []
+        json_path = os.path.join(self.sandbox, 'timings_%s.jsonl' % mini_uuid())
+        hooks = [lambda publisher, timings: emitted.append(timings), timing.JSONLinesHook(json_path)]
+        for hook in hooks:
+            timing.add_hook(hook)
+        try:
+            with Publisher(name='test_timings', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+                publisher.add_file(data_file)
+        finally:
+            for hook in hooks:
+                timing.remove_hook(hook)
+
+        self.assertEqual(emitted, [publisher.timings])
+        for name in ('create', 'version', 'directory', 'copy', 'update', 'tag'):
+            self.assertTrue(name in publisher.timings, name)
+        copy_span = [span for span in publisher.timings if span.name == 'copy'][0]
+        self.assertEqual(copy_span.files, 1)
+        self.assertEqual(copy_span.bytes, len('this is a dummy file'))
+
+        tags = self.sgfs.get_directory_entity_tags(publisher.directory)
+        names = [span['name'] for span in tags[0]['sgpublish']['timings']]
+        self.assertTrue('copy' in names)
+        self.assertFalse('tag' in names)
+
+        record = json.loads(open(json_path).read())
+        self.assertEqual(record['id'], publisher.id)
+
+    def test_fix_permissions(self):
+
+        import stat
+
+        from sgpublish import permissions
+
+        data_file = os.path.join(self.sandbox, 'permissions_file.txt')
+        open(data_file, 'w').write('this is a dummy file')
+
+        with mock.patch.object(permissions, 'fix_tree', wraps=permissions.fix_tree) as fix_tree:
+
+            # Everything was placed by the copier, so there is nothing to scan.
+            with Publisher(name='test_fix_permissions', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+                publisher.add_file(data_file)
+            self.assertFalse(fix_tree.called)
+
+            # But the directory was handed out, so anything may be in there.
+            with Publisher(name='test_fix_permissions', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+                open(os.path.join(publisher.directory, 'exported.txt'), 'w').write('exported')
+            self.assertEqual(fix_tree.call_count, 1)
+
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(publisher.directory, 'exported.txt')).st_mode), 0444)
+
+    def test_copy_strategies(self):
+
+        from sgpublish import copier
+        from sgpublish import publisher as publisher_module
+
+        data_file = os.path.join(self.sandbox, 'moved_%s.txt' % mini_uuid())
+        open(data_file, 'w').write('this is a dummy file')
+
+        with mock.patch.object(copier, 'same_device', return_value=False):
+            with mock.patch.object(publisher_module.log, 'info') as info:
+                with Publisher(name='test_copy_strategies', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+                    dst_path = publisher.add_file(data_file, method='move')
+
+        strategies = dict(publisher.copy_strategies)
+        self.assertEqual(sum(strategies.itervalues()), 1)
+        strategy = strategies.keys()[0]
+        self.assertTrue(strategy.endswith('+delete'), strategy)
+        info.assert_any_call('moved %s via %s' % (dst_path, strategy))
+
+    def test_thumbnail_reuse(self):
+
+        thumbnail_path = os.path.join(self.sandbox, 'thumbnail_%s.png' % mini_uuid())
+        open(thumbnail_path, 'wb').write('not really a png')
+
+        self.session.upload_thumbnail = Mock()
+        self.session.share_thumbnail = Mock()
+
+        with Publisher(name='test_thumbnail_reuse', type='generic', link=self.task, sgfs=self.sgfs, thumbnail_path=thumbnail_path) as first:
+            pass
+        self.assertEqual(self.session.upload_thumbnail.call_count, 1)
+        self.assertFalse(self.session.share_thumbnail.called)
+
+        # A copy is in the publish.
+        tags = self.sgfs.get_directory_entity_tags(first.directory)
+        meta = tags[0]['sgpublish']
+        self.assertEqual(open(os.path.join(first.directory, meta['thumbnail'])).read(), 'not really a png')
+
+        # Republishing shares the identical thumbnail instead of uploading it.
+        with Publisher(template=first.entity, sgfs=self.sgfs) as second:
+            pass
+        self.assertEqual(self.session.upload_thumbnail.call_count, 1)
+        self.session.share_thumbnail.assert_called_once_with([second.entity.minimal], source_entity=first.entity.minimal)
+        self.assertEqual(self.sgfs.get_directory_entity_tags(second.directory)[0]['sgpublish']['thumbnail_digest'], meta['thumbnail_digest'])
+
+    def test_template_cache(self):
+
+        from sgpublish.publisher import template_cache
+        template_cache.enabled = True
+        self.addCleanup(setattr, template_cache, 'enabled', False)
+        self.addCleanup(template_cache.clear)
+
+        thumbnail_path = os.path.join(self.sandbox, 'thumbnail_%s.png' % mini_uuid())
+        open(thumbnail_path, 'wb').write('not really a png')
+        self.session.upload_thumbnail = Mock()
+        self.session.share_thumbnail = Mock()
+
+        with Publisher(name='test_template_cache', type='generic', link=self.task, sgfs=self.sgfs, thumbnail_path=thumbnail_path) as first:
+            first.description = 'the template'
+
+        for i in xrange(2):
+            with Publisher(template=first.entity, sgfs=self.sgfs) as derived:
+                pass
+            self.assertEqual(derived.description, 'the template')
+            self.assertEqual(os.path.basename(derived.thumbnail_path), os.path.basename(first.thumbnail_path))
+
+            cached = template_cache.get(self.session.merge(first.entity))
+            self.assertEqual(cached['fields']['code'], 'test_template_cache')
+            self.assertEqual(cached['path'], first.directory)
+            self.assertTrue(cached['meta']['thumbnail'])
+
+    def test_background_commit(self):
+
+        data_file = os.path.join(self.sandbox, 'background_file.txt')
+        open(data_file, 'w').write('this is a dummy file')
+
+        progress = []
+        with Publisher(name='test_background_commit', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+            publisher.add_file(data_file)
+            future = publisher.commit(background=True, progress_callback=lambda *args: progress.append(args))
+
+        # The context did not commit again.
+        entity = future.result(timeout=30)
+        self.assertEqual(entity['id'], publisher.id)
+        self.assertEqual(self.session.find_one('PublishEvent', [('id', 'is', publisher.id)], ['sg_version'])['sg_version'], 1)
+        self.assertTrue(('copy', 1, 1) in progress)
+        self.assertEqual(progress[-1], ('done', None, None))
+
+    def test_background_commit_failure(self):
+
+        errors = []
+        publisher = Publisher(name='test_background_failure', type='generic', link=self.task, sgfs=self.sgfs)
+        publisher.add_file(os.path.join(self.sandbox, 'does_not_exist_%s' % mini_uuid()))
+        future = publisher.commit(background=True, error_callback=errors.append)
+
+        self.assertTrue(future.exception(timeout=30) is not None)
+        self.assertEqual(errors, [future.exception()])
+        self.assertTrue(publisher.directory.endswith('.failed'))
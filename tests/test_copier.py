@@ -0,0 +1,303 @@
+from common import *
+
+import stat
+
+import mock
+
+from sgpublish import manifest
+from sgpublish import permissions
+from sgpublish.blobstore import BlobStore
+from sgpublish import copier
+from sgpublish.copier import Copier, copy_file, chunked_copy
+
+
+class TestCopier(TestCase):
+
+    def setUp(self):
+        self.src = os.path.join(self.sandbox, mini_uuid(), 'src')
+        self.dst = os.path.join(self.sandbox, mini_uuid(), 'dst')
+        os.makedirs(self.src)
+
+    def test_parallel_copy(self):
+
+        copier = Copier(max_workers=4, batch_size=3)
+        for i in xrange(20):
+            name = 'frame.%04d.exr' % i
+            open(os.path.join(self.src, name), 'w').write('frame %d' % i)
+            copier.add(os.path.join(self.src, name), os.path.join(self.dst, 'sub%d' % (i % 2), name))
+
+        self.assertEqual(len(copier), 20)
+        stats = copier.run()
+
+        self.assertEqual(stats.files, 20)
+        self.assertEqual(stats.bytes, sum(len('frame %d' % i) for i in xrange(20)))
+        for i in xrange(20):
+            name = 'frame.%04d.exr' % i
+            self.assertEqual(open(os.path.join(self.dst, 'sub%d' % (i % 2), name)).read(), 'frame %d' % i)
+
+    def test_failure_raises(self):
+
+        copier = Copier()
+        copier.add(os.path.join(self.src, 'does_not_exist'), os.path.join(self.dst, 'x'))
+        self.assertRaises(OSError, copier.run)
+
+    def test_methods(self):
+
+        src_path = os.path.join(self.src, 'data')
+        open(src_path, 'w').write('data')
+        os.makedirs(self.dst)
+
+        for method in ('copy', 'link', 'reflink', 'auto'):
+            dst_path = os.path.join(self.dst, method)
+            strategy, size = copy_file(src_path, dst_path, method)
+            self.assertEqual(size, 4)
+            self.assertEqual(open(dst_path).read(), 'data')
+
+        # Hardlinks share the inode, whereas everything else must not.
+        self.assertEqual(os.stat(src_path).st_ino, os.stat(os.path.join(self.dst, 'link')).st_ino)
+        self.assertNotEqual(os.stat(src_path).st_ino, os.stat(os.path.join(self.dst, 'auto')).st_ino)
+
+    def test_blob_store(self):
+
+        store = BlobStore(os.path.join(self.sandbox, mini_uuid(), 'blobs'))
+        for name in 'ab':
+            open(os.path.join(self.src, name), 'w').write('identical')
+
+        # The store is shared with the project, whatever our umask.
+        umask = os.umask(022)
+        try:
+            copier = Copier(blob_store=store)
+            copier.add(os.path.join(self.src, 'a'), os.path.join(self.dst, 'a'))
+            copier.add(os.path.join(self.src, 'b'), os.path.join(self.dst, 'b'))
+            copier.run()
+        finally:
+            os.umask(umask)
+
+        digest = copier.digests[os.path.join(self.dst, 'a')]
+        self.assertEqual(copier.digests[os.path.join(self.dst, 'b')], digest)
+        self.assertTrue(digest in store)
+
+        # Both are hardlinks to the one blob.
+        blob_ino = os.stat(store.path_for_digest(digest)).st_ino
+        self.assertEqual(os.stat(os.path.join(self.dst, 'a')).st_ino, blob_ino)
+        self.assertEqual(os.stat(os.path.join(self.dst, 'b')).st_ino, blob_ino)
+
+        blob_dir = os.path.dirname(store.path_for_digest(digest))
+        self.assertEqual(stat.S_IMODE(os.stat(blob_dir).st_mode), 02775)
+        self.assertEqual(stat.S_IMODE(os.stat(store.root).st_mode), 02775)
+        self.assertEqual(stat.S_IMODE(os.stat(store.path_for_digest(digest)).st_mode), 0444)
+
+    def test_delta(self):
+
+        for name in 'ab':
+            open(os.path.join(self.src, name), 'w').write(name)
+
+        v1 = os.path.join(self.dst, 'v1')
+        copier = Copier()
+        for name in 'ab':
+            copier.add(os.path.join(self.src, name), os.path.join(v1, name))
+        copier.run()
+
+        open(os.path.join(self.src, 'b'), 'w').write('changed')
+
+        v2 = os.path.join(self.dst, 'v2')
+        copier = Copier(delta_from=v1, delta_root=v2)
+        for name in 'ab':
+            copier.add(os.path.join(self.src, name), os.path.join(v2, name))
+        copier.run()
+
+        self.assertEqual(copier.reused, [os.path.join(v2, 'a')])
+        self.assertEqual(os.stat(os.path.join(v1, 'a')).st_ino, os.stat(os.path.join(v2, 'a')).st_ino)
+        self.assertEqual(open(os.path.join(v2, 'b')).read(), 'changed')
+
+    def test_read_only(self):
+
+        open(os.path.join(self.src, 'data'), 'w').write('data')
+        os.makedirs(self.dst)
+
+        copier = Copier(read_only=True)
+        copier.add(os.path.join(self.src, 'data'), os.path.join(self.dst, 'sub', 'data'))
+        copier.run()
+
+        # Something the copier didn't place.
+        open(os.path.join(self.dst, 'exported'), 'w').write('exported')
+
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, 'sub', 'data')).st_mode), 0444)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, 'sub')).st_mode), 0555)
+
+        # Only the exported file needs fixing.
+        self.assertEqual(permissions.fix_tree(self.dst), 1)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, 'exported')).st_mode), 0444)
+        self.assertEqual(stat.S_IMODE(os.stat(self.dst).st_mode), permissions.ROOT_MODE)
+
+        # Hardlinks would share their permissions with the source.
+        strategy, size = copy_file(os.path.join(self.src, 'data'), os.path.join(self.dst, 'linked'), 'link', read_only=True)
+        self.assertNotEqual(strategy, 'link')
+        self.assertNotEqual(os.stat(os.path.join(self.src, 'data')).st_ino, os.stat(os.path.join(self.dst, 'linked')).st_ino)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.src, 'data')).st_mode) & 0200, 0200)
+
+    def test_checksum_manifest(self):
+
+        open(os.path.join(self.src, 'data'), 'w').write('data')
+
+        copier = Copier(checksum='md5')
+        copier.add(os.path.join(self.src, 'data'), os.path.join(self.dst, 'data'))
+        copier.run()
+
+        size, mtime, digest = copier.checksums[os.path.join(self.dst, 'data')]
+        self.assertEqual(size, 4)
+        self.assertEqual(digest, '8d777f385d3dfec8815d20f7496026dc')
+
+        # Something the copier didn't place still makes it in.
+        open(os.path.join(self.dst, 'exported'), 'w').write('exported')
+
+        entries = manifest.build(self.dst, copier.checksums, 'md5')
+        self.assertEqual([e[0] for e in entries], ['data', 'exported'])
+
+        summary = manifest.write(self.dst, entries, 'md5')
+        self.assertEqual(summary['files'], 2)
+        self.assertEqual(manifest.verify(self.dst, full=True), [])
+
+        # A resumed commit may write it again after it was made read-only.
+        permissions.set_file(os.path.join(self.dst, manifest.MANIFEST_NAME))
+        self.assertEqual(manifest.write(self.dst, entries, 'md5'), summary)
+
+        os.unlink(os.path.join(self.dst, 'exported'))
+        self.assertEqual(manifest.verify(self.dst), ['exported'])
+
+    def test_chunked_copy(self):
+
+        src_path = os.path.join(self.src, 'large')
+        data = os.urandom(37)
+        open(src_path, 'wb').write(data)
+        os.makedirs(self.dst)
+
+        strategy, size = copy_file(src_path, os.path.join(self.dst, 'auto'), 'copy', chunked_threshold=10)
+        self.assertEqual(strategy, 'chunked')
+        self.assertEqual(open(os.path.join(self.dst, 'auto'), 'rb').read(), data)
+
+        # Interrupt a copy by having a chunk fail to verify.
+        dst_path = os.path.join(self.dst, 'resumed')
+        original = copier._hash_chunk
+        calls = []
+        def flaky_hash_chunk(chunk):
+            calls.append(chunk)
+            if len(calls) == 8:
+                return 'corrupt'
+            return original(chunk)
+        copier._hash_chunk = flaky_hash_chunk
+        try:
+            self.assertRaises(IOError, chunked_copy, src_path, dst_path, chunk_size=4)
+        finally:
+            copier._hash_chunk = original
+        self.assertTrue(os.path.exists(dst_path + copier.PARTIAL_SUFFIX))
+
+        # Only the chunks after the last good one are copied again.
+        self.assertEqual(chunked_copy(src_path, dst_path, chunk_size=4), 37 - 12)
+        self.assertEqual(open(dst_path, 'rb').read(), data)
+        self.assertFalse(os.path.exists(dst_path + copier.PARTIAL_SUFFIX))
+
+    def test_tree(self):
+
+        os.makedirs(os.path.join(self.src, 'a', 'b'))
+        os.makedirs(os.path.join(self.src, 'empty'))
+        for i in xrange(10):
+            open(os.path.join(self.src, 'a', 'frame.%04d.exr' % i), 'w').write('frame %d' % i)
+        open(os.path.join(self.src, 'a', 'b', 'deep'), 'w').write('deep')
+        os.symlink('a/b/deep', os.path.join(self.src, 'link'))
+
+        # A (potentially) sparse file.
+        with open(os.path.join(self.src, 'sparse'), 'wb') as fh:
+            fh.write('x')
+            fh.seek(4 * 1048576)
+            fh.write('y')
+
+        copier = Copier(batch_size=4, read_only=True)
+        copier.add_tree(self.src, self.dst)
+        stats = copier.run()
+
+        self.assertEqual(stats.files, 13)
+        self.assertEqual(stats.strategies['symlink'], 1)
+        self.assertEqual(open(os.path.join(self.dst, 'a', 'frame.0005.exr')).read(), 'frame 5')
+        self.assertEqual(open(os.path.join(self.dst, 'link')).read(), 'deep')
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'link')), 'a/b/deep')
+        self.assertEqual(os.listdir(os.path.join(self.dst, 'empty')), [])
+        self.assertEqual(os.path.getsize(os.path.join(self.dst, 'sparse')), 4 * 1048576 + 1)
+        self.assertTrue(os.stat(os.path.join(self.dst, 'sparse')).st_blocks <= os.stat(os.path.join(self.src, 'sparse')).st_blocks)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, 'a')).st_mode), permissions.DIRECTORY_MODE)
+
+    def test_sparse_unaligned_tail(self):
+
+        src_path = os.path.join(self.src, 'sparse')
+        with open(src_path, 'wb') as fh:
+            fh.write('head')
+            fh.seek(10 * 1048576)
+            fh.write('tail' * 25) # Not a multiple of any block size.
+        os.makedirs(self.dst)
+        dst_path = os.path.join(self.dst, 'sparse')
+
+        strategy, size = copy_file(src_path, dst_path)
+        self.assertEqual(size, 10 * 1048576 + 100)
+        self.assertEqual(open(dst_path, 'rb').read(), open(src_path, 'rb').read())
+
+    def test_move(self):
+
+        os.makedirs(self.dst)
+        src_path = os.path.join(self.src, 'data')
+        open(src_path, 'w').write('data')
+
+        strategy, size = copy_file(src_path, os.path.join(self.dst, 'renamed'), 'move')
+        self.assertEqual(strategy, 'rename')
+        self.assertFalse(os.path.exists(src_path))
+
+        # Pretend that the destination is on another device.
+        open(src_path, 'w').write('data')
+        with mock.patch.object(copier, 'same_device', return_value=False):
+            strategy, size = copy_file(src_path, os.path.join(self.dst, 'copied'), 'move')
+        self.assertTrue(strategy.endswith('+delete'), strategy)
+        self.assertEqual(open(os.path.join(self.dst, 'copied')).read(), 'data')
+        self.assertFalse(os.path.exists(src_path))
+
+    def test_move_tree(self):
+
+        for name in ('renamed', 'walked'):
+            tree = os.path.join(self.src, name)
+            os.makedirs(os.path.join(tree, 'sub'))
+            for i in xrange(5):
+                open(os.path.join(tree, 'sub', 'frame.%04d.exr' % i), 'w').write('frame %d' % i)
+
+        results = []
+        mover = Copier(batch_size=2, read_only=True, callback=results.extend)
+        mover.add_tree(os.path.join(self.src, 'renamed'), os.path.join(self.dst, 'renamed'), 'move')
+        stats = mover.run()
+
+        self.assertEqual(stats.strategies['rename'], 1)
+        self.assertEqual([r[:2] for r in results], [(os.path.join(self.dst, 'renamed'), 'rename')])
+        self.assertFalse(os.path.exists(os.path.join(self.src, 'renamed')))
+        self.assertEqual(open(os.path.join(self.dst, 'renamed', 'sub', 'frame.0003.exr')).read(), 'frame 3')
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, 'renamed', 'sub')).st_mode), permissions.DIRECTORY_MODE)
+
+        with mock.patch.object(copier, 'same_device', return_value=False):
+            mover = Copier(batch_size=2)
+            mover.add_tree(os.path.join(self.src, 'walked'), os.path.join(self.dst, 'walked'), 'move')
+            stats = mover.run()
+
+        self.assertEqual(stats.files, 5)
+        self.assertFalse(stats.strategies['rename'])
+        self.assertFalse(os.path.exists(os.path.join(self.src, 'walked')))
+        self.assertEqual(open(os.path.join(self.dst, 'walked', 'sub', 'frame.0003.exr')).read(), 'frame 3')
+
+    def test_add_many(self):
+
+        def entries():
+            for i in xrange(10):
+                name = 'frame.%04d.exr' % i
+                open(os.path.join(self.src, name), 'w').write('frame %d' % i)
+                yield os.path.join(self.src, name), os.path.join(self.dst, 'sub%d' % (i // 4), name), 'copy'
+
+        copier = Copier(batch_size=3)
+        copier.add_many(entries())
+        stats = copier.run()
+
+        self.assertEqual(stats.files, 10)
+        self.assertEqual(open(os.path.join(self.dst, 'sub2', 'frame.0009.exr')).read(), 'frame 9')
@@ -0,0 +1,86 @@
+import shutil
+import socket
+import tempfile
+
+from common import *
+
+from sgpublish.daemon import PublishDaemon, DaemonClient, DaemonError
+
+
+class TestDaemon(PublishTestCase):
+
+    def setUp(self):
+        super(TestDaemon, self).setUp()
+
+        # Unix socket paths are limited to ~100 bytes, so not in the sandbox.
+        self.socket_dir = tempfile.mkdtemp()
+        self.daemon = PublishDaemon(os.path.join(self.socket_dir, 'daemon.sock'), sgfs=self.sgfs)
+        self.daemon.start()
+        self.client = DaemonClient(self.daemon.address, timeout=30)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        shutil.rmtree(self.socket_dir)
+
+    def test_publish(self):
+
+        self.assertEqual(self.client.ping()['pid'], os.getpid())
+
+        data_file = os.path.join(self.sandbox, 'daemon_file.txt')
+        open(data_file, 'w').write('this is a dummy file')
+
+        job_id = self.client.submit(link=self.task, type='generic', name='test_daemon',
+            files=[data_file], metadata={'key': 'value'})
+        status = self.client.wait(job_id)
+
+        self.assertEqual(status['state'], 'done', status.get('error'))
+        self.assertEqual(status['version'], 1)
+        self.assertEqual(status['progress'], ['done', None, None])
+        self.assertTrue(os.path.exists(os.path.join(status['directory'], 'daemon_file.txt')))
+
+        publish = self.session.find_one('PublishEvent', [('id', 'is', status['publish']['id'])], ['sg_version'])
+        self.assertEqual(publish['sg_version'], 1)
+
+        self.assertEqual([job['id'] for job in self.client.list()], [job_id])
+
+    def test_failure(self):
+
+        job_id = self.client.submit(link=self.task, type='generic', name='test_daemon_failure',
+            files=[os.path.join(self.sandbox, 'does_not_exist_%s' % mini_uuid())])
+        status = self.client.wait(job_id)
+
+        self.assertEqual(status['state'], 'failed')
+        self.assertTrue(status['error']['message'])
+
+    def test_socket_mode(self):
+        self.assertEqual(os.stat(self.daemon.address).st_mode & 0777, 0600)
+
+    def test_bad_requests(self):
+        self.assertRaises(DaemonError, self.client.submit, type='generic', name='no_link')
+        self.assertRaises(DaemonError, self.client.submit, link=self.task, type='generic', name='x', bogus=1)
+        self.assertRaises(DaemonError, self.client.submit, link=self.task, type='generic', name='x', directory=self.sandbox)
+        self.assertRaises(DaemonError, self.client.submit, link=self.task, type='generic', name='x', files=[['/src', 'dst', 'move']])
+        self.assertRaises(DaemonError, self.client.submit, link=self.task, type='generic', name='x', files=[['/src', '../dst']])
+        self.assertRaises(DaemonError, self.client.status, 12345)
+        self.assertRaises(DaemonError, self.client.request, 'bogus')
+
+    def test_address_in_use(self):
+
+        # A live daemon's socket is not taken.
+        self.assertRaises(DaemonError, PublishDaemon, self.daemon.address, sgfs=self.sgfs)
+        self.assertEqual(self.client.ping()['pid'], os.getpid())
+
+        # Nor is anything which isn't a socket.
+        path = os.path.join(self.socket_dir, 'not_a_socket')
+        open(path, 'w').write('precious')
+        self.assertRaises(DaemonError, PublishDaemon, path, sgfs=self.sgfs)
+        self.assertEqual(open(path).read(), 'precious')
+
+        # But a stale one is.
+        stale_path = os.path.join(self.socket_dir, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(stale_path)
+        sock.close()
+        daemon = PublishDaemon(stale_path, sgfs=self.sgfs)
+        daemon.shutdown()
+        self.assertFalse(os.path.exists(stale_path))
@@ -0,0 +1,42 @@
+from common import *
+
+import threading
+
+from sgpublish.executor import ExecutorService
+
+
+class TestExecutorService(TestCase):
+
+    def test_queue_depth(self):
+
+        service = ExecutorService(sizes={'test': 1})
+        started = threading.Event()
+        event = threading.Event()
+
+        def first():
+            started.set()
+            event.wait(5)
+
+        try:
+            futures = [service.submit('test', first)]
+            futures.extend(service.submit('test', event.wait, 5) for i in xrange(2))
+            # The worker must have picked up the first before we count.
+            self.assertTrue(started.wait(5))
+            self.assertEqual(service.queue_depth('test'), 2)
+            self.assertEqual(service.status()['test']['max_workers'], 1)
+            event.set()
+            for future in futures:
+                future.result()
+            self.assertEqual(service.queue_depth(), 0)
+        finally:
+            event.set()
+            service.shutdown()
+
+    def test_restarts_after_shutdown(self):
+
+        service = ExecutorService()
+        self.assertEqual(service.submit('shotgun', lambda: 123).result(), 123)
+        service.shutdown()
+        self.assertEqual(service.status(), {})
+        self.assertEqual(service.submit('shotgun', lambda: 456).result(), 456)
+        service.shutdown()
@@ -0,0 +1,72 @@
+from common import *
+
+from sgpublish.journal import Journal, JOURNAL_NAME
+
+
+class TestJournal(PublishTestCase):
+
+    def test_partial_record(self):
+
+        directory = os.path.join(self.sandbox, 'partial_' + mini_uuid())
+        os.makedirs(directory)
+        journal = Journal(directory)
+        journal.write('commit', id=1, files=[])
+        journal.write_stage('updated')
+        journal.close()
+        open(journal.path, 'a').write('{"event": "sta')
+
+        state = Journal.find(os.path.join(directory, 'a', 'b')).replay()
+        self.assertEqual(state.commit['id'], 1)
+        self.assertEqual(sorted(state.stages), ['updated'])
+
+    def test_queued(self):
+
+        directory = os.path.join(self.sandbox, 'queued_' + mini_uuid())
+        os.makedirs(directory)
+        files = [('/src/%d' % i, os.path.join(directory, '%d' % i), 'copy') for i in xrange(2500)]
+        journal = Journal(directory)
+        journal.write_queued(files)
+        journal.write('commit', id=1)
+        journal.close()
+
+        # In chunks, rather than one huge record.
+        self.assertEqual([r['event'] for r in journal.read()], ['queued'] * 3 + ['commit'])
+
+        state = journal.replay()
+        self.assertEqual(len(state.queued), 2500)
+        self.assertEqual(list(state.queued), files)
+
+    def test_resume(self):
+
+        first = os.path.join(self.sandbox, 'first.txt')
+        open(first, 'w').write('first')
+        second = os.path.join(self.sandbox, 'second_' + mini_uuid() + '.txt')
+
+        publisher = Publisher(name='test_resume', type='generic', link=self.task, sgfs=self.sgfs, journal=True)
+        publisher.add_file(first)
+        publisher.add_file(second, 'second.txt')
+        publisher.metadata['key'] = 'value'
+        publish_id = publisher.id
+
+        # The second file doesn't exist, so the commit is rolled back.
+        self.assertRaises(Exception, publisher.commit)
+        directory = publisher.directory
+        self.assertFalse(directory.endswith('.failed'))
+        self.assertTrue(os.path.exists(os.path.join(directory, JOURNAL_NAME)))
+        self.assertTrue(os.path.exists(os.path.join(directory, 'first.txt')))
+        first_stat = os.stat(os.path.join(directory, 'first.txt'))
+
+        open(second, 'w').write('second')
+        resumed = Publisher.resume(publish_id, sgfs=self.sgfs)
+
+        self.assertEqual(resumed.directory, directory)
+        self.assertFalse(os.path.exists(os.path.join(directory, JOURNAL_NAME)))
+        self.assertEqual(open(os.path.join(directory, 'second.txt')).read(), 'second')
+        # The first file was not copied again.
+        self.assertEqual(os.stat(os.path.join(directory, 'first.txt')).st_ino, first_stat.st_ino)
+
+        publish = self.session.find_one('PublishEvent', [('id', 'is', publish_id)], ['sg_version'])
+        self.assertEqual(publish['sg_version'], 1)
+        tags = self.sgfs.get_directory_entity_tags(directory)
+        self.assertEqual(len(tags), 1)
+        self.assertEqual(tags[0]['key'], 'value')
@@ -0,0 +1,91 @@
+from common import *
+
+import json
+
+from sgpublish import metadata
+
+
+class TestSidecar(TestCase):
+
+    def setUp(self):
+        self.dir = os.path.join(self.sandbox, mini_uuid())
+        os.makedirs(self.dir)
+
+    def test_small(self):
+        data = {'key': 'value'}
+        self.assertTrue(metadata.offload(data, self.dir) is data)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, metadata.SIDECAR_NAME)))
+
+    def test_roundtrip(self):
+
+        data = {
+            'small': 'value',
+            'file_info': dict(('key%d' % i, 'x' * 100) for i in xrange(1000)),
+        }
+        summary = metadata.offload(data, self.dir, threshold=1024)
+
+        self.assertTrue(metadata.is_summary(summary))
+        self.assertEqual(summary['small'], 'value')
+        self.assertTrue(len(summary['file_info']) < 1000)
+        self.assertEqual(summary[metadata.POINTER_KEY]['partial'], ['file_info'])
+        self.assertTrue(len(json.dumps(summary)) < 1024)
+
+        # Inflating keeps anything else (e.g. from a tag).
+        summary['entity'] = {'type': 'PublishEvent', 'id': 1}
+        full = metadata.inflate(summary)
+        self.assertEqual(full['file_info']['key999'], 'x' * 100)
+        self.assertEqual(full['entity'], {'type': 'PublishEvent', 'id': 1})
+
+        # Via a moved directory.
+        moved = self.dir + '.moved'
+        os.rename(self.dir, moved)
+        self.assertRaises(IOError, metadata.inflate, summary)
+        self.assertEqual(metadata.inflate(summary, moved)['small'], 'value')
+
+        self.assertEqual(metadata.load({'sg_metadata': json.dumps(summary)}, moved)['file_info']['key0'], 'x' * 100)
+
+
+    def test_nested_fields(self):
+
+        # Like the Maya exporter; everything under one key.
+        data = {'maya': {
+            'file_info': dict(('key%d' % i, 'x' * 100) for i in xrange(400)),
+            'min_time': 1001.0,
+            'max_time': 1100.0,
+            'references': ['/path/to/ref.mb'],
+        }}
+        summary = metadata.offload(data, self.dir)
+
+        self.assertTrue(metadata.is_summary(summary))
+        self.assertEqual(summary['maya']['min_time'], 1001.0)
+        self.assertEqual(summary['maya']['max_time'], 1100.0)
+        self.assertEqual(summary['maya']['references'], ['/path/to/ref.mb'])
+        self.assertFalse('file_info' in summary['maya'])
+        self.assertEqual(summary[metadata.POINTER_KEY]['partial'], ['maya'])
+
+        self.assertEqual(len(metadata.inflate(summary)['maya']['file_info']), 400)
+
+        # The summary is still useful without its sidecar.
+        os.unlink(os.path.join(self.dir, metadata.SIDECAR_NAME))
+        self.assertRaises(IOError, metadata.inflate, summary)
+        partial = metadata.inflate(summary, missing_ok=True)
+        self.assertEqual(partial['maya']['max_time'], 1100.0)
+        self.assertFalse(metadata.POINTER_KEY in partial)
+
+
+class TestPublisherMetadata(PublishTestCase):
+
+    def test_offloaded_metadata(self):
+
+        with Publisher(name='test_big_metadata', type='generic', link=self.task, sgfs=self.sgfs, metadata_threshold=1024) as publisher:
+            publisher.metadata['maya'] = {'file_info': dict(('key%d' % i, 'x' * 100) for i in xrange(1000))}
+            publisher.metadata['note'] = 'small'
+
+        publish = self.session.find_one('PublishEvent', [('id', 'is', publisher.id)], ['sg_metadata'])
+        self.assertTrue(len(publish['sg_metadata']) < 1024)
+        self.assertEqual(json.loads(publish['sg_metadata'])['note'], 'small')
+        self.assertEqual(metadata.load(publish)['maya']['file_info']['key5'], 'x' * 100)
+
+        tags = [tag for tag in self.sgfs.get_directory_entity_tags(publisher.directory) if tag['entity'] == publisher.entity]
+        self.assertTrue(metadata.is_summary(tags[0]))
+        self.assertTrue('sgpublish' in metadata.inflate(tags[0], publisher.directory))
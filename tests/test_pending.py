@@ -0,0 +1,97 @@
+from common import *
+
+import time
+
+from sgpublish.pending import PendingFiles
+
+
+class TestPendingFiles(TestCase):
+
+    def setUp(self):
+        self.dir = os.path.join(self.sandbox, mini_uuid())
+        os.makedirs(self.dir)
+
+    def test_index(self):
+
+        files = PendingFiles()
+        files.append('/src/a', os.path.join(self.dir, 'a'), 'copy')
+        self.assertTrue(os.path.join(self.dir, 'a') in files)
+        self.assertFalse(os.path.join(self.dir, 'b') in files)
+        self.assertRaises(ValueError, files.append, '/src/other', os.path.join(self.dir, 'a'), 'copy')
+        self.assertEqual(list(files), [('/src/a', os.path.join(self.dir, 'a'), 'copy')])
+
+    def test_free_suffix(self):
+
+        files = PendingFiles()
+        path = os.path.join(self.dir, 'scene.ma')
+        self.assertEqual(files.free_suffix(path), 0)
+
+        files.append('/src', path, 'copy')
+        self.assertEqual(files.free_suffix(path), 1)
+        # Only a query; nothing was taken.
+        self.assertEqual(files.free_suffix(path), 1)
+
+        # Files on disk are also taken.
+        open(os.path.join(self.dir, 'scene_1.ma'), 'w').close()
+        files.append('/src', os.path.join(self.dir, 'scene_2.ma'), 'copy')
+        self.assertEqual(files.free_suffix(path), 3)
+
+    def test_spill(self):
+
+        files = PendingFiles(spill_threshold=10)
+        for i in xrange(25):
+            files.append('/src/frame.%04d.exr' % i, os.path.join(self.dir, 'frame.%04d.exr' % i), 'copy')
+            self.assertEqual(files.spilled, i >= 10)
+
+        self.assertEqual(len(files), 25)
+        self.assertTrue(os.path.join(self.dir, 'frame.0003.exr') in files)
+        self.assertTrue(os.path.join(self.dir, 'frame.0020.exr') in files)
+        self.assertFalse(os.path.join(self.dir, 'frame.0030.exr') in files)
+        self.assertRaises(ValueError, files.append, '/src/other', os.path.join(self.dir, 'frame.0003.exr'), 'copy')
+
+        entries = list(files)
+        self.assertEqual(len(entries), 25)
+        self.assertEqual(entries[12], ('/src/frame.0012.exr', os.path.join(self.dir, 'frame.0012.exr'), 'copy'))
+        self.assertTrue(all(isinstance(x, str) for entry in entries for x in entry))
+
+        files.close()
+        self.assertEqual(len(files), 0)
+
+    def test_benchmark(self):
+
+        count = 100000
+        start = time.time()
+        files = PendingFiles()
+        path = os.path.join(self.dir, 'frame.exr')
+        for i in xrange(count):
+            suffix = files.free_suffix(path)
+            files.append('/src/%d' % i, '%s_%d.exr' % (path[:-4], suffix) if suffix else path, 'copy')
+        elapsed = time.time() - start
+
+        self.assertEqual(len(files), count)
+        self.assertTrue(os.path.join(self.dir, 'frame_%d.exr' % (count - 1)) in files)
+        # Quadratic probing would take hours.
+        self.assertTrue(elapsed < 30, 'queueing %d files took %.1fs' % (count, elapsed))
+
+
+class TestPublisherQueue(PublishTestCase):
+
+    def test_add_files_benchmark(self):
+
+        count = 100000
+        publisher = Publisher(name='test_queue_benchmark', type='generic', link=self.task, sgfs=self.sgfs)
+        try:
+
+            start = time.time()
+            publisher.add_files('/frames/frame.%06d.exr' % i for i in xrange(count))
+            for i in xrange(100):
+                publisher.add_file('/frames/frame.000000.exr', make_unique=True)
+            elapsed = time.time() - start
+
+            self.assertEqual(len(publisher._files), count + 100)
+            self.assertTrue(publisher.file_exists('frame.%06d.exr' % (count - 1)))
+            self.assertEqual(publisher.unique_name('frame.000000.exr'), 'frame.000000_101.exr')
+            self.assertTrue(elapsed < 60, 'queueing %d files took %.1fs' % (count, elapsed))
+
+        finally:
+            publisher.rollback()
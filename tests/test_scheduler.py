@@ -0,0 +1,167 @@
+from common import *
+
+import json
+import threading
+import time
+
+from sgpublish import scheduler
+from sgpublish.copier import Copier
+from sgpublish.scheduler import IOScheduler, INTERACTIVE, BATCH
+
+
+class FakeClock(object):
+
+    """A clock which only moves when slept on."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.lock = threading.Lock()
+        self.on_sleep = None
+
+    def __call__(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        if self.on_sleep is not None:
+            self.on_sleep(seconds)
+        with self.lock:
+            self.now += seconds
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.dir = os.path.join(self.sandbox, mini_uuid())
+        os.makedirs(self.dir)
+
+    def test_unlimited(self):
+        sched = IOScheduler(clock=self.clock, sleep=self.clock.sleep)
+        self.assertFalse(sched.active)
+        self.assertEqual(sched.throttle(1 << 30), 0)
+
+    def test_process_rate(self):
+
+        sched = IOScheduler(process_rate=100, clock=self.clock, sleep=self.clock.sleep)
+        for i in xrange(4):
+            sched.throttle(100)
+
+        # The first second's worth is the burst; the rest are at 100B/s.
+        self.assertAlmostEqual(self.clock.now, 1003.0)
+        self.assertEqual(sched.status()['bytes'], 400)
+        self.assertAlmostEqual(sched.status()['throttled'], 3.0)
+
+    def test_host_rate(self):
+
+        path = os.path.join(self.dir, 'host.json')
+        a = IOScheduler(host_rate=100, host_state_path=path, clock=self.clock, sleep=self.clock.sleep)
+        b = IOScheduler(host_rate=100, host_state_path=path, clock=self.clock, sleep=self.clock.sleep)
+
+        a.throttle(100)
+        self.assertAlmostEqual(self.clock.now, 1000.0)
+
+        # The other "process" must wait for the first one's burst to refill.
+        b.throttle(100)
+        self.assertAlmostEqual(self.clock.now, 1001.0)
+
+    def test_host_state_is_untrusted(self):
+
+        path = os.path.join(self.dir, 'state', 'host.json')
+        sched = IOScheduler(host_rate=100, host_state_path=path, clock=self.clock, sleep=self.clock.sleep)
+        sched.throttle(10)
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 07777, 01777)
+
+        # Anyone may write it, so a crippling debt (or a future timestamp) is ignored.
+        for state in ({'tokens': -1e12, 'updated': 1000.0}, {'tokens': 0, 'updated': 1e12}, [1, 2]):
+            with open(path, 'w') as fh:
+                fh.write(json.dumps(state))
+            start = self.clock.now
+            sched.throttle(10)
+            self.assertAlmostEqual(self.clock.now, start)
+
+        # Symlinks are never followed.
+        target = os.path.join(self.dir, 'target')
+        open(target, 'w').write('precious')
+        os.unlink(path)
+        os.symlink(target, path)
+        sched.throttle(10)
+        self.assertEqual(open(target).read(), 'precious')
+
+    def test_batch_share(self):
+
+        sched = IOScheduler(process_rate=100, batch_share=0.25, clock=self.clock, sleep=self.clock.sleep)
+        sched.throttle(10, INTERACTIVE)
+        sched.throttle(10, BATCH)
+        sched.throttle(10, BATCH)
+
+        # Batch copies cost 4x while interactive ones are active: 10 + 40 + 40 = 90.
+        self.assertAlmostEqual(self.clock.now, 1000.0)
+        sched.throttle(10, BATCH)
+        sched.throttle(10, BATCH)
+        self.assertAlmostEqual(self.clock.now, 1000.7)
+
+    def test_priority_queue(self):
+
+        sched = IOScheduler(process_rate=100, clock=self.clock, sleep=self.clock.sleep)
+        sched.throttle(200, BATCH)
+
+        order = []
+        queues = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def on_sleep(seconds):
+            queues.append([w['priority'] for w in sched.status()['queue']])
+            if not started.is_set():
+                started.set()
+                release.wait(5)
+
+        def copy(name, priority):
+            sched.throttle(100, priority)
+            order.append(name)
+
+        def start(name, priority):
+            thread = threading.Thread(target=copy, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+
+        # The first batch copy is held while it waits for bandwidth, and
+        # another queues up behind it.
+        self.clock.on_sleep = on_sleep
+        threads = []
+        start('batch1', BATCH)
+        started.wait(5)
+        start('batch2', BATCH)
+        while len(sched.status()['queue']) < 2:
+            time.sleep(0.01)
+
+        # An interactive copy goes ahead of both.
+        start('interactive', INTERACTIVE)
+        threads[-1].join(5)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(order, ['interactive', 'batch1', 'batch2'])
+        self.assertEqual(queues[:2], [[BATCH], [INTERACTIVE, BATCH, BATCH]])
+        self.assertEqual(sched.status()['waiting'], {INTERACTIVE: 0, BATCH: 0})
+
+    def test_copier(self):
+
+        src = os.path.join(self.dir, 'src')
+        os.makedirs(src)
+        copier = Copier(batch_size=1, priority=BATCH)
+        for i in xrange(3):
+            path = os.path.join(src, 'file%d' % i)
+            open(path, 'w').write('x' * 1000)
+            copier.add(path, os.path.join(self.dir, 'dst', 'file%d' % i), 'copy')
+
+        scheduler.configure(process_rate=1000, clock=self.clock, sleep=self.clock.sleep)
+        try:
+            stats = copier.run()
+        finally:
+            scheduler.configure()
+
+        self.assertEqual(stats.files, 3)
+        self.assertAlmostEqual(self.clock.now, 1002.0)
@@ -0,0 +1,116 @@
+from common import *
+
+import datetime
+
+import mock
+
+from sgpublish import stubs
+from sgpublish.publisher import ShotgunFault
+
+
+class TestStubPool(PublishTestCase):
+
+    def setUp(self):
+        super(TestStubPool, self).setUp()
+
+        self._pool = stubs.pool
+        self.pool = stubs.pool = stubs.StubPool(enabled=True, size=2)
+
+    def tearDown(self):
+        self.pool.retire()
+        stubs.pool = self._pool
+
+    def _waiting(self):
+        return self.session.find('PublishEvent', [('code', 'is', stubs.STUB_CODE)])
+
+    def test_claim(self):
+
+        project = self.session.merge(self.proj)
+        user = self.session.guess_user()
+        for future in self.pool.fill(self.session, project, user):
+            future.result()
+        self.assertEqual(self.pool.status()['ready'], 2)
+        ready = set(e['id'] for e in self._waiting())
+
+        with Publisher(name='test_stub_claim', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+            pass
+
+        self.assertTrue(publisher.id in ready)
+        self.assertEqual(self.pool.status()['claimed'], 1)
+        publish = self.session.find_one('PublishEvent', [('id', 'is', publisher.id)], ['code', 'sg_version', 'sg_link'])
+        self.assertEqual(publish['code'], 'test_stub_claim')
+        self.assertEqual(publish['sg_version'], 1)
+        self.assertEqual(publish['sg_link']['id'], self.task['id'])
+
+        # Unclaimed stubs are retired.
+        for future in self.pool.fill(self.session, project, user):
+            future.result()
+        self.assertEqual(len(self._waiting()), 2)
+        self.pool.retire()
+        self.assertEqual(self._waiting(), [])
+
+    def test_publish_many(self):
+
+        project = self.session.merge(self.proj)
+        for future in self.pool.fill(self.session, project, self.session.guess_user()):
+            future.result()
+
+        results = publish_many([
+            dict(name='test_stub_many_%d' % i, type='generic', link=self.task)
+            for i in xrange(3)
+        ], sgfs=self.sgfs)
+
+        self.assertEqual([r.ok for r in results], [True, True, True])
+        # The third may or may not have been refilled in time.
+        status = self.pool.status()
+        self.assertTrue(status['claimed'] >= 2)
+        self.assertEqual(status['claimed'] + status['missed'], 3)
+        for i, result in enumerate(results):
+            publish = self.session.find_one('PublishEvent', [('id', 'is', result.publisher.id)], ['code', 'sg_version'])
+            self.assertEqual(publish['code'], 'test_stub_many_%d' % i)
+            self.assertEqual(publish['sg_version'], 1)
+
+    def test_disabled(self):
+        self.pool.enabled = False
+        self.assertEqual(self.pool.fill(self.session, self.proj), [])
+        self.assertEqual(self.pool.claim(self.session, self.proj), None)
+
+    def test_failed_claim(self):
+
+        project = self.session.merge(self.proj)
+        for future in self.pool.fill(self.session, project, self.session.guess_user()):
+            future.result()
+        ready = set(e['id'] for e in self._waiting())
+
+        with mock.patch.object(Publisher, '_claim_stub', side_effect=ShotgunFault('claim failed')):
+            with Publisher(name='test_stub_failed_claim', type='generic', link=self.task, sgfs=self.sgfs) as publisher:
+                pass
+
+        # It fell back to creating one, and retired the stub it couldn't claim.
+        self.assertFalse(publisher.id in ready)
+        waiting = set(e['id'] for e in self._waiting())
+        self.assertEqual(len(ready - waiting), 1)
+
+    def test_sweep(self):
+
+        project = self.session.merge(self.proj)
+        user = self.session.guess_user()
+        data = {'code': stubs.STUB_CODE, 'project': project, 'sg_version': 0, 'created_by': user}
+        stale = self.session.create('PublishEvent', dict(data, created_at=datetime.datetime.now() - datetime.timedelta(days=2)))
+        fresh = self.session.create('PublishEvent', data)
+
+        for future in self.pool.fill(self.session, project, user):
+            future.result()
+
+        waiting = set(e['id'] for e in self._waiting())
+        self.assertFalse(stale['id'] in waiting)
+        self.assertTrue(fresh['id'] in waiting)
+
+        # Only the first fill sweeps.
+        stale = self.session.create('PublishEvent', dict(data, created_at=datetime.datetime.now() - datetime.timedelta(days=2)))
+        for future in self.pool.fill(self.session, project, user):
+            future.result()
+        self.assertTrue(stale['id'] in set(e['id'] for e in self._waiting()))
+
+        self.session.delete('PublishEvent', fresh['id'])
+        self.session.delete('PublishEvent', stale['id'])
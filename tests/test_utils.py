@@ -0,0 +1,18 @@
+from common import *
+
+from sgpublish import utils
+
+
+class TestUniqueDirectory(TestCase):
+
+    def test_make_unique_directory(self):
+
+        base_path = os.path.join(self.sandbox, mini_uuid(), 'publish')
+        paths = [utils.make_unique_directory(base_path) for i in xrange(3)]
+        self.assertEqual(paths, [base_path, base_path + '_1', base_path + '_2'])
+
+        # Failed publishes don't collide, and gaps are filled.
+        os.makedirs(base_path + '.1234.failed')
+        os.makedirs(base_path + '_4')
+        self.assertEqual(utils.make_unique_directory(base_path), base_path + '_3')
+        self.assertEqual(utils.make_unique_directory(base_path), base_path + '_5')